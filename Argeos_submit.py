@@ -14,24 +14,80 @@ The program takes a file with ID GSE as input, and outputs all the necessary inf
 The output is three files: a human-readable text file, a table -
 suitable for sorting results, as well as a file with errors, where bugged IDs are written
 """
+import calendar
 import click
 import csv
+import ftplib
+import gzip
+import hashlib
+import io
+import json
+import queue
+import re
+import sqlite3
+import tempfile
 import tarfile
 import shutil
-import requests
-from bs4 import BeautifulSoup
-from tqdm import tqdm
-import entrezpy.esummary.esummarizer
-import entrezpy.esearch.esearcher
-import entrezpy.efetch.efetcher
+import socket
+import threading
+import time
+import marshal
+import bisect
+import functools
+import random
+import heapq
+import urllib.parse
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
-from contextlib import contextmanager, redirect_stderr, redirect_stdout
-import logging
-from copy import deepcopy
-from pymed import PubMed
+from contextlib import contextmanager
+import collections
+from email.utils import formatdate, parsedate_to_datetime
 import sys
 import subprocess
 
+
+class LazyImport:
+    """
+    Модуль (или объект из модуля), который на самом деле импортируется только при первом обращении.
+    Тяжелые пакеты (bs4, requests, pyarrow) нужны не в каждом режиме, а импорт всех сразу
+    заметно тормозит даже --help. Если модулей несколько, берется первый, который удалось импортировать
+    """
+
+    def __init__(self, modules, attr=None):
+        self._modules = modules if isinstance(modules, tuple) else (modules,)
+        self._attr = attr
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            for i, name in enumerate(self._modules):
+                try:
+                    module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if i == len(self._modules) - 1:
+                        raise
+            self._target = getattr(module, self._attr) if self._attr else module
+        return self._target
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+requests = LazyImport("requests")
+BeautifulSoup = LazyImport("bs4", "BeautifulSoup")
+tqdm = LazyImport("tqdm", "tqdm")
+pyarrow = LazyImport("pyarrow")  # не обязательный, только для --format parquet/arrow
+pyarrow_parquet = LazyImport("pyarrow.parquet")
+zstd = LazyImport(("compression.zstd", "zstandard"))  # не обязательный, только для --format tsv.zst
+etree = LazyImport(("lxml.etree", "xml.etree.ElementTree"))  # для потокового парсера, lxml заметно быстрее
+resource = LazyImport("resource")  # нет на Windows, нужен только для пикового RSS в отчете
+
 # ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ
 if True:
     # NCBI требует сообщать им почту разраба и название проги
@@ -42,62 +98,236 @@ if True:
     # А это директория для временных файлов
     tmp_dir = os.path.join(dirname, "argeos_tmp")
     Error_List = []  # задаем пустой лист, для повторного анализа плохих ID (Глобальная переменная!)
-    reader = csv.reader(open(os.path.join(dirname, 'dict_if_final.csv'), 'r'))
-    dict_if = {}
-    for k, v in filter(None, reader):
-        dict_if[k] = v
+    # Таблица импакт-факторов (dict_if_final.csv) и список плохих ID (bad_ids.txt) читаются не здесь,
+    # а при первом обращении: см. get_dict_if() и get_bad_ids()
     VerboseG = False  # G от слова global
     Cell_size_for_tsv = 50000
-    with open(os.path.join(dirname, 'bad_ids.txt'), 'r') as badids:
-        lines = badids.readlines()
-    Bad_IDs = [x.strip() for x in lines]
+    # Параметры скачивания с GEO: сколько потоков качают одновременно и какими кусками (в байтах)
+    Download_workers = 4
+    Block_size = 1024 * 1024
+    GEO_ftp_host = "ftp.ncbi.nlm.nih.gov"  # None - качать сразу по HTTPS
+    GEO_https_base = "https://ftp.ncbi.nlm.nih.gov"  # тот же /geo/series/GSEnnn/ путь, но по HTTPS
+    AE_base = "https://www.ebi.ac.uk/arrayexpress/xml/v3"  # /experiments и /protocols у ArrayExpress
+    AE_workers = 8  # сколько потоков одновременно ходят в ArrayExpress
+    Eutils_base = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils"  # E-utilities (esearch, esummary)
+    Search_workers = 3  # сколько запросов esearch идут одновременно (частоту все равно держит get_entrez_bucket)
+    Search_page = 10000  # сколько ID забирать за один запрос esearch
+    Keep_tmp = False  # отладочный режим: сохранять скачанные архивы в tmp_dir
+    Fuzzy_if = False  # искать импакт-фактор по похожему названию журнала, если точного нет
+    Api_key = None  # NCBI API ключ (10 запросов в секунду вместо 3)
+    Pubmed_batch = 200  # сколько PMID отправлять в esummary за один запрос
+    Pubmed_cache = None  # PubMedCache, если кэш включен (--cache_dir)
+    Search_cache = None  # SearchCache, если кэш включен (--cache_dir)
+    Local_cache = None  # LocalCache, если кэш включен (--cache_dir)
+    Offline = False  # работать только с кэшем, без сети
+    Parser_engine = "soup"  # чем разбирать MINiML: soup (geo_xml_parser) или iter (geo_xml_iterparser)
+    Sample_rows = False  # собирать строки по каждому сэмплу для --samples (см. SampleWriter)
+    Value_caps = {}  # --value_cap: поле GsmCollector (или "*" - все поля) -> сколько разных значений оставлять
+    Low_memory = False  # --low_memory: в пул процессов _family.xml идет через временный файл, а не в памяти
+    # Сетевой слой (см. net_call): таймауты, повторы с паузами и предохранитель на каждый сервер
+    Net_timeout = (10, 120)  # секунд на подключение и на ожидание данных (не на весь ответ!)
+    Net_retries = 5  # сколько раз повторять запрос после временной ошибки (обрыв, таймаут, 429, 5xx)
+    Net_backoff = 1.0  # первая пауза перед повтором, дальше удваивается (со случайным разбросом)
+    Net_backoff_max = 120.0
+    Retry_statuses = (429, 500, 502, 503, 504)
+    Breaker_failures = 8  # столько ошибок подряд - и сервер считается лежащим
+    Breaker_cooldown = 60.0  # секунд не ходить на лежащий сервер, потом пробуем одним запросом
+
+
+class Record:
+    """
+    Основа для записей: поля перечислены в __slots__ наследника и у каждого экземпляра свои (по умолчанию None).
+    Без __dict__ экземпляр заметно меньше в памяти, а копировать запись целиком не нужно - см. replace()
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("unknown fields: " + ", ".join(fields))
 
+    def replace(self, **changes):
+        """
+        Выход: новая запись, у которой заменены только поля из changes, остальные ссылаются на те же значения
+        """
+        new = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(new, name, changes[name] if name in changes else getattr(self, name))
+        return new
 
-class SeriesInfo:
+
+class SeriesInfo(Record):
     # класс для удобной записи переменных датасета
-    GSE = None
-    Authors = None
-    organism = None
-    samples = None
-    Type = None
-    platform = None
-    title = None
-    sub_date = None
-    Summary = None
-    Overall_design = None
-    BioProject = None
-    BioProj_EBI = None
-    SRA = None
-
-
-class PubMedInfo:
+    __slots__ = ("GSE", "Authors", "organism", "samples", "Type", "platform", "title", "sub_date", "Summary",
+                 "Overall_design", "BioProject", "BioProj_EBI", "SRA")
+
+
+class PubMedInfo(Record):
     # класс для работы с данными из PubMed
-    journal = None  # полное название журнала
-    doi = None  # doi айдишник
-    impfact = None  # импакт фактор журнала
-    pbid = None  # id для поиска статьи в pubmed и вытаскивания
-    title = None  # Название статьи
-    full_refs = None  # Все статьи данной записи
+    __slots__ = ("journal",  # полное название журнала
+                 "doi",  # doi айдишник
+                 "impfact",  # импакт фактор журнала
+                 "pbid",  # id для поиска статьи в pubmed и вытаскивания
+                 "title",  # Название статьи
+                 "full_refs")  # Все статьи данной записи
 
 
-class GsmInfo:
-    Cell_type = None
-    Treatment = None
-    Growth = None
-    Type_mol = None
-    Extr_prot = None
-    Characteristics = None
-    All_protocols = None
+class GsmInfo(Record):
+    __slots__ = ("Cell_type", "Treatment", "Growth", "Type_mol", "Extr_prot", "Characteristics", "All_protocols",
+                 "Samples")  # Samples - строки по каждому каналу сэмплов, только для --samples (иначе None)
 
 
-class GseInfo:
+class GseInfo(Record):
     # И будет создан один класс, что бы править ими всеми
-    series_info = SeriesInfo()
-    PubMed_info = PubMedInfo()
-    gsm_info = GsmInfo()
+    # Подклассы свои у каждой записи (кроме копий из replace, которые делят неизмененные подклассы с оригиналом)
+    __slots__ = ("series_info", "PubMed_info", "gsm_info")
+
+    def __init__(self, series_info=None, PubMed_info=None, gsm_info=None):
+        super().__init__(series_info=SeriesInfo() if series_info is None else series_info,
+                         PubMed_info=PubMedInfo() if PubMed_info is None else PubMed_info,
+                         gsm_info=GsmInfo() if gsm_info is None else gsm_info)
 
 
 # Технические функции
+class OrderedSet:
+    """
+    Множество, которое помнит порядок первого добавления (на основе dict, проверка вхождения за O(1)).
+    Используется везде, где нужны уникальные значения в порядке появления: списки из листа с проверкой
+    "not in" становятся квадратичными на сериях с тысячами сэмплов
+    """
+
+    __slots__ = ("_items",)
+
+    def __init__(self, iterable=()):
+        self._items = dict.fromkeys(iterable)
+
+    def add(self, item):
+        self._items[item] = None
+
+    def update(self, iterable):
+        self._items.update(dict.fromkeys(iterable))
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "OrderedSet(" + repr(list(self._items)) + ")"
+
+
+class CappedSet(OrderedSet):
+    """
+    OrderedSet, который хранит не больше cap разных значений (0 - без ограничения). Сверх этого значения
+    только считаются: запоминается их hash(), а не сами строки, так что на сериях с десятками тысяч сэмплов
+    (у каждого свои Characteristics) память не растет вместе с текстом. Сколько не влезло - в more
+    """
+
+    __slots__ = ("cap", "_extra")
+
+    def __init__(self, cap=0):
+        super().__init__()
+        self.cap = cap
+        self._extra = set()
+
+    def add(self, item):
+        if item in self._items:
+            return
+        if self.cap and len(self._items) >= self.cap:
+            self._extra.add(hash(item))  # в пределах одного разбора hash() постоянный, а совпадения редки
+        else:
+            self._items[item] = None
+
+    def update(self, iterable):
+        for item in iterable:
+            self.add(item)
+
+    @property
+    def more(self):
+        return len(self._extra)
+
+
+def parse_caps(text):
+    """
+    Вход: строка из --value_cap: число (для всех полей) и/или пары поле=число через запятую,
+    например 1000 или characteristics=200,cell_type=50 или 1000,characteristics=200
+    Выход: словарь поле -> ограничение ("*" - для всех остальных) или None, если строка кривая
+    """
+    caps = {}
+    for part in text.split(","):
+        name, _, value = part.strip().rpartition("=")
+        name = name.strip() or "*"
+        if not value.strip().isdigit() or (name != "*" and name not in GsmCollector.fields):
+            return None
+        caps[name] = int(value)
+    return caps
+
+
+def peak_rss():
+    """
+    Выход: пиковый RSS текущего процесса в байтах (None, если узнать нельзя, например на Windows)
+    """
+    try:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    except ImportError:
+        return None
+    # в Linux ru_maxrss в килобайтах, а в macOS - в байтах
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+_dict_if = None
+_bad_ids = None
+
+
+def get_dict_if():
+    """
+    Выход: словарь журнал -> импакт-фактор из dict_if_final.csv
+    CSV на 12.5 тысяч строк читается только один раз: рядом кладется его бинарная копия (marshal),
+    которая пересобирается, если у CSV поменялось время изменения или размер
+    """
+    global _dict_if
+    if _dict_if is None:
+        csv_path = os.path.join(dirname, 'dict_if_final.csv')
+        bin_path = os.path.join(dirname, 'dict_if_final.marshal')
+        stat = os.stat(csv_path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        try:
+            with open(bin_path, 'rb') as bin_file:
+                saved_stamp, table = marshal.loads(bin_file.read())
+            if tuple(saved_stamp) == stamp:
+                _dict_if = table
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        if _dict_if is None:
+            with open(csv_path, 'r') as csv_file:
+                _dict_if = {k: v for k, v in filter(None, csv.reader(csv_file))}
+            try:
+                with open(bin_path, 'wb') as bin_file:
+                    marshal.dump((stamp, _dict_if), bin_file)
+            except OSError:
+                pass  # нет прав на запись - просто каждый раз читаем CSV
+    return _dict_if
+
+
+def get_bad_ids():
+    """
+    Выход: OrderedSet ID из bad_ids.txt, которые не нужно анализировать (пустой, если файла нет)
+    """
+    global _bad_ids
+    if _bad_ids is None:
+        try:
+            with open(os.path.join(dirname, 'bad_ids.txt'), 'r') as badids:
+                _bad_ids = OrderedSet(x.strip() for x in badids)
+        except FileNotFoundError:
+            _bad_ids = OrderedSet()
+    return _bad_ids
+
+
 def chunks(lst, chunk_size):
     """
     Вход: лист и переменая int - по сколько переменныых делим лист
@@ -108,86 +338,563 @@ def chunks(lst, chunk_size):
     return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
 
 
-def mydeepcopy(gse_mega):
-    """
-    Какие-то баги возникали из-за обычного копирования, пытался решить дипкопией.
-    Не помню помогло по итогу или нет, но лучше не трогать :)
-    """
-    new_gse_mega = GseInfo()
-    new_gse_mega.series_info.Authors = deepcopy(gse_mega.series_info.Authors)
-    new_gse_mega.series_info.organism = deepcopy(gse_mega.series_info.organism)
-    new_gse_mega.series_info.samples = deepcopy(gse_mega.series_info.samples)
-    new_gse_mega.series_info.Type = deepcopy(gse_mega.series_info.Type)
-    new_gse_mega.series_info.platform = deepcopy(gse_mega.series_info.platform)
-    new_gse_mega.series_info.title = deepcopy(gse_mega.series_info.title)
-    new_gse_mega.series_info.sub_date = deepcopy(gse_mega.series_info.sub_date)
-    new_gse_mega.series_info.Summary = deepcopy(gse_mega.series_info.Summary)
-    new_gse_mega.series_info.Overall_design = deepcopy(gse_mega.series_info.Overall_design)
-    new_gse_mega.series_info.BioProject = deepcopy(gse_mega.series_info.BioProject)
-    new_gse_mega.series_info.BioProj_EBI = deepcopy(gse_mega.series_info.BioProj_EBI)
-    new_gse_mega.series_info.SRA = deepcopy(gse_mega.series_info.SRA)
-    new_gse_mega.PubMed_info.journal = deepcopy(gse_mega.PubMed_info.journal)
-    new_gse_mega.PubMed_info.doi = deepcopy(gse_mega.PubMed_info.doi)
-    new_gse_mega.PubMed_info.impfact = deepcopy(gse_mega.PubMed_info.impfact)
-    new_gse_mega.PubMed_info.pbid = deepcopy(gse_mega.PubMed_info.pbid)
-    new_gse_mega.PubMed_info.title = deepcopy(gse_mega.PubMed_info.title)
-    new_gse_mega.PubMed_info.full_refs = deepcopy(gse_mega.PubMed_info.full_refs)
-    new_gse_mega.gsm_info.Cell_type = deepcopy(gse_mega.gsm_info.Cell_type)
-    new_gse_mega.gsm_info.Treatment = deepcopy(gse_mega.gsm_info.Treatment)
-    new_gse_mega.gsm_info.Growth = deepcopy(gse_mega.gsm_info.Growth)
-    new_gse_mega.gsm_info.Type_mol = deepcopy(gse_mega.gsm_info.Type_mol)
-    new_gse_mega.gsm_info.Extr_prot = deepcopy(gse_mega.gsm_info.Extr_prot)
-    new_gse_mega.gsm_info.Characteristics = deepcopy(gse_mega.gsm_info.Characteristics)
-    new_gse_mega.gsm_info.All_protocols = deepcopy(gse_mega.gsm_info.All_protocols)
-    return new_gse_mega
-
-
 def cell_splitter(enter_string):
     """
-    Прото разбивает строку на несколько разделенных табом
+    Вход: строка
+    Выход: лист кусков строки для отдельных ячеек таблицы: если строка длиннее Cell_size_for_tsv, то куски по
+    Cell_size_for_tsv - 1 символов, иначе строка целиком
+    Режется за один проход срезами от исходной строки (раньше хвост каждый раз копировался заново)
     """
     # немного логики
     if enter_string is not None:
         n = Cell_size_for_tsv
-        if n == 0:
-            return enter_string
-        elif n < 100:
-            return enter_string
+        if n < 100 or len(enter_string) <= n:  # 0 - без ограничений, слишком маленькие ячейки тоже не режем
+            return [enter_string]
         # когда все проверили, просто разбиваем
-        exit_str = ""
-        if len(enter_string) > n:
-            numb = len(enter_string) // n
-            for i in range(numb + 1):
-                exit_str = exit_str + enter_string[:n - 1] + "\t"
-                enter_string = enter_string[n - 1:]
-        else:
-            exit_str = enter_string
-        return exit_str.strip("\t")
+        return [enter_string[i:i + n - 1] for i in range(0, len(enter_string), n - 1)]
     else:
         print("error! string is None type", file=sys.stderr)
-        return " "
+        return [" "]
 
 
-@contextmanager
-def suppressor(a):
-    a = True
-    if a:
-        with open(os.devnull, 'w') as fnull:
-            with redirect_stderr(fnull) as err, redirect_stdout(fnull) as out:
-                yield (err, out)
-    else:
-        yield
+class RunMetrics:
+    """
+    Счетчики и гистограммы по стадиям работы (esearch, скачивание, tar, разбор XML, сэмплы, esummary, импакт-факторы,
+    разбиение, запись). Пишут в них все потоки сразу, так что все под одним замком.
+    В конце запуска выгружается в run_report.json (write_json) и, если нужно, в текстовый формат Prometheus
+    (write_prometheus). Время у стадий суммируется по всем потокам, поэтому может быть больше wall_seconds
+    """
+    seconds_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    bytes_buckets = tuple(1024 * 4 ** i for i in range(11))  # от 1 КБ до 1 ГБ
+    rss_buckets = tuple(2 ** 20 * 2 ** i for i in range(17))  # от 1 МБ до 64 ГБ
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}  # имя -> {"buckets", "counts" (последний - больше всех границ), "count", "sum", ...}
+            self.started = time.time()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=None):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                buckets = list(buckets or self.seconds_buckets)
+                hist = {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "count": 0, "sum": 0.0,
+                        "min": value, "max": value}
+                self.histograms[name] = hist
+            hist["counts"][bisect.bisect_left(hist["buckets"], value)] += 1
+            hist["count"] += 1
+            hist["sum"] += value
+            hist["min"] = min(hist["min"], value)
+            hist["max"] = max(hist["max"], value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        Декоратор: время каждого вызова функции идет в гистограмму name
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        Выход: копия всех значений (словарь, который можно передать из другого процесса и слить через merge)
+        """
+        with self.lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {name: dict(hist, buckets=list(hist["buckets"]), counts=list(hist["counts"]))
+                                   for name, hist in self.histograms.items()}}
+
+    def drain(self):
+        """
+        Выход: все, что накоплено (как snapshot), после чего счетчики и гистограммы обнуляются.
+        Так процесс разбора отдает с каждым заданием только то, что насчитал после прошлого
+        """
+        with self.lock:
+            data = {"counters": self.counters, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return data
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot["histograms"].items():
+                hist = self.histograms.get(name)
+                if hist is None:
+                    self.histograms[name] = dict(other, buckets=list(other["buckets"]), counts=list(other["counts"]))
+                    continue
+                hist["counts"] = [a + b for a, b in zip(hist["counts"], other["counts"])]
+                hist["count"] += other["count"]
+                hist["sum"] += other["sum"]
+                hist["min"] = min(hist["min"], other["min"])
+                hist["max"] = max(hist["max"], other["max"])
+
+    def report(self, **extra):
+        """
+        Выход: словарь для run_report.json: время запуска, счетчики и гистограммы (со средним), плюс extra
+        """
+        data = self.snapshot()
+        for hist in data["histograms"].values():
+            hist["mean"] = hist["sum"] / hist["count"]
+        report = {"started": formatdate(self.started, localtime=True),
+                  "wall_seconds": round(time.time() - self.started, 3),
+                  "peak_rss_bytes": peak_rss()}  # основной процесс, у процессов разбора - гистограмма parse_rss_bytes
+        report.update(extra)
+        report.update(data)
+        return report
+
+    def write_json(self, path, **extra):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(**extra), f, indent=1, sort_keys=True)
+            f.write("\n")
+
+    def write_prometheus(self, path, prefix="argeos_"):
+        """
+        Текстовый формат Prometheus (для node_exporter textfile collector и т.п.).
+        Файл пишется целиком во временный и потом переименовывается, чтобы коллектор не прочитал половину
+        """
+        data = self.snapshot()
+        lines = ["# TYPE " + prefix + "wall_seconds gauge",
+                 prefix + "wall_seconds " + repr(round(time.time() - self.started, 3))]
+        rss = peak_rss()
+        if rss is not None:
+            lines.append("# TYPE " + prefix + "peak_rss_bytes gauge")
+            lines.append(prefix + "peak_rss_bytes " + str(rss))
+        for name, value in sorted(data["counters"].items()):
+            lines.append("# TYPE " + prefix + name + " counter")
+            lines.append(prefix + name + " " + repr(value))
+        for name, hist in sorted(data["histograms"].items()):
+            lines.append("# TYPE " + prefix + name + " histogram")
+            total = 0
+            for bound, count in zip(hist["buckets"] + ["+Inf"], hist["counts"]):
+                total = total + count
+                lines.append(prefix + name + '_bucket{le="' + str(bound) + '"} ' + str(total))
+            lines.append(prefix + name + "_sum " + repr(hist["sum"]))
+            lines.append(prefix + name + "_count " + str(hist["count"]))
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+Run_metrics = RunMetrics()  # одни на весь запуск (в процессах разбора свои, см. parse_family_job)
 
 
 # Основные функции
-def sist_search(filename, maxterms, output_dir):
+class QuerySyntaxError(ValueError):
+    """
+    Строка из input_terms.txt не разбирается (непарные или пустые скобки, непарные кавычки, тэг или оператор без
+    слова, несколько "|")
+    """
+
+
+class QueryTerm(Record):
+    # слова подряд без операторов между ними (Entrez так и ищет их одним термином) и тэг поля [ORGN], [TIAB]...
+    __slots__ = ("words", "field")
+
+
+class QueryGroup(Record):
+    # (...) - лист из QueryTerm, QueryGroup и операторов (строки AND/OR/NOT), как написал пользователь
+    __slots__ = ("items",)
+
+
+_query_token = re.compile(r'\s*(?:(\()|(\))|("[^"]*")|\[([^\[\]]*)\]|([^\s()"]+))')
+_query_tagged = re.compile(r'(.+?)\[([^\[\]]+)\]$')
+
+
+def _query_tokens(text):
+    """
+    Вход: строка запроса (без части после "|")
+    Выход: лист пар (вид, значение): ( ) op word tag
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _query_token.match(text, pos)
+        if match is None:
+            raise QuerySyntaxError("unbalanced quote")
+        pos = match.end()
+        opening, closing, phrase, tag, word = match.groups()
+        if opening or closing:
+            tokens.append((opening or closing, None))
+        elif tag is not None:
+            tokens.append(("tag", tag))
+        elif word in ("AND", "OR", "NOT"):
+            tokens.append(("op", word))
+        else:
+            tagged = _query_tagged.match(word or phrase)
+            if tagged is None:
+                tokens.append(("word", word or phrase))
+            else:  # sapiens[ORGN] - тэг прямо за словом
+                tokens.extend([("word", tagged.group(1)), ("tag", tagged.group(2))])
+    return tokens
+
+
+def _query_items(tokens, pos=0, depth=0):
+    """
+    Вход: токены из _query_tokens, откуда начинать и глубина скобок
+    Выход: лист узлов (QueryTerm, QueryGroup, операторы) и позиция после закрывающей скобки
+    """
+    items = []
+    term = None  # QueryTerm, к которому еще можно дописывать слова
+    while pos < len(tokens):
+        kind, value = tokens[pos]
+        pos = pos + 1
+        if kind == "(":
+            group, pos = _query_items(tokens, pos, depth + 1)
+            items.append(QueryGroup(items=group))
+            term = None
+        elif kind == ")":
+            if depth == 0:
+                raise QuerySyntaxError("unexpected )")
+            if not items:
+                raise QuerySyntaxError("empty ()")
+            return _query_checked(items), pos
+        elif kind == "op":
+            if value != "NOT" and (not items or isinstance(items[-1], str)):
+                raise QuerySyntaxError(value + " without a term before it")
+            items.append(value)
+            term = None
+        elif kind == "tag":
+            if term is None:
+                raise QuerySyntaxError("[" + value + "] without a term")
+            term.field = value
+            term = None
+        elif term is None:
+            term = QueryTerm(words=[value])
+            items.append(term)
+        else:
+            term.words.append(value)
+    if depth > 0:
+        raise QuerySyntaxError("missing )")
+    return _query_checked(items), pos
+
+
+def _query_checked(items):
+    # оператор в конце скобок (или всей строки) висит без второго слова
+    if items and isinstance(items[-1], str):
+        raise QuerySyntaxError(items[-1] + " without a term after it")
+    return items
+
+
+def _query_text(items, fields=True):
+    """
+    Выход: запрос обратно строкой (fields=False - без тэгов полей, для ArrayExpress)
+    """
+    out = []
+    for item in items:
+        if isinstance(item, str):
+            out.append(item)
+        elif isinstance(item, QueryGroup):
+            out.append("(" + _query_text(item.items, fields) + ")")
+        else:
+            out.append(" ".join(item.words) + ("[" + item.field + "]" if fields and item.field else ""))
+    return " ".join(out)
+
+
+class SearchQuery(Record):
+    """
+    Разобранная строка из input_terms.txt: "ключевые слова | Организм[ORGN]" (часть с "|" не обязательна).
+    Строка разбирается один раз (parse_query), а из дерева собираются запросы для обеих баз:
+    entrez_term() для GEO и ae_params()/ae_label() для ArrayExpress
+    """
+    __slots__ = ("raw",  # строка как есть (без пробелов по краям), ключ для SearchState
+                 "items",  # ключевые слова: лист узлов, см. _query_items
+                 "organism")  # организм после "|" (без [ORGN]) или None
+    entrez_only = ("PDAT", "MDAT", "EDAT", "DP", "ETYP", "GTYP", "FILTER")  # у ArrayExpress таких нет
+
+    def entrez_term(self):
+        keywords = _query_text(self.items)
+        term = "(" + keywords + ") AND " if keywords else ""
+        if self.organism is not None:
+            term = term + self.organism + "[ORGN] AND "
+        return term + "gse[ETYP]"  # только серии (GSE)
+
+    def _ae_parts(self):
+        # У ArrayExpress организм - отдельный параметр species, а тэгов полей нет. Если запрос - цепочка из AND,
+        # то организм тэгом [ORGN] (lung AND Homo sapiens[ORGN]) тоже уходит в species, а условия только для
+        # Entrez (даты [PDAT] и т.п.) выкидываются. В остальных случаях от тэгов остаются только слова
+        items, species = self.items, self.organism
+        if all(item == "AND" for item in items if isinstance(item, str)):
+            operands = []
+            for item in items:
+                field = (item.field or "").upper() if isinstance(item, QueryTerm) else ""
+                if field == "ORGN" and species is None:
+                    species = " ".join(item.words).strip('"')
+                elif field not in self.entrez_only and not isinstance(item, str):
+                    operands.append(item)
+            if len(operands) < len([item for item in items if not isinstance(item, str)]):
+                items = [part for item in operands for part in ("AND", item)][1:]
+        keywords = _query_text(items, fields=False)
+        return ("(" + keywords + ")" if keywords else ""), species
+
+    def ae_params(self):
+        """
+        Выход: параметры поискового адреса ArrayExpress (keywords=...&species=...)
+        """
+        keywords, species = self._ae_parts()
+        params = "keywords=" + urllib.parse.quote_plus(keywords, safe="()*")
+        if species is not None:
+            params = params + "&species=" + urllib.parse.quote_plus(species)
+        return params
+
+    def ae_label(self):
+        """
+        Выход: запрос ArrayExpress для table_term.tsv
+        """
+        return " | ".join(part for part in self._ae_parts() if part)
+
+
+@functools.lru_cache(maxsize=None)
+def parse_query(line):
+    """
+    Вход: строка из input_terms.txt
+    Выход: SearchQuery (или None для пустой строки). Разобранные строки запоминаются, так что поиск в GEO и в
+    ArrayExpress разбирает файл запросов один раз на двоих. Кривая строка - QuerySyntaxError
+    """
+    raw = line.strip()
+    if not raw:
+        return None
+    keywords, bar, organism = raw.partition("|")
+    if "|" in organism:
+        raise QuerySyntaxError("more than one | in " + raw)
+    if bar:
+        organism = " ".join(re.sub(r"\[[^\[\]]*\]\s*$", "", organism).split()) or None
+    try:
+        items = _query_items(_query_tokens(keywords))[0]
+    except QuerySyntaxError as e:
+        raise QuerySyntaxError(str(e) + " in " + raw) from None
+    if not items and (not bar or organism is None):
+        raise QuerySyntaxError("empty query " + raw)
+    return SearchQuery(raw=raw, items=items, organism=organism if bar else None)
+
+
+class SearchCache:
+    """
+    Результаты поиска (SQLite search.sqlite в --cache_dir): по каждому запросу в том виде, в каком он уходит
+    на сервер (Entrez term или параметры ArrayExpress, плюс даты --delta), - кол-во находок и сами ID.
+    Если по тому же запросу искали не раньше ttl назад (--search_ttl), сервер не спрашивается.
+    Правка строки в input_terms.txt дает другой запрос, так что устаревший результат не подхватится
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl  # секунд, 0 - результаты только записываются (пригодятся для --offline)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS searches (db TEXT, query TEXT, count INTEGER, ids TEXT, "
+                        "fetched REAL, PRIMARY KEY (db, query))")
+        self.db.commit()
+
+    def get(self, db, query):
+        """
+        Выход: (кол-во находок, лист ID) или None, если свежего результата нет
+        """
+        with self.lock:
+            row = self.db.execute("SELECT count, ids, fetched FROM searches WHERE db = ? AND query = ?",
+                                  (db, query)).fetchone()
+        if row is None or not (Offline or row[2] >= time.time() - self.ttl):
+            Run_metrics.inc("search_cache_misses_total")
+            return None
+        Run_metrics.inc("search_cache_hits_total")
+        return row[0], json.loads(row[1])
+
+    def put(self, db, query, count, ids):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?, ?)",
+                            (db, query, count, json.dumps(ids), time.time()))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SearchState:
+    """
+    Даты последнего поиска по каждому запросу (search_state.json в output директории) для режима --delta.
+    Дата запоминается в начале поиска, и в следующий раз ищется с нее включительно: лучше найти пару записей
+    повторно, чем пропустить обновленные в день прошлого запуска
+    """
+
+    def __init__(self, path, datetype):
+        self.path = path
+        self.datetype = datetype  # pdat - дата публикации, mdat - дата последнего изменения
+        self.today = time.strftime("%Y/%m/%d")  # формат дат E-utilities
+        try:
+            with open(path, 'r', encoding='utf-8') as state_file:
+                self.state = json.load(state_file)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def since(self, db, term):
+        """
+        Выход: дата прошлого поиска по запросу (YYYY/MM/DD) или None, если по нему еще не искали
+        """
+        return self.state.get(db, {}).get(term.strip())
+
+    def mark(self, db, term):
+        self.state.setdefault(db, {})[term.strip()] = self.today
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as state_file:
+            json.dump(self.state, state_file, indent=1, ensure_ascii=False)
+        os.replace(tmp_path, self.path)  # чтобы при падении не остался недописанный файл
+
+
+def save_search_result(output_dir, name, id_list, state):
+    """
+    Вход: директория, имя файла со списком (input_GSE.txt или input_ArEx.txt), найденные ID и SearchState (или None)
+    Выход: кол-во ID для анализа
+    Без --delta ID просто пишутся в файл. С --delta найденное (новое или измененное с прошлого поиска) пишется в
+    delta_<имя> и добавляется к ID из прошлых запусков в основном файле
+    """
+    id_list = list(OrderedSet(id_list))
+    path = os.path.join(output_dir, name)
+    if state is not None:
+        with open(os.path.join(output_dir, "delta_" + name), "w") as delta_file:
+            for id in id_list:
+                delta_file.write(id + '\n')
+        merged = OrderedSet()
+        if os.path.exists(path):
+            with open(path, "r") as previous:
+                merged.update(x.strip() for x in previous if x.strip())
+        merged.update(id_list)
+        id_list_all = list(merged)
+    else:
+        id_list_all = id_list
+    with open(path, "w") as id_file:
+        for id in id_list_all:
+            id_file.write(id + '\n')
+    return len(id_list)
+
+
+class GeoSearcher:
+    """
+    Параллельный поиск в GEO (db=gds) через esearch из E-utilities.
+    Запросы идут пулом потоков (у каждого своя requests.Session), частоту держит общий get_entrez_bucket().
+    Первый запрос по каждому термину делается с usehistory=y: из него берется точное кол-во находок (Count) и WebEnv,
+    а остальные страницы ID читаются из истории на сервере параллельно, по page штук за раз.
+    Наперед запрашивается не больше workers первых запросов и workers страниц, так что в памяти только они
+    """
+
+    def __init__(self, workers, page):
+        self.page = max(1, page)
+        self.workers = max(1, workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.pool = ThreadPoolExecutor(self.workers)
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+            with self.lock:
+                self.connections.append(session)
+        return session
+
+    def _esearch(self, params):
+        params = dict(params, db="gds", retmode="json", tool=tool, email=email)
+        if Api_key:
+            params["api_key"] = Api_key
+        Run_metrics.inc("esearch_requests_total")
+        with Run_metrics.timer("esearch_seconds"):
+            r = http_request("get", Eutils_base + "/esearch.fcgi", self._session(), get_entrez_bucket().acquire,
+                             params=params)
+            r.raise_for_status()
+            return r.json()["esearchresult"]
+
+    def _first(self, term, dates):
+        params = {"term": term, "usehistory": "y", "retmax": self.page}
+        params.update(dates)
+        return self._esearch(params)
+
+    def _page(self, first, retstart):
+        # "#N" - ссылка на запрос N из истории WebEnv
+        return self._esearch({"term": "#" + first["querykey"], "WebEnv": first["webenv"], "usehistory": "y",
+                              "retstart": retstart, "retmax": self.page})["idlist"]
+
+    def run(self, queries, maxterms):
+        """
+        Вход: лист пар (запрос, словарь с параметрами дат) и максимум ID на один запрос
+        Выход: генератор троек (запрос, Count, генератор страниц ID) в исходном порядке запросов
+        Страницы надо дочитать до перехода к следующему запросу, в памяти держатся только они
+        """
+        queries = iter(queries)
+        firsts = collections.deque()
+        while True:
+            # окно: следующий запрос отправляется, когда результат предыдущего забрали
+            while len(firsts) < self.workers:
+                query = next(queries, None)
+                if query is None:
+                    break
+                firsts.append((query[0], self.pool.submit(self._first, *query)))
+            if not firsts:
+                break
+            term, future = firsts.popleft()
+            first = future.result()
+            count = int(first["count"])
+            yield term, count, self._pages(first, min(count, maxterms))
+
+    def _pages(self, first, total):
+        yield first["idlist"]
+        starts = iter(range(self.page, total, self.page))
+        pages = collections.deque()
+        while True:
+            # так же окном: следующая страница запрашивается, когда прочитали самую раннюю
+            while len(pages) < self.workers:
+                start = next(starts, None)
+                if start is None:
+                    break
+                pages.append(self.pool.submit(self._page, first, start))
+            if not pages:
+                return
+            yield pages.popleft().result()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for conn in self.connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.connections = []
+
+
+def sist_search(filename, maxterms, output_dir, state=None):
     """
-    Вход: файл input_terms.txt - построчная запись запросов
+    Вход: файл input_terms.txt - построчная запись запросов (и SearchState для режима --delta)
     Выход: запись в два файла: input_GSE.txt - уникальные GSE ID для анализа,
     table_term.tsv - таблица запрос - кол-во найденных датасетов
     Внимание! К запросам добавлять GSE не нужно, это делается тут
     Функция считывает запросы из файла, добавляет пункт для поиска только датасетов, и возвращает список датасетов.
     Попутно она записывает в отдельный файл таблицу с количесвом найденных датасетов по каждому запросу
+    С SearchState по запросам, по которым уже искали, ищется только то, что вышло (pdat) или изменилось (mdat)
+    после прошлого поиска, см. save_search_result
     """
 
     def id_to_gse(id):
@@ -204,78 +911,188 @@ def sist_search(filename, maxterms, output_dir):
         term_list = input_file.readlines()  # читаем запросы в лист
     table_term = open(os.path.join(output_dir, "table_term.tsv"), "w")  # открываем файл для записи таблицы
     table_term.write("term" + '\t' + "number of found datasets (GEO)" + '\n')  # записываем шапку таблицы
-    glob_list = []  # лист куда сливаю все GSE. Причем слив происходит при работе самой утилиты, т.е. в конце она выдает
-    # общую сумму всех GSE по всем запросам. Для этого ввожу переменную i
-    i = 0  # переменная для подсчета кол-ва датасетов найденный в конкретном запросе (см коммент выше)
-
-    for term in tqdm(term_list):  # проходимся по всем запросам
-        # if True:
-        if "|" in term:  # если есть организм
-            term = "(" + term.strip() + " AND gse[ETYP]"  # добавляем фильтрацию по датасетам (только GSE)
-            term = term.replace(" |", "|")  # если перед палкой пробел, то это его удалит
-            term = term.replace("|",
-                                ") AND")  # Тут заменяем | у ORGN на AND (в других бд orgn в других разделах пишут)
-        else:  # если нет организма
-            term = "(" + term.strip() + ") AND gse[ETYP]"
-        with suppressor(True):
-            logging.disable(logging.CRITICAL)  # Выключаю @#%^*$ логи entrezpy (ЭТУ СТРОЧКУ Я ИСКАЛ 4 МЕСЯЦА!!!)
-            e = entrezpy.esearch.esearcher.Esearcher(tool, email)
-            a = e.inquire({"db": "gds", "term": term, "retmax": maxterms, "rettype": "uilist"})
-            # НЕ ЗАБЫТЬ! " (кавычка) = %22
-            id_list = a.get_result().uids  # считываю результат
-            logging.disable(logging.NOTSET)  # возвращаем логи
-        i_new = len(id_list)  # узнаем длинну текущего массива айдишников
-        table_term.write(term + '\t' + str(i_new - i) + '\n')  # записываем инфу по запросу, вычитаем предыдущие
-        i = i_new
-        glob_list = id_list
-
-    gse_list = []  # сервер выдает  результаты в виде просто id, но для ftp мне нужен формат GSE id, для этого лист
-    for unique_id in set(glob_list):  # чтобы оптимизировать работу, проходимся только по уникальным GSE ID
-        gse_id = id_to_gse(unique_id)  # переводим id в gse спец функцией
-        gse_list.append(gse_id)
-    num = 0
-    with open(os.path.join(output_dir, "input_GSE.txt"), "w") as input_gse:  # открываем файл на запись GSE ID
-        for gse in gse_list:
-            input_gse.write(gse + '\n')  # записываем GSE ID в файл
-            num = num + 1  # подсчитываем количестов уникальных gse_id
+    queries = []
+    for line in term_list:  # проходимся по всем запросам
+        query = parse_query(line)
+        if query is None:
+            continue  # пустая строка
+        dates = {}
+        if state is not None:
+            since = state.since("GEO", query.raw)
+            if since is not None:
+                dates = {"datetype": state.datetype, "mindate": since, "maxdate": state.today}
+            state.mark("GEO", query.raw)
+        # (ключевые слова) AND Организм[ORGN] AND gse[ETYP] - фильтрация по датасетам (только GSE), см. SearchQuery
+        queries.append((query.entrez_term(), dates))
+    # свежие результаты из кэша поиска (--search_ttl) берутся как есть, на сервер идут только остальные
+    keys = [term + ("" if not dates else " " + json.dumps(dates, sort_keys=True)) for term, dates in queries]
+    cached = [None if Search_cache is None else Search_cache.get("GEO", key) for key in keys]
+
+    # Запросы идут параллельно (GeoSearcher), а ID сливаются в общий OrderedSet по мере прихода страниц.
+    # Кол-во находок по запросу - Count из esearch (раньше считалось вычитанием длин, что неверно при пересечениях)
+    found = OrderedSet()
+    searcher = GeoSearcher(Search_workers, Search_page)
+    try:
+        live = searcher.run([pair for pair, hit in zip(queries, cached) if hit is None], maxterms)
+        for (term, dates), key, hit in tqdm(list(zip(queries, keys, cached))):
+            if hit is not None:
+                count, ids = hit
+                found.update(ids)
+            else:
+                term, count, pages = next(live)
+                ids = [] if Search_cache is not None else None
+                for page in pages:
+                    found.update(page)
+                    if ids is not None:
+                        ids.extend(page)
+                if ids is not None:
+                    Search_cache.put("GEO", key, count, ids)
+            table_term.write(term + '\t' + str(count) + '\n')  # записываем инфу по запросу
+    finally:
+        searcher.close()
+
+    # сервер выдает  результаты в виде просто id, но для ftp мне нужен формат GSE id
+    gse_list = [id_to_gse(unique_id) for unique_id in found]
+    num = save_search_result(output_dir, "input_GSE.txt", gse_list, state)  # записываем GSE ID в файл
 
     table_term.write("TOTAL GEO (UNIQUE)\t" + str(num) + '\n')  # добавляем строку со суммарными находками(уникальными!)
     table_term.close()  # не забываем закрыть файл с результатами!
 
 
-def gsm_analizator(gsm_list):
+class GsmCollector:
+    """
+    Собирает информацию по каналам сэмплов и оставляет только уникальные значения.
+    Общая часть для обоих парсеров (суп и iterparse), чтобы на выходе были одинаковые GsmInfo.
+    Время разбора сэмплов (тело цикла по timed()) за всю серию идет в гистограмму gsm_seconds
+    """
+
+    # имена полей для --value_cap
+    fields = ("treatment", "growth", "cell_type", "molecule", "extraction", "characteristics")
+
+    def __init__(self, samples=False, caps=None):
+        caps = Value_caps if caps is None else caps
+        cap = [caps.get(name, caps.get("*", 0)) for name in self.fields]
+        self.tr_list = CappedSet(cap[0])  # Treatment protocol
+        self.gr_list = CappedSet(cap[1])  # Growth protocol
+        self.cell_types = CappedSet(cap[2])  # тип клеток
+        self.tp_list = CappedSet(cap[3])  # тип экстрагируемой молекулы (?)
+        self.exp_list = CappedSet(cap[4])  # Extraction protocol (протокол выделения пробы)
+        self.char_list = CappedSet(cap[5])  # Characteristics (вся прочая инфа из образцов)
+        # если в канале нет протокола, то берется значение из предыдущего канала
+        self.treatment = "None"
+        self.growth = "None"
+        # для --samples: (GSM, номер канала, source, cell type, molecule, [(tag, value), ...]) без схлопывания
+        self.samples = [] if samples else None
+        self.seconds = 0.0
+
+    def timed(self, items):
+        """
+        Вход: сэмплы или каналы, по которым идет цикл парсера
+        Выход: они же, а время, пока цикл обрабатывает каждый элемент, прибавляется к self.seconds
+        """
+        for item in items:
+            start = time.perf_counter()
+            try:
+                yield item
+            finally:
+                self.seconds = self.seconds + time.perf_counter() - start
+
+    def add_sample(self, accession, channel, source, cells, mol_type, pairs):
+        """
+        Вход: значения одного канала сэмпла как есть (cells - из характеристики "cell type" или None)
+        """
+        if self.samples is not None:
+            self.samples.append((accession, channel, source, cells, mol_type, pairs))
+
+    def add_channel(self, treatment, growth, cells, mol_type, extprot, charact):
+        """
+        Вход: значения одного канала (None у treatment/growth - значит в канале их нет)
+        """
+        if treatment is not None:
+            self.treatment = treatment
+        if growth is not None:
+            self.growth = growth
+        # повторы OrderedSet отбрасывает сам, остается первое появление
+        self.tr_list.add(self.treatment)
+        self.gr_list.add(self.growth)
+        self.cell_types.add(cells)
+        self.tp_list.add(mol_type)
+        self.exp_list.add(extprot)
+        self.char_list.add(charact)
+
+    @staticmethod
+    def _listed(values):
+        text = str(list(values)).strip('[]')
+        if values.more > 0:
+            Run_metrics.inc("gsm_values_capped_total", values.more)
+            text = text + ", …and " + format(values.more, ",") + " more distinct values"
+        return text
+
+    def result(self):
+        """
+        Выход: GsmInfo, где каждое поле - строка из уникальных значений (или "None"),
+        с --value_cap в конце поля пишется, сколько значений не влезло
+        """
+        Run_metrics.observe("gsm_seconds", self.seconds)
+        out_info = GsmInfo()
+        out_info.Treatment = self._listed(self.tr_list)
+        out_info.Cell_type = self._listed(self.cell_types)
+        out_info.Growth = self._listed(self.gr_list)
+        out_info.Type_mol = self._listed(self.tp_list)
+        out_info.Extr_prot = self._listed(self.exp_list)
+        out_info.Characteristics = self._listed(self.char_list)
+        # Произвожу проверку на пустые параметры, тогда прописываю None
+        if len(out_info.Type_mol) == 0:
+            out_info.Type_mol = "None"
+        if len(out_info.Treatment) == 0:
+            out_info.Treatment = "None"
+        if len(out_info.Cell_type) == 0:
+            out_info.Cell_type = "None"
+        if len(out_info.Growth) == 0:
+            out_info.Growth = "None"
+        if len(out_info.Extr_prot) == 0:
+            out_info.Extr_prot = "None"
+        if len(out_info.Characteristics) == 0:
+            out_info.Characteristics = "None"
+        out_info.Samples = self.samples
+        return out_info
+
+
+def _soup_source(source):
+    """
+    Вход: тэг <source> из супа
+    Выход: его текст. html.parser считает <source> пустым тэгом из HTML, так что текст оказывается сразу после него
+    (а если Source пустой, то следующим идет уже другой тэг - тогда пустая строка, как у iterparse)
+    """
+    text = source.get_text().strip()
+    if text or source.next_sibling is None or source.next_sibling.name is not None:
+        return text
+    return str(source.next_sibling).strip()
+
+
+def gsm_analizator(gsm_list, sample_rows=False):
     """
-    Вход: Лист из GSM ID
+    Вход: Лист из GSM ID (и флаг: собирать ли еще и строки по каждому сэмплу, см. GsmCollector.add_sample)
     Выход: Вся нужная инфа (тип клеток, treatment protocol) записанная в специальный класс (чтоб на выход одна
     переменная)
     Функция проходится по блокам сэмплов и вытаскивает из каждой нужную инфу.
     Дополнительно фильтрует ее, на выходе получаются только уникальные знаения.
     По сути работает как основной код, но просто смотрит много однотипных страниц, и выдает только уникальные значения.
     """
-    tr_list = []  # лист для Treatment protocol
-    gr_list = []  # лист для Growth protocol
-    cell_types = []  # лист для типа клеток
-    tp_list = []  # лист для типа экстрагируемой молекулы (?)
-    exp_list = []  # лист для Extraction protocol (протокола выделения пробы)
-    char_list = []  # лист для Characteristics (вся прочая инфа из образцов)
-    # Упоминая переменные
-    growth = "None"
-    # cells = "None"
-    # mol_type = "None"
-    treatment = "None"
-    for GSM in gsm_list:
-        for chanel in GSM.find_all("channel"):
+    collector = GsmCollector(sample_rows)
+    for GSM in collector.timed(gsm_list):
+        for position, chanel in enumerate(GSM.find_all("channel"), 1):
             try:
                 treatment = chanel.find_all("treatment-protocol")[0].get_text().strip()
             except Exception:
-                pass
+                treatment = None
             # Тут вначале обращаюсь к блоку Chanle (видимо бывают разные каналы для одного образца, нужно это учесть)
             try:
                 growth = chanel.find_all("growth-protocol")[
                     0].get_text().strip()  # если нет нормального Treatment протокола,
                 # то обычно инфа записанна здесь. А если уж тут нет, то скорее всего вообще другой тип эксперимента.
             except Exception:
-                pass
+                growth = None
             try:
                 cells = chanel.find_all("characteristics", attrs={"tag": "cell type"})[0].get_text().strip()
             except Exception:
@@ -283,7 +1100,7 @@ def gsm_analizator(gsm_list):
                 pass
             # а потом через characteristics с тэгом "cell type" нахожу нужное значение.
             if cells == -1:
-                cells = "Source: " + chanel.find_all("source")[0].get_text().strip()
+                cells = "Source: " + _soup_source(chanel.find_all("source")[0])
                 # иногда тупо нет графы Cell type, но эксперимент на клетках.
                 # Тогда обычно они записывают инфу тут, но помечаю что это из Source
             mol_type = chanel.find_all("molecule")[
@@ -299,386 +1116,1743 @@ def gsm_analizator(gsm_list):
             except Exception:
                 charact = ""
                 pass
-            # далее в листы добавляются только уникальные значения
-            if treatment not in tr_list:
-                tr_list.append(treatment)
-            if growth not in gr_list:
-                gr_list.append(growth)
-            if cells not in cell_types:
-                cell_types.append(cells)
-            if mol_type not in tp_list:
-                tp_list.append(mol_type)
-            if extprot not in exp_list:
-                exp_list.append(extprot)
-            if charact not in char_list:
-                char_list.append(charact)
-    out_info = GsmInfo()
-    out_info.Treatment = str(tr_list).strip('[]')
-    out_info.Cell_type = str(cell_types).strip('[]')
-    out_info.Growth = str(gr_list).strip('[]')
-    out_info.Type_mol = str(tp_list).strip('[]')
-    out_info.Extr_prot = str(exp_list).strip('[]')
-    out_info.Characteristics = str(char_list).strip('[]')
-    # Произвожу проверку на пустые параметры, тогда прописываю None
-    if len(out_info.Type_mol) == 0:
-        out_info.Type_mol = "None"
-    if len(out_info.Treatment) == 0:
-        out_info.Treatment = "None"
-    if len(out_info.Cell_type) == 0:
-        out_info.Cell_type = "None"
-    if len(out_info.Growth) == 0:
-        out_info.Growth = "None"
-    if len(out_info.Extr_prot) == 0:
-        out_info.Extr_prot = "None"
-    if len(out_info.Characteristics) == 0:
-        out_info.Characteristics = "None"
-    return out_info
-
-
-def geo_xml_parser(name):
+            collector.add_channel(treatment, growth, cells, mol_type, extprot, charact)
+            if sample_rows:
+                source = chanel.find("source")
+                if source is not None:
+                    source = _soup_source(source)
+                cell_type = chanel.find("characteristics", attrs={"tag": "cell type"})
+                collector.add_sample(GSM.get("iid"), position, source,
+                                     None if cell_type is None else cell_type.get_text().strip(), mol_type,
+                                     [(char.get("tag") or "", char.get_text().strip())
+                                      for char in chanel.find_all("characteristics")])
+    return collector.result()
+
+
+def build_gse_info(platforms, fields, gsm_info, samples):
+    """
+    Вход: лист пар (accession, organism) по платформам, словарь с полями серии, GsmInfo и кол-во сэмплов
+    Выход: переменная мегакласса GseInfo
+    Общая сборка результата для обоих парсеров
+    """
+    series = SeriesInfo()
+    # с платформой сложности, так что склеиваем все платформы через "; "
+    series.platform = "; ".join([acc for acc, org in platforms])
+    # организмы без повторов, в порядке появления в файле (чтоб выдача не менялась от запуска к запуску)
+    series.organism = "; ".join(OrderedSet(org for acc, org in platforms))
+    # Далее выцепляем инфу по каждому интересуещему параметру в отдельную переменную
+    series.GSE = fields["GSE"]
+    series.samples = samples
+    Run_metrics.inc("gsm_samples_total", samples)
+    series.Type = "; ".join(fields["types"]).strip("; ")  # стрип нужен чтоб красиво выводилось
+    series.title = fields["title"]
+    series.sub_date = fields["sub_date"]
+    series.Summary = ' '.join(fields["summary"].split())
+    series.Overall_design = ' '.join(fields["overall_design"].split())  # удалю перенос строки внутри текста
+    for link_type, target in fields["relations"]:
+        if link_type == "BioProject":
+            # BioProject link
+            series.BioProject = target
+        elif link_type == "SRA":
+            # SRA link
+            series.SRA = target
+    if series.BioProject is not None and "bioproject/" in series.BioProject:
+        bioProj = series.BioProject.split("bioproject/")[1]
+        series.BioProj_EBI = "https://www.ebi.ac.uk/ena/browser/view/" + bioProj
+        series.BioProject = "https://www.ncbi.nlm.nih.gov/bioproject/" + bioProj
+
+    # ! Блок PUBMED
+    pubmed = PubMedInfo()
+    pubmed.pbid = fields["pubmed_ids"]
+
+    all_info = GseInfo()
+    all_info.gsm_info = gsm_info
+    all_info.PubMed_info = pubmed
+    all_info.series_info = series
+
+    all_info.gsm_info.All_protocols = "[Overal design]" + str(
+        all_info.series_info.Overall_design) + "; [Treatment]" + str(
+        all_info.gsm_info.Treatment) + "; " + "[Growth]" + str(all_info.gsm_info.Growth) + "; [Extraction]" + str(
+        all_info.gsm_info.Extr_prot) + "; [Cell type]" + str(all_info.gsm_info.Cell_type) + str(
+        all_info.gsm_info.Characteristics)
+    return all_info
+
+
+def geo_xml_parser(name, sample_rows=False):
     """
     Программа производит непосредственный анализ XML файла полученного с GEO.
     ТРУБУЮТСЯ ФУНКЦИИ: pub_med_by_id, GSM_analizator
-    Вход: имя файла .xml
+    Вход: имя файла .xml (или открытый бинарный поток) и флаг сбора строк по сэмплам (для --samples)
     Выход: три переменные, каждая своего класса, записанные в переменую мегакласса:
     Series -  инфа по датасэту
     pubmed - инфа из PubMed
     GSM_info - инфа по сэмплам
     """
-    with open(name, 'r', encoding='utf-8') as XML_file:
-        xml = XML_file.read()
-        soup = BeautifulSoup(xml, features="html.parser")
-        # Варим суп из файла.
-        # МНОГОБУКАФ: Изначально пытался юзать пакет lxml, причем его можно и как паресер для супа использовать.
-        # Но с ним были проблемы, тупо не запускался. Так что юзаю стандартный парсер. ОДНАКО, в супе
-        # я немного разочеровался: дело в том, что все парсеры раскладывают файл на дерево. И скажем нам нужен
-        # конкретный лист из этого дерева,и у него есть уникальный тэг. Хотелось бы тупо по этому тэгу его и выцепить.
-        # Но нет, в супе нужно пропсывать полный путь по тэгам :( А уверенности что путь один для всех файлов нет :'(
-        # Кароч надеюсь все норм будет. Но если что надо менять пакет для парсенья.
-        block1 = soup.find_all('series')[0]
-        # Блок1 : тут инфа по датасету, то что можно в саммари найти
-        block2 = soup.find_all('platform')
-        # тут инфа по платформе, например ее ID
-        samples_block = soup.find_all('sample')
-        # а тут получаем лист из блоков по каждому образцу. Его потом анализируем функцией GSM_analizator
-
-        # ! Блок серии (датасета)
-        if True:
-            series = SeriesInfo()
-            # с платформой сложности, так что проходимся циклом
-            i = 0
-            for blochechek in block2:
-                if i == 0:
-                    platf = blochechek.find_all('accession')[0].get_text().strip()
-                else:
-                    platf = platf + "; " + blochechek.find_all('accession')[0].get_text().strip()
-                i = i + 1
-            org_list = []
-            for blochechek in block2:
-                organ = blochechek.find_all('organism')[0].get_text().strip()
-                org_list.append(organ)
-            first = True
-            for new_org in set(org_list):
-                if first:
-                    organ = new_org
-                    first = False
-                else:
-                    organ = organ + "; " + new_org
-            # platform
-            series.platform = platf
-            # organism
-            series.organism = organ
-            # Далее выцепляем инфу по каждому интересуещему параметру в отдельную переменную
-            # GSE ID
-            series.GSE = block1.find_all('accession')[0].get_text().strip()
-            # samples
-            series.samples = len(samples_block)
-            # Type
-            types = block1.find_all('type')
-            str_type = ""
-            for one_type in types:
-                str_type = str_type + one_type.get_text().strip() + "; "
-            series.Type = str_type.strip("; ")  # стрип нужен чтоб красиво выводилось
-            # title
-            series.title = block1.find_all('title')[0].get_text().strip()
-            # sub_date
-            series.sub_date = block1.find_all('submission-date')[0].get_text().strip()
-            # Summary
-            series.Summary = block1.find_all('summary')[0].get_text().strip()
-            series.Summary = ' '.join(series.Summary.split())
-            # Overall_design
-            series.Overall_design = block1.find_all('overall-design')[0].get_text().strip()
-            series.Overall_design = ' '.join(series.Overall_design.split())  # удалю перенос строки внутри текста
-
-            for links in block1.find_all('relation'):
-                if links.get('type') == "BioProject":
-                    # BioProject link
-                    series.BioProject = links.get('target')
-                elif links.get('type') == "SRA":
-                    # SRA link
-                    series.SRA = links.get('target')
-            if series.BioProject != "None" or series.BioProject is not None:  # убедиться, что при отсутсвии get() возвращает None
-                bioProj = series.BioProject.split("bioproject/")[1]
-                series.BioProj_EBI = "https://www.ebi.ac.uk/ena/browser/view/" + bioProj
-                series.BioProject = "https://www.ncbi.nlm.nih.gov/bioproject/" + bioProj
-        # ! Блок PUBMED
-        if True:
-            pubmed = PubMedInfo()
-            pub_med_id = block1.find_all('pubmed-id')  # получаю лист со ВСЕМИ сатьями
-            # doi
-            if type(pub_med_id) != "NoneType":
-                lt = []
-                for poob in pub_med_id:
-                    lt.append(poob.get_text())
-                pubmed.pbid = lt
+    if hasattr(name, "read"):  # уже открытый поток (например, прямо из архива)
+        xml = name.read().decode('utf-8')
+    else:
+        with open(name, 'r', encoding='utf-8') as XML_file:
+            xml = XML_file.read()
+    soup = BeautifulSoup(xml, features="html.parser")
+    # Варим суп из файла.
+    # МНОГОБУКАФ: Изначально пытался юзать пакет lxml, причем его можно и как паресер для супа использовать.
+    # Но с ним были проблемы, тупо не запускался. Так что юзаю стандартный парсер. ОДНАКО, в супе
+    # я немного разочеровался: дело в том, что все парсеры раскладывают файл на дерево. И скажем нам нужен
+    # конкретный лист из этого дерева,и у него есть уникальный тэг. Хотелось бы тупо по этому тэгу его и выцепить.
+    # Но нет, в супе нужно пропсывать полный путь по тэгам :( А уверенности что путь один для всех файлов нет :'(
+    # Кароч надеюсь все норм будет. Но если что надо менять пакет для парсенья (см. geo_xml_iterparser).
+    block1 = soup.find_all('series')[0]
+    # Блок1 : тут инфа по датасету, то что можно в саммари найти
+    block2 = soup.find_all('platform')
+    # тут инфа по платформе, например ее ID
+    samples_block = soup.find_all('sample')
+    # а тут получаем лист из блоков по каждому образцу. Его потом анализируем функцией GSM_analizator
+
+    platforms = []
+    for blochechek in block2:
+        platforms.append((blochechek.find_all('accession')[0].get_text().strip(),
+                          blochechek.find_all('organism')[0].get_text().strip()))
+    fields = {
+        "GSE": block1.find_all('accession')[0].get_text().strip(),
+        "types": [one_type.get_text().strip() for one_type in block1.find_all('type')],
+        "title": block1.find_all('title')[0].get_text().strip(),
+        "sub_date": block1.find_all('submission-date')[0].get_text().strip(),
+        "summary": block1.find_all('summary')[0].get_text().strip(),
+        "overall_design": block1.find_all('overall-design')[0].get_text().strip(),
+        "relations": [(links.get('type'), links.get('target')) for links in block1.find_all('relation')],
+        "pubmed_ids": [poob.get_text() for poob in block1.find_all('pubmed-id')],  # ВСЕ статьи
+    }
+    # ! Блок сэмплов
+    # Анализируем все сэмплы и получаем с них инфу в виде листов. Всю выдачу функции записываем в GSM_info
+    gsm_info = gsm_analizator(samples_block, sample_rows)
+    return build_gse_info(platforms, fields, gsm_info, len(samples_block))
+
+
+def _local(tag):
+    """
+    Вход: тэг из ElementTree вида {namespace}Name
+    Выход: Name (MINiML лежит в своем namespace, а он нам не нужен)
+    """
+    if not isinstance(tag, str):  # комментарии в lxml
+        return ""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _all_elements(elem, name):
+    return [el for el in elem.iter() if _local(el.tag) == name]
+
+
+def _text(elem):
+    return "".join(elem.itertext()).strip()
+
+
+def _first_text(elem, name):
+    """
+    Как find_all(name)[0].get_text().strip() в супе: IndexError если такого элемента нет
+    """
+    for el in elem.iter():
+        if _local(el.tag) == name:
+            return _text(el)
+    raise IndexError(name)
+
+
+def _channel_values(chanel):
+    """
+    Вход: элемент <Channel> из iterparse
+    Выход: значения канала в том же виде, что и в gsm_analizator
+    """
+    treatment = growth = cells = source = mol_type = extprot = None
+    charact = ""
+    charact_ok = True
+    for el in chanel:
+        name = _local(el.tag)
+        if name == "Treatment-Protocol" and treatment is None:
+            treatment = _text(el)
+        elif name == "Growth-Protocol" and growth is None:
+            growth = _text(el)
+        elif name == "Source" and source is None:
+            source = _text(el)
+        elif name == "Molecule" and mol_type is None:
+            mol_type = _text(el)
+        elif name == "Extract-Protocol" and extprot is None:
+            extprot = _text(el)
+        elif name == "Characteristics":
+            tag = el.get("tag")
+            if tag is None:
+                charact_ok = False  # в супе тут падала склейка строки, и Characteristics обнулялись
             else:
-                pubmed.pbid = "None"
-            # pubmed.journal = "None"
-
-        # ! Блок сэмплов
-        # Анализируем все сэмплы и получаем с них инфу в виде листов. Всю выдачу функции записываем в GSM_info
-        gsm_info = gsm_analizator(samples_block)
-
-        # Удаляем GSM_info после записи его компонентов в переменные (мне удобнее работать с ними)
-        all_info = GseInfo()
-        all_info.gsm_info = gsm_info
-        all_info.PubMed_info = pubmed
-        all_info.series_info = series
-
-        all_info.gsm_info.All_protocols = "[Overal design]" + str(
-            all_info.series_info.Overall_design) + "; [Treatment]" + str(
-            all_info.gsm_info.Treatment) + "; " + "[Growth]" + str(all_info.gsm_info.Growth) + "; [Extraction]" + str(
-            all_info.gsm_info.Extr_prot) + "; [Cell type]" + str(all_info.gsm_info.Cell_type) + str(
-            all_info.gsm_info.Characteristics)
-    return all_info
+                charact = charact + tag + ': ' + _text(el) + '; '
+                if cells is None and tag == "cell type":
+                    cells = _text(el)
+    if cells is None:
+        if source is None:
+            raise IndexError("source")
+        cells = "Source: " + source
+    if mol_type is None:
+        raise IndexError("molecule")
+    if extprot is None:
+        raise IndexError("extract-protocol")
+    return treatment, growth, cells, mol_type, extprot, charact if charact_ok else ""
 
 
-def pubmed_parser(gse_info_list, pubmed_id_list, ERRORS):
-    """"
-    Вход: лист из переменных формата GSE_id, но в которых пока нет инфы из pubmed (а только pbid) + файл с ошибками
-    Выход: Инфа с pubmed + импакт фактор
-    # import metapub - пытался юзать этот пакет, но он битый и не ставится
+def _sample_values(chanel):
     """
-    pubmed_id_list = [int(i) for i in pubmed_id_list if i != "None"]  # удаляем None значения
+    Вход: элемент <Channel> из iterparse
+    Выход: source, cell type, molecule и лист пар (tag, value) канала как есть - для GsmCollector.add_sample
+    """
+    source = cells = mol_type = None
+    pairs = []
+    for el in chanel:
+        name = _local(el.tag)
+        if name == "Source" and source is None:
+            source = _text(el)
+        elif name == "Molecule" and mol_type is None:
+            mol_type = _text(el)
+        elif name == "Characteristics":
+            pairs.append((el.get("tag") or "", _text(el)))
+            if cells is None and el.get("tag") == "cell type":
+                cells = _text(el)
+    return source, cells, mol_type, pairs
+
+
+def geo_xml_iterparser(name, sample_rows=False):
+    """
+    Вход: имя файла .xml (или открытый бинарный файл) и флаг сбора строк по сэмплам (для --samples)
+    Выход: переменная мегакласса, такая же как у geo_xml_parser
+    Потоковый парсер: идет по файлу один раз через iterparse, каждый блок верхнего уровня (Platform, Sample,
+    Series) разбирается сразу как только закрылся, после чего удаляется из памяти. Так даже файлы на сотни
+    мегабайт не надо целиком держать в памяти
+    """
+    platforms = []
+    fields = None
+    collector = GsmCollector(sample_rows)
+    samples = 0
+    depth = 0
+    root = None
+    for event, elem in etree.iterparse(name, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth = depth + 1
+            continue
+        depth = depth - 1
+        if depth != 1:
+            continue
+        block = _local(elem.tag)
+        if block == "Platform":
+            platforms.append((_first_text(elem, 'Accession'), _first_text(elem, 'Organism')))
+        elif block == "Sample":
+            samples = samples + 1
+            position = 0
+            for chanel in collector.timed(elem):
+                if _local(chanel.tag) == "Channel":
+                    collector.add_channel(*_channel_values(chanel))
+                    if collector.samples is not None:
+                        position = position + 1
+                        collector.add_sample(elem.get("iid"), position, *_sample_values(chanel))
+        elif block == "Series" and fields is None:
+            fields = {
+                "GSE": _first_text(elem, 'Accession'),
+                "types": [_text(el) for el in _all_elements(elem, 'Type')],
+                "title": _first_text(elem, 'Title'),
+                "sub_date": _first_text(elem, 'Submission-Date'),
+                "summary": _first_text(elem, 'Summary'),
+                "overall_design": _first_text(elem, 'Overall-Design'),
+                "relations": [(el.get('type'), el.get('target')) for el in _all_elements(elem, 'Relation')],
+                "pubmed_ids": [''.join(el.itertext()) for el in _all_elements(elem, 'Pubmed-ID')],
+            }
+        # блок разобран - выкидываем его (и все предыдущие) из дерева
+        elem.clear()
+        root.clear()
+    if fields is None:
+        raise IndexError("series")
+    return build_gse_info(platforms, fields, collector.result(), samples)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов: не больше rate запросов в секунду (общий на все потоки)
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        for _ in range(n):
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                    self.stamp = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+
+
+class CircuitOpen(Exception):
+    """
+    Сервер недавно много раз подряд не отвечал, и запрос к нему даже не отправлялся (см. CircuitBreaker)
+    """
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного сервера. После Breaker_failures ошибок подряд он "размыкается": запросы сразу падают
+    с CircuitOpen, а не висят на таймаутах. Через Breaker_cooldown секунд пропускается один пробный запрос:
+    если он прошел - все работает как обычно, если нет - ждем еще столько же
+    """
+
+    def __init__(self, host, failures, cooldown):
+        self.host = host
+        self.threshold = max(1, failures)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None  # когда разомкнулся (None - замкнут, все работает)
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.probing or time.monotonic() - self.opened < self.cooldown:
+                raise CircuitOpen(self.host)
+            self.probing = True  # этот поток делает пробный запрос, остальные пока ждут результата
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures = self.failures + 1
+            if self.probing or (self.opened is None and self.failures >= self.threshold):
+                if self.opened is None:
+                    Run_metrics.inc("circuit_opened_total")
+                self.opened = time.monotonic()
+            self.probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host, Breaker_failures, Breaker_cooldown)
+            _breakers[host] = breaker
+        return breaker
+
+
+def network_errors():
+    """
+    Выход: кортеж исключений, которые значат, что подвела сеть (а не данные)
+    requests.RequestException - это OSError, а вот ошибки urllib3 при чтении потока - нет
+    """
+    return ftplib.all_errors + (importlib.import_module("urllib3.exceptions").HTTPError,)
+
+
+def retry_after(error):
+    """
+    Вход: исключение
+    Выход: сколько секунд просит подождать сервер (заголовок Retry-After у 429/503) или None
+    """
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value is None:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    date = http_mtime(value)  # бывает и в виде даты
+    return max(0.0, date - time.time()) if date is not None else None
+
+
+def transient_errors():
+    """
+    Выход: кортеж исключений, после которых запрос стоит повторить: обрыв или отказ соединения, таймаут, DNS,
+    временная ошибка FTP (4xx). Неверный URL (InvalidURL, MissingSchema, InvalidSchema), ошибки локальных файлов
+    (PermissionError, FileNotFoundError и т.п.) и FTP 5xx сюда не входят - повтор их не исправит
+    """
+    exceptions = importlib.import_module("urllib3.exceptions")
+    return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError, exceptions.ProtocolError, exceptions.TimeoutError,
+            exceptions.NewConnectionError, ftplib.error_temp, EOFError, ConnectionError, TimeoutError,
+            socket.gaierror)
+
+
+def is_transient(error):
+    """
+    Вход: исключение
+    Выход: True, если запрос стоит повторить (обрыв, таймаут, 429, 5xx), а не ошибка в самом запросе (404, 550,
+    неверный URL) или на диске
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        return response.status_code in Retry_statuses
+    return isinstance(error, transient_errors())
+
+
+def note_failure(errors, stage, accession, error):
+    """
+    Вход: файл ошибок, стадия (для сообщения), ID и исключение
+    Пишет ошибку в файл. В Error_List (его повторяет --retry_failed) ID попадает только при сбое сети или
+    разомкнутом предохранителе - 404, битый архив и т.п. при повторе не исправятся
+    """
+    if is_transient(error) or isinstance(error, CircuitOpen):
+        errors.write("error was (" + stage + ") " + str(accession) + "\n")
+        Error_List.append(accession)
+    else:
+        reason = " ".join((type(error).__name__ + ": " + str(error)).split())
+        errors.write("error was (" + stage + ", not retried: " + reason + ") " + str(accession) + "\n")
+
+
+def backoff_delay(attempt, wait=None):
+    """
+    Вход: номер повтора (с 0) и пауза, которую попросил сервер (Retry-After)
+    Выход: пауза в секундах: Retry-After, если он есть, иначе случайная от 0 до Net_backoff * 2^attempt
+    (случайная, чтобы потоки, которые упали одновременно, не повторяли тоже одновременно)
+    """
+    if wait is not None:
+        return wait
+    return random.uniform(0, min(Net_backoff_max, Net_backoff * 2 ** attempt))
+
+
+def net_call(host, func, retries=None):
+    """
+    Вход: имя сервера, функция без аргументов, которая делает запрос, и сколько раз повторять (по умолчанию
+    Net_retries)
+    Выход: результат func
+    Все походы в сеть идут через эту функцию: временные ошибки повторяются с паузами (backoff_delay),
+    а ошибки подряд считаются предохранителем сервера (get_breaker). Если он разомкнут - сразу CircuitOpen
+    """
+    breaker = get_breaker(host)
+    retries = Net_retries if retries is None else retries
+    attempt = 0
+    while True:
+        breaker.check()
+        try:
+            result = func()
+        except Exception as e:
+            if not is_transient(e):
+                breaker.success()  # сервер ответил, просто не то (404, битый файл и т.п.)
+                raise
+            breaker.failure()
+            Run_metrics.inc("net_errors_total")
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt, retry_after(e))
+            Run_metrics.inc("net_retries_total")
+            Run_metrics.observe("net_backoff_seconds", delay)
+            if VerboseG:
+                tqdm.write("Retry " + str(attempt + 1) + " in " + "%.1f" % delay + "s: " + host + " (" + repr(e) + ")",
+                           file=sys.stderr)
+            time.sleep(delay)
+            attempt = attempt + 1
+            continue
+        breaker.success()
+        return result
+
+
+def http_request(method, url, session=None, throttle=None, **kwargs):
+    """
+    Вход: "get" или "post", адрес, (не обязательно) requests.Session, ограничитель частоты (например,
+    get_entrez_bucket().acquire - вызывается перед каждой попыткой) и аргументы requests
+    Выход: requests.Response. 429 и 5xx повторяются (с учетом Retry-After), остальные коды отдаются как есть
+    """
+    http = requests if session is None else session
+    kwargs.setdefault("timeout", Net_timeout)
+
+    def attempt():
+        if throttle is not None:
+            throttle()
+        r = getattr(http, method)(url, **kwargs)
+        if r.status_code in Retry_statuses:
+            r.close()
+            r.raise_for_status()
+        return r
+
+    return net_call(urllib.parse.urlsplit(url).netloc, attempt)
+
+
+_entrez_bucket = None
+
+
+def get_entrez_bucket():
+    """
+    Выход: общий на всю программу ограничитель запросов к E-utilities
+    NCBI разрешает 3 запроса в секунду, а с API ключом - 10
+    """
+    global _entrez_bucket
+    if _entrez_bucket is None:
+        _entrez_bucket = TokenBucket(10 if Api_key else 3)
+    return _entrez_bucket
+
+
+class PubMedCache:
+    """
+    Локальная база (SQLite) с ответами PubMed: summary по PMID (журнал, source, название, articleids)
+    и найденные PMID по названию статьи (для ArrayExpress, там статьи указаны только названиями).
+    Одни и те же статьи встречаются в разных сериях и в каждом новом запуске, так что NCBI спрашивается только
+    про новые. Записи старше max_age (если задан) считаются устаревшими и скачиваются заново
+    """
+
+    fields = ('fulljournalname', 'source', 'title', 'articleids')
+
+    def __init__(self, path, max_age=None):
+        self.max_age = max_age  # секунд, None - без ограничения
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS summaries (pmid INTEGER PRIMARY KEY, data TEXT, fetched REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY, pmid TEXT, fetched REAL)")
+        self.db.commit()
+
+    def _oldest(self):
+        return time.time() - self.max_age if self.max_age else 0
+
+    def get_summaries(self, pubmed_id_list):
+        """
+        Вход: лист PMID (int)
+        Выход: словарь PMID -> summary для тех, что есть в базе, и лист PMID, которых нет
+        """
+        found = {}
+        with self.lock:
+            for part in chunks(pubmed_id_list, 500):
+                rows = self.db.execute("SELECT pmid, data FROM summaries WHERE fetched >= ? AND pmid IN (%s)" %
+                                       ",".join("?" * len(part)), [self._oldest()] + list(part)).fetchall()
+                for pmid, data in rows:
+                    found[pmid] = json.loads(data)
+            missing = [pmid for pmid in pubmed_id_list if pmid not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_summaries(self, res):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)",
+                                [(int(pmid), json.dumps({k: summary.get(k) for k in self.fields}), now)
+                                 for pmid, summary in res.items()])
+            self.db.commit()
+
+    def get_titles(self, title_list):
+        """
+        Вход: лист названий статей
+        Выход: словарь название -> PMID (None, если в прошлый раз статья не нашлась) и лист названий, которых нет
+        """
+        found = {}
+        with self.lock:
+            for title in title_list:
+                row = self.db.execute("SELECT pmid FROM titles WHERE title = ? AND fetched >= ?",
+                                      (title, self._oldest())).fetchone()
+                if row is not None:
+                    found[title] = row[0]
+            missing = [title for title in title_list if title not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put_titles(self, title_to_pmid):
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?, ?)",
+                                [(title, pmid, now) for title, pmid in title_to_pmid.items()])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class PubMedClient:
+    """
+    Клиент esummary для PubMed, один на весь запуск.
+    PMID отправляются большими пачками (до Pubmed_batch за один POST запрос, больше 500 esummary в json не отдает),
+    каждый запрос проходит через общий ограничитель частоты. Если есть Pubmed_cache, то сначала смотрим в него.
+    Запросы идут напрямую в E-utilities через net_call (раньше через entrezpy: у него свои повторы без Retry-After
+    и sys.exit на ответ 400)
+    """
+
+    def __init__(self, batch):
+        self.batch = max(1, min(batch, 500))
+
+    @staticmethod
+    def _esummary(part):
+        data = {"db": "pubmed", "id": ",".join(str(i) for i in part), "retmode": "json", "tool": tool, "email": email}
+        if Api_key:
+            data["api_key"] = Api_key
+        r = http_request("post", Eutils_base + "/esummary.fcgi", throttle=get_entrez_bucket().acquire, data=data)
+        r.raise_for_status()
+        result = r.json().get("result", {})
+        return {int(uid): result[uid] for uid in result.get("uids", []) if uid in result}
+
+    def summaries(self, pubmed_id_list):
+        """
+        Вход: лист из PMID (int)
+        Выход: словарь PMID -> summary (journal, source, title, articleids ...)
+        """
+        uniq = list(OrderedSet(pubmed_id_list))
+        res = {}
+        if Pubmed_cache is not None:
+            res, uniq = Pubmed_cache.get_summaries(uniq)
+        if Offline:
+            return res
+        for part in chunks(uniq, self.batch):
+            Run_metrics.inc("esummary_pmids_total", len(part))
+            try:
+                with Run_metrics.timer("esummary_seconds"):
+                    fresh = self._esummary(part)
+            except Exception as e:
+                # как и раньше, без summary запись все равно пишется (в errors будет "no pubmed summary")
+                Run_metrics.inc("esummary_failures_total")
+                tqdm.write("esummary failed for " + str(len(part)) + " PMIDs: " + repr(e), file=sys.stderr)
+                continue
+            if Pubmed_cache is not None:
+                Pubmed_cache.put_summaries(fresh)
+            res.update(fresh)
+        return res
+
+
+_pubmed_client = None
+
+
+def get_pubmed_client():
+    global _pubmed_client
+    if _pubmed_client is None:
+        _pubmed_client = PubMedClient(Pubmed_batch)
+    return _pubmed_client
+
+
+def normalize_journal(name):
+    """
+    Вход: название журнала (полное или сокращенное ISO, как в source у PubMed)
+    Выход: нормализованная строка для поиска: нижний регистр, без пунктуации, & -> and, без "the" в начале
+    "The Journal of Physiology" и "J. Physiol." превращаются в "journal of physiology" и "j physiol"
+    """
+    name = name.lower().replace("&", " and ")
+    words = re.sub(r"[^\w\s]", " ", name).split()
+    if len(words) > 1 and words[0] == "the":
+        words = words[1:]
+    return " ".join(words)
+
+
+class ImpactIndex:
+    """
+    Индекс импакт-факторов, строится один раз из dict_if_final.csv.
+    Ключи нормализуются (normalize_journal), так что поиск - это одно обращение к словарю, а все результаты
+    запоминаются. Если включен нечеткий поиск, то для ненайденных журналов ищется ближайший по триграммам.
+    Журналы, которые так и не нашлись, считаются в unresolved (потом пишутся в unresolved_journals.tsv)
+    """
+
+    def __init__(self, table, fuzzy=False, threshold=0.85):
+        self.index = {}
+        for name, value in table.items():
+            self.index.setdefault(normalize_journal(name), value)
+        for name, value in table.items():
+            self.index[name] = value  # точное совпадение с ключом таблицы важнее нормализованного
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.grams = None
+        self.memo = {}
+        self.unresolved = collections.Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _trigrams(key):
+        key = " " + key + " "
+        return {key[i:i + 3] for i in range(len(key) - 2)}
+
+    def _build_grams(self):
+        # триграмма -> лист ключей, где она есть. Строится только при первом нечетком поиске
+        self.grams = collections.defaultdict(list)
+        self.gram_count = {}
+        for key in self.index:
+            grams = self._trigrams(key)
+            self.gram_count[key] = len(grams)
+            for gram in grams:
+                self.grams[gram].append(key)
+
+    def _closest(self, key):
+        if self.grams is None:
+            self._build_grams()
+        grams = self._trigrams(key)
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        best, best_score = None, 0.0
+        for cand, n in shared.items():
+            score = 2.0 * n / (len(grams) + self.gram_count[cand])  # коэффициент Дайса
+            if score > best_score:
+                best, best_score = cand, score
+        if best_score >= self.threshold:
+            return self.index[best]
+        return None
+
+    def _find(self, full, source):
+        for name in (full, source):
+            if name:
+                value = self.index.get(name.lower())
+                if value is None:
+                    value = self.index.get(normalize_journal(name))
+                if value is not None:
+                    return value
+        if self.fuzzy:
+            for name in (full, source):
+                if name:
+                    value = self._closest(normalize_journal(name))
+                    if value is not None:
+                        return value
+        return None
+
+    @Run_metrics.timed("impact_lookup_seconds")
+    def resolve(self, full, source=None):
+        """
+        Вход: полное название журнала и (если есть) сокращенное
+        Выход: импакт-фактор строкой; "None" если журнал известен, но IF нет; None если журнал не нашелся
+        """
+        memo_key = (full, source)
+        if memo_key not in self.memo:
+            value = self._find(full, source)
+            if value == "None" or value == "Not Available":
+                value = "None"
+            self.memo[memo_key] = value
+        value = self.memo[memo_key]
+        if value is None:
+            Run_metrics.inc("impact_unresolved_total")
+            with self.lock:
+                self.unresolved[full or source] += 1
+        return value
+
+    def write_report(self, path):
+        """
+        Записывает журналы, для которых не нашелся импакт-фактор: название и сколько раз встретился
+        """
+        with open(path, 'w', encoding='utf-8') as report:
+            report.write("journal\tcount\n")
+            for journal, count in self.unresolved.most_common():
+                report.write(str(journal) + "\t" + str(count) + "\n")
+
+
+_impact_index = None
+
+
+def get_impact_index():
+    global _impact_index
+    if _impact_index is None:
+        _impact_index = ImpactIndex(get_dict_if(), Fuzzy_if)
+    return _impact_index
+
+
+def pubmed_parser(gse_info_list, pubmed_id_list, ERRORS, res=None):
+    """"
+    Вход: лист из переменных формата GSE_id, но в которых пока нет инфы из pubmed (а только pbid) + файл с ошибками
+    (+ уже скачанные summary, если их собрали заранее для нескольких пакетов сразу)
+    Выход: Инфа с pubmed + импакт фактор
+    # import metapub - пытался юзать этот пакет, но он битый и не ставится
+    """
+    pubmed_id_list = [int(i) for i in pubmed_id_list if i != "None"]  # удаляем None значения
     if VerboseG:
         print("Getting info from pubmed: " + str(pubmed_id_list))
     exit_list = []
-    if len(pubmed_id_list) > 0:  # это защита от пустого листа, если все ID выдали ошибку
-        with suppressor(True):
-            logging.disable(logging.CRITICAL)  # отключаем логи. ЭТУ СТРОЧКУ Я ИСКАЛ 4 МЕСЯЦА!!
-            e = entrezpy.esummary.esummarizer.Esummarizer(tool, email)
-            analyzer = e.inquire({'db': 'pubmed', 'id': pubmed_id_list})
-            res = analyzer.get_result().summaries
-            logging.disable(logging.NOTSET)  # возвращаем логи
-        jurs = list(dict_if.keys())
-        new_jurs = []
-
-        for pubmed in gse_info_list:
-            pubmed_ret = pubmed
-            if pubmed.PubMed_info.pbid is None:  # если нет статьи
-                pubmed_ret.PubMed_info.impfact = "None"
-                pubmed_ret.PubMed_info.journal = "None"
-                pubmed_ret.PubMed_info.full_refs = "None"
-
-            elif len(pubmed.PubMed_info.pbid) == 1:  # если отдна статья
-                u_id = int(pubmed.PubMed_info.pbid[0])
-                pubmed_ret.PubMed_info.pbid = u_id  # тут тупо вывожу инфу по одной статье
+    if len(pubmed_id_list) == 0:  # статей нет ни у одного датасета - отдаем лист как есть
+        return gse_info_list
+    if res is None:
+        res = get_pubmed_client().summaries(pubmed_id_list)
+    impact = get_impact_index()
+
+    for pubmed in gse_info_list:
+        pubmed_ret = pubmed
+        if isinstance(pubmed.PubMed_info.pbid, list):
+            # статьи, по которым PubMed ничего не вернул, пропускаем
+            found = [pb for pb in pubmed.PubMed_info.pbid if int(pb) in res]
+            if len(found) < len(pubmed.PubMed_info.pbid):
+                ERRORS.write("no pubmed summary " + str(pubmed.series_info.GSE) + " " +
+                             str([pb for pb in pubmed.PubMed_info.pbid if pb not in found]) + "\n")
+            pubmed_ret.PubMed_info.pbid = found if len(found) > 0 else None
+        if pubmed.PubMed_info.pbid is None:  # если нет статьи
+            pubmed_ret.PubMed_info.impfact = "None"
+            pubmed_ret.PubMed_info.journal = "None"
+            pubmed_ret.PubMed_info.full_refs = "None"
+
+        elif len(pubmed.PubMed_info.pbid) == 1:  # если отдна статья
+            u_id = int(pubmed.PubMed_info.pbid[0])
+            pubmed_ret.PubMed_info.pbid = u_id  # тут тупо вывожу инфу по одной статье
+            ful_jur = res.get(u_id).get('fulljournalname')
+            # полное название, потом краткое (ISO), с нормализацией регистра, пунктуации, &/and
+            imft = impact.resolve(ful_jur, res.get(u_id).get('source'))
+            if imft is None:
+                imft = "None"  # ненайденные журналы уже посчитаны в индексе
+            pubmed_ret.PubMed_info.journal = ful_jur
+            pubmed_ret.PubMed_info.impfact = imft
+
+            doi_ex = False
+            for d in res.get(u_id).get('articleids'):
+                if d.get('idtype') == 'doi':
+                    u_doi = d.get('value')
+                    doi_ex = True
+            if doi_ex:
+                # pubmed_ret.PubMed_info.doi = "doi: " + u_doi
+                pubmed_ret.PubMed_info.doi = "https://doi.org/" + u_doi
+                ref = u_doi
+            else:
+                pubmed_ret.PubMed_info.doi = "pubmed_id = " + str(u_id)
+                ref = "pubmed_id = " + str(u_id)
+            pubmed_ret.PubMed_info.title = res.get(u_id).get('title')
+            pubmed_ret.PubMed_info.full_refs = "{" + ful_jur + " (" + imft + "): " + ref + "}"
+        elif len(pubmed.PubMed_info.pbid) > 1:  # если несколько статей
+            # Прохожусь по всем pubmed id, выявляю тот, у которого наибольший импакт фактор
+            best = ["", -1.0, "None"]
+            all_refs = ""
+            for uniq_pb in pubmed.PubMed_info.pbid:
+                u_id = int(uniq_pb)
                 ful_jur = res.get(u_id).get('fulljournalname')
-                imft = dict_if.get(ful_jur.lower())
-                if imft is None:
-                    imft = dict_if.get(res.get(u_id).get('source').lower())  # пробуем краткое название
+                imft = impact.resolve(ful_jur, res.get(u_id).get('source'))
                 if imft is None:
-                    imft = dict_if.get(ful_jur.lower().replace('and', '&'))
-                if imft is None:
-                    imft = dict_if.get(ful_jur.lower().replace('&', 'and'))
-                # все перепробовали, теперь с высокой вероятностью есть impactfactor
-                if imft == "None" or imft == "Not Available":
-                    imft = "None"
-                elif imft is None:
                     imft = "None"
-                    new_jurs.append(ful_jur)  # Если все же его нет, то записываем в логи
-                pubmed_ret.PubMed_info.journal = ful_jur
-                pubmed_ret.PubMed_info.impfact = imft
+                mb_best = [u_id, -0.5 if imft == "None" else float(imft), imft]
+                if best[1] < mb_best[1]:
+                    best = mb_best
+
+                # тут формируем дополение в полный списко всех ссылок
+                doi_ex = False
+                for d in res.get(u_id).get('articleids'):
+                    if d.get('idtype') == 'doi':
+                        u_doi = d.get('value')
+                        doi_ex = True
+                if doi_ex:
+                    out_str = "{" + ful_jur + " (" + imft + ") doi:" + u_doi + "}; "
+                else:
+                    out_str = "{" + ful_jur + " (" + imft + ") pubmed_id = " + str(uniq_pb) + "}; "
+                all_refs = all_refs + out_str
+            pubmed_id = best[0]
+            doi_ex = False
+            for d in res.get(pubmed_id).get('articleids'):
+                if d.get('idtype') == 'doi':
+                    ul_doi = d.get('value')
+                    doi_ex = True
+            if doi_ex:
+                # pubmed_ret.PubMed_info.doi = "doi: " + ul_doi
+                pubmed_ret.PubMed_info.doi = "https://doi.org/" + ul_doi
+            else:
+                pubmed_ret.PubMed_info.doi = "pubmed_id = " + str(pubmed_id)
+            pubmed_ret.PubMed_info.title = res.get(pubmed_id).get('title')
+            # jur = res.get(pubmed_id).get('source')  # Тут краткое имя журнала
+            # pubmed_ret.PubMed_info.journal = jur
+            pubmed_ret.PubMed_info.impfact = best[2]
+            pubmed_ret.PubMed_info.journal = res.get(pubmed_id).get('fulljournalname')
+            pubmed_ret.PubMed_info.full_refs = all_refs
+        exit_list.append(pubmed_ret)
+    return exit_list
+
+
+class CacheMiss(Exception):
+    """
+    Записи нет в кэше, а скачивать нельзя (режим --offline)
+    """
+
+
+class CacheWriter:
+    """
+    Файл, который пишется во временную директорию кэша и по ходу записи считает sha256.
+    После finish() его можно положить в кэш под именем хэша (content-addressed)
+    """
+
+    def __init__(self, tmp_path):
+        self.path = tmp_path
+        self.file = open(tmp_path, 'wb')
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LocalCache:
+    """
+    Локальный кэш скачанных файлов: архивы MINiML с GEO и XML с ArrayExpress.
+    Файлы лежат в objects/ под именем своего sha256 (одинаковое содержимое хранится один раз),
+    а в index.sqlite записано: какой accession -> какой хэш, ETag/Last-Modified сервера и когда запись
+    последний раз проверялась (validated) и использовалась (accessed).
+    Пока запись моложе ttl, сервер не спрашиваем вообще; потом - условный запрос (If-None-Match/If-Modified-Since
+    или MDTM для FTP). Если кэш больше max_size, то выкидываются записи, которые дольше всех не использовались (LRU),
+    а записи, которые не проверялись дольше max_age, удаляются в любом случае.
+    """
+
+    def __init__(self, path, max_size, ttl, max_age):
+        self.path = path
+        self.max_size = max_size  # байт
+        self.ttl = ttl  # секунд
+        self.max_age = max_age  # секунд
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(path, "tmp"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, sha TEXT, size INTEGER, "
+                        "etag TEXT, mtime REAL, validated REAL, accessed REAL)")
+        self.db.commit()
+
+    def _object(self, sha):
+        return os.path.join(self.path, "objects", sha[:2], sha)
+
+    def lookup(self, key):
+        """
+        Вход: ключ записи (например GEO:GSE1234)
+        Выход: словарь с метаданными записи или None, если ее нет
+        """
+        with self.lock:
+            row = self.db.execute("SELECT sha, size, etag, mtime, validated FROM entries WHERE key = ?",
+                                  (key,)).fetchone()
+        if row is None or not os.path.exists(self._object(row[0])):
+            return None
+        return {"key": key, "sha": row[0], "size": row[1], "etag": row[2], "mtime": row[3], "validated": row[4]}
+
+    def is_fresh(self, meta):
+        return time.time() - meta["validated"] < self.ttl
+
+    def conditional_headers(self, meta):
+        """
+        Выход: заголовки условного HTTP запроса для записи (пустой словарь, если записи нет)
+        """
+        headers = {}
+        if meta is not None:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["mtime"]:
+                headers["If-Modified-Since"] = formatdate(meta["mtime"], usegmt=True)
+        return headers
+
+    def touch(self, key, validated=False):
+        now = time.time()
+        with self.lock:
+            if validated:
+                self.db.execute("UPDATE entries SET accessed = ?, validated = ? WHERE key = ?", (now, now, key))
+            else:
+                self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+
+    def open(self, meta):
+        """
+        Выход: бинарный файл с содержимым записи
+        """
+        self.touch(meta["key"])
+        return open(self._object(meta["sha"]), 'rb')
+
+    def read_text(self, meta):
+        with self.open(meta) as f:
+            return gzip.decompress(f.read()).decode('utf-8')
+
+    def writer(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.path, "tmp"))
+        os.close(fd)
+        return CacheWriter(tmp_path)
+
+    def commit(self, key, writer, etag=None, mtime=None):
+        """
+        Вход: ключ, дописанный CacheWriter и то, что сервер сказал про версию файла
+        Кладет файл в objects/ под именем хэша и обновляет индекс
+        """
+        writer.close()
+        sha = writer.sha.hexdigest()
+        obj = self._object(sha)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        if os.path.exists(obj):
+            os.remove(writer.path)  # такой файл уже есть (например, не изменился с прошлого раза)
+        else:
+            os.replace(writer.path, obj)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, sha, writer.size, etag, mtime, now, now))
+            self.db.commit()
+
+    def put_text(self, key, text, etag=None, mtime=None):
+        writer = self.writer()
+        writer.write(gzip.compress(text.encode('utf-8')))
+        self.commit(key, writer, etag, mtime)
+
+    def evict(self):
+        """
+        Удаляет из кэша записи, которые давно не проверялись, а потом самые давно не использованные,
+        пока кэш не влезет в max_size. Файл удаляется, только если на него больше не ссылается ни одна запись
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT key, sha, size, validated FROM entries ORDER BY accessed").fetchall()
+            total = sum(row[2] for row in rows)
+            old = time.time() - self.max_age
+            dropped = []
+            for key, sha, size, validated in rows:
+                if validated < old or total > self.max_size:
+                    dropped.append(key)
+                    total -= size
+            for key in dropped:
+                sha = self.db.execute("SELECT sha FROM entries WHERE key = ?", (key,)).fetchone()[0]
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if self.db.execute("SELECT 1 FROM entries WHERE sha = ?", (sha,)).fetchone() is None:
+                    try:
+                        os.remove(self._object(sha))
+                    except OSError:
+                        pass
+            self.db.commit()
+        return len(dropped)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def ftp_mtime(response):
+    """
+    Вход: ответ сервера на MDTM вида "213 20200131235959"
+    Выход: время в секундах (или None)
+    """
+    try:
+        stamp = response.split()[1][:14]
+        return calendar.timegm(time.strptime(stamp, "%Y%m%d%H%M%S"))
+    except (IndexError, ValueError):
+        return None
+
+
+def http_mtime(value):
+    """
+    Вход: заголовок Last-Modified
+    Выход: время в секундах (или None)
+    """
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def cached_get_text(key, url, session=None):
+    """
+    Вход: ключ для кэша, адрес и (не обязательно) requests.Session, через которую делать запрос
+    Выход: текст ответа сервера (или его копия из кэша)
+    Если кэш выключен - это просто GET через http_request (с таймаутами и повторами)
+    """
+    if Local_cache is None:
+        return http_request("get", url, session).text
+    meta = Local_cache.lookup(key)
+    if meta is not None and (Offline or Local_cache.is_fresh(meta)):
+        return Local_cache.read_text(meta)
+    if Offline:
+        raise CacheMiss(key)
+    r = http_request("get", url, session, headers=Local_cache.conditional_headers(meta))
+    if r.status_code == 304 and meta is not None:
+        Local_cache.touch(key, validated=True)
+        return Local_cache.read_text(meta)
+    if r.status_code == 200:
+        Local_cache.put_text(key, r.text, r.headers.get("ETag"), http_mtime(r.headers.get("Last-Modified")))
+    return r.text
+
+
+def GSE_to_nnn(gse_id):
+    """
+    Вход: GSE_id
+    ВЫХОД: название наддиректории в виде GSE...nnn (-3 последние символа)
+    """
+    if len(gse_id) > 5:
+        out_n = gse_id[:-3] + "nnn/"
+    else:
+        out_n = "GSEnnn/"
+    return out_n
+
+
+def geo_family_path(gse_id):
+    """
+    Вход: GSE_id
+    Выход: путь до архива MINiML на сервере (одинаковый для FTP и HTTPS)
+    """
+    return "/geo/series/" + GSE_to_nnn(gse_id) + gse_id + "/miniml/" + gse_id + "_family.xml.tgz"
+
+
+class BadFamilyFile(Exception):
+    """
+    Архив скачался, но разобрать его не получилось (битый архив, нет _family.xml, кривой XML)
+    """
+
+
+class ArchiveStream:
+    """
+    Обертка над потоком скачивания: считает байты и дублирует их в файлы (отладочный tmp и/или кэш)
+    """
+
+    def __init__(self, raw, tees=()):
+        self.raw = raw
+        self.tees = list(tees)
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.raw.read(n)
+        self.size += len(data)
+        for tee in self.tees:
+            tee.write(data)
+        return data
+
+    def drain(self, blocksize):
+        while self.read(blocksize):
+            pass
+
+    def close(self, discard=False):
+        for tee in self.tees:
+            if discard and isinstance(tee, CacheWriter):
+                tee.discard()  # недокачанный или битый архив в кэш не кладем
+            else:
+                tee.close()
+
+
+@Run_metrics.timed("xml_parse_seconds")
+def parse_family_xml(source, engine=None, sample_rows=None):
+    """
+    Вход: путь до _family.xml или открытый бинарный поток с ним, движок парсера (по умолчанию из --parser)
+    и флаг сбора строк по сэмплам (по умолчанию из --samples)
+    Выход: переменная мегакласса GseInfo
+    """
+    if sample_rows is None:
+        sample_rows = Sample_rows
+    if (engine or Parser_engine) == "iter":
+        return geo_xml_iterparser(source, sample_rows)
+    return geo_xml_parser(source, sample_rows)
+
+
+def parse_family_tgz(fileobj, GSE_id, engine=None):
+    """
+    Вход: поток с архивом GSE..._family.xml.tgz
+    Выход: GseInfo
+    Архив читается потоково (mode="r|gz"), ничего не распаковывается на диск:
+    до парсера доходит только член архива _family.xml, все остальное пропускается
+    """
+    start = time.perf_counter()
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tf:
+        for member in tf:
+            if member.isfile() and os.path.basename(member.name) == GSE_id + "_family.xml":
+                Run_metrics.observe("tar_seconds", time.perf_counter() - start)  # дальше разбор идет из потока
+                return parse_family_xml(tf.extractfile(member), engine)
+    raise tarfile.ReadError("no " + GSE_id + "_family.xml in archive")
+
+
+@Run_metrics.timed("tar_seconds")
+def extract_family_xml(fileobj, GSE_id):
+    """
+    Вход: поток с архивом GSE..._family.xml.tgz
+    Выход: содержимое _family.xml (bytes), чтобы разобрать его в другом процессе
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tf:
+        for member in tf:
+            if member.isfile() and os.path.basename(member.name) == GSE_id + "_family.xml":
+                return tf.extractfile(member).read()
+    raise tarfile.ReadError("no " + GSE_id + "_family.xml in archive")
+
+
+@Run_metrics.timed("tar_seconds")
+def spool_family_xml(fileobj, GSE_id, spool_dir):
+    """
+    Вход: поток с архивом GSE..._family.xml.tgz и директория для временных файлов
+    Выход: путь до временного файла с _family.xml (для --low_memory: в другой процесс уходит путь, а не
+    весь файл в памяти). Файл удаляет parse_family_job
+    """
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tf:
+        for member in tf:
+            if member.isfile() and os.path.basename(member.name) == GSE_id + "_family.xml":
+                fd, path = tempfile.mkstemp(prefix=GSE_id + "_", suffix=".xml", dir=spool_dir)
+                with os.fdopen(fd, 'wb') as spool:
+                    shutil.copyfileobj(tf.extractfile(member), spool, Block_size)
+                return path
+    raise tarfile.ReadError("no " + GSE_id + "_family.xml in archive")
+
+
+def parse_context():
+    """
+    Выход: контекст multiprocessing для пула разбора - forkserver, а где его нет (Windows) - spawn
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def parse_family_job(xml, GSE_id, engine, sample_rows=False, caps=None):
+    """
+    Вход: содержимое _family.xml (или путь до временного файла с ним из spool_family_xml), GSE_id, движок парсера,
+    флаг сбора строк по сэмплам и ограничения --value_cap
+    Выход: GseInfo и метрики этого процесса с прошлого задания (Run_metrics.drain, их сливает GeoPipeline)
+    Запускается в пуле процессов (поэтому все нужное передается аргументами, а не через глобальные переменные)
+    """
+    global Value_caps
+    Value_caps = caps or {}
+    try:
+        source = xml if isinstance(xml, str) else io.BytesIO(xml)
+        gse_info = parse_family_xml(source, engine, sample_rows)
+    except Exception as e:
+        raise BadFamilyFile(GSE_id) from e
+    finally:
+        if isinstance(xml, str):
+            os.remove(xml)
+    rss = peak_rss()
+    if rss is not None:
+        Run_metrics.observe("parse_rss_bytes", rss, RunMetrics.rss_buckets)  # max - пик самого толстого процесса
+    return gse_info, Run_metrics.drain()
+
+
+class DownloadProgress:
+    """
+    Общий прогресс-бар для всех потоков скачивания.
+    Каждый поток сообщает сколько байт он скачал, а в подписи к бару выводится скорость каждого потока
+    """
+
+    def __init__(self, total, leave=False):
+        self.bar = tqdm(total=total, unit="ds", leave=leave, desc="download")
+        self.lock = threading.Lock()
+        self.bytes = {}  # имя потока -> [байт скачано, секунд потрачено]
+
+    def report(self, nbytes, seconds):
+        name = threading.current_thread().name.split("_")[-1]
+        with self.lock:
+            stat = self.bytes.setdefault(name, [0, 0.0])
+            stat[0] += nbytes
+            stat[1] += seconds
+            speeds = {}
+            for worker, (b, sec) in sorted(self.bytes.items()):
+                speeds["w" + worker] = "%.1fMB/s" % (b / 1048576 / sec if sec > 0 else 0.0)
+            self.bar.set_postfix(speeds, refresh=False)
+            self.bar.update(1)
+
+    def close(self):
+        self.bar.close()
+
+
+class GeoDownloader:
+    """
+    Пул для скачивания архивов MINiML с GEO.
+    Потоки живут все время работы программы, у каждого потока свое FTP соединение (и своя HTTPS сессия),
+    которое переиспользуется между пакетами, а не открывается заново на каждый датасет.
+    Если по FTP скачать не получилось, то пробуем тот же путь по HTTPS.
+    """
+
+    def __init__(self, workers, blocksize):
+        self.blocksize = blocksize
+        self.local = threading.local()
+        self.connections = []  # все открытые соединения, чтобы в конце их закрыть
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="argeos_dl")
+
+    def _ftp(self):
+        ftp = getattr(self.local, "ftp", None)
+        if ftp is None:
+            ftp = ftplib.FTP(GEO_ftp_host, timeout=Net_timeout[1])
+            ftp.login(user="anonymous")
+            self.local.ftp = ftp
+            with self.lock:
+                self.connections.append(ftp)
+        return ftp
+
+    def _drop_ftp(self):
+        ftp = getattr(self.local, "ftp", None)
+        self.local.ftp = None
+        if ftp is not None:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()  # keep-alive соединение на весь поток
+            self.local.session = session
+            with self.lock:
+                self.connections.append(session)
+        return session
+
+    def _tees(self, GSE_id, cached):
+        # архив пишется на диск только в отладочном режиме и в кэш (если он включен и архив не из кэша)
+        tees = []
+        if Keep_tmp:
+            tees.append(open(os.path.join(tmp_dir, str(GSE_id + ".xml.tgz")), 'wb'))
+        if Local_cache is not None and not cached:
+            tees.append(Local_cache.writer())
+        return tees
+
+    def _consume(self, raw, GSE_id, handler, mtime=None, etag=None, cached=False):
+        """
+        Вход: поток с архивом, GSE_id, что делать с архивом (handler) и версия файла на сервере (для кэша)
+        Выход: результат handler (разобранный GseInfo или содержимое _family.xml) и кол-во скачанных байт
+        Остаток архива (таблицы сэмплов) дочитывается вхолостую, чтобы соединение можно было использовать дальше
+        (и чтобы в кэш попал архив целиком)
+        """
+        reader = ArchiveStream(raw, self._tees(GSE_id, cached))
+        try:
+            try:
+                gse_info = handler(reader, GSE_id)
+            except network_errors():
+                raise  # это обрыв связи, а не битый файл: такое можно повторить (см. net_call)
+            except Exception as e:
+                raise BadFamilyFile(GSE_id) from e
+            reader.drain(self.blocksize)
+        except Exception:
+            reader.close(discard=True)
+            raise
+        reader.close()
+        for tee in reader.tees:
+            if isinstance(tee, CacheWriter):
+                Local_cache.commit("GEO:" + GSE_id, tee, etag, mtime)
+        return gse_info, reader.size
+
+    def _from_cache(self, meta, GSE_id, handler, validated=False):
+        if validated:
+            Local_cache.touch(meta["key"], validated=True)
+        with Local_cache.open(meta) as f:
+            return self._consume(f, GSE_id, handler, cached=True)
+
+    def _by_ftp(self, path, GSE_id, meta, handler):
+        # Сервер может закрыть простаивающее соединение, поэтому один раз переподключаемся
+        for attempt in range(2):
+            try:
+                ftp = self._ftp()
+                mtime = None
+                if Local_cache is not None:
+                    # MDTM - аналог Last-Modified для FTP, по нему понимаем, изменился ли архив
+                    mtime = ftp_mtime(ftp.sendcmd('MDTM ' + path))
+                    if meta is not None and mtime is not None and meta["mtime"] is not None \
+                            and mtime <= meta["mtime"]:
+                        return self._from_cache(meta, GSE_id, handler, validated=True)
+                conn = ftp.transfercmd('RETR ' + path)
+            except ftplib.all_errors:
+                self._drop_ftp()
+                if attempt == 1:
+                    raise
+                continue
+            try:
+                with conn, conn.makefile('rb') as stream:
+                    result = self._consume(stream, GSE_id, handler, mtime=mtime)
+                ftp.voidresp()
+                return result
+            except Exception:
+                # состояние управляющего соединения неизвестно, так что его проще пересоздать
+                self._drop_ftp()
+                raise
+
+    def _by_https(self, path, GSE_id, meta, handler):
+        headers = Local_cache.conditional_headers(meta) if Local_cache is not None else {}
+        with self._session().get(GEO_https_base + path, stream=True, headers=headers, timeout=Net_timeout) as r:
+            if r.status_code == 304 and meta is not None:
+                return self._from_cache(meta, GSE_id, handler, validated=True)
+            r.raise_for_status()
+            r.raw.decode_content = False  # это и так .tgz, распаковывает tarfile
+            return self._consume(r.raw, GSE_id, handler, mtime=http_mtime(r.headers.get("Last-Modified")),
+                                 etag=r.headers.get("ETag"))
+
+    def _https(self, path, GSE_id, meta, handler):
+        # архив качается заново целиком, если связь оборвалась посреди скачивания
+        return net_call(urllib.parse.urlsplit(GEO_https_base).netloc,
+                        lambda: self._by_https(path, GSE_id, meta, handler))
+
+    def fetch(self, GSE_id, progress, handler=parse_family_tgz):
+        """
+        Вход: GSE_id, общий прогресс-бар и что делать с потоком архива (по умолчанию - сразу разобрать)
+        Выход: GseInfo, разобранный прямо из скачиваемого потока (без временных файлов), иначе исключение
+        (или содержимое _family.xml, если handler=extract_family_xml)
+        Если включен кэш, то архив берется из него (со свежей записью на сервер не ходим вообще)
+        """
+        if VerboseG:
+            tqdm.write("Downloading " + str(GSE_id))  # Важно что использую не print(), т.к. он ломает prog.bar tqdm
+        path = geo_family_path(GSE_id)
+        start = time.monotonic()
+        meta = Local_cache.lookup("GEO:" + GSE_id) if Local_cache is not None else None
+        if meta is not None and (Offline or Local_cache.is_fresh(meta)):
+            source = "cache"
+            gse_info, size = self._from_cache(meta, GSE_id, handler)
+        elif Offline:
+            raise CacheMiss(GSE_id)
+        elif not GEO_ftp_host:
+            source = "https"
+            gse_info, size = self._https(path, GSE_id, meta, handler)
+        else:
+            try:
+                source = "ftp"
+                # FTP не повторяем: запасной вариант для него - HTTPS, но ошибки считает предохранитель
+                gse_info, size = net_call(GEO_ftp_host, lambda: self._by_ftp(path, GSE_id, meta, handler), retries=0)
+            except ftplib.all_errors + (CircuitOpen,):
+                if VerboseG:
+                    tqdm.write("FTP failed, trying HTTPS " + str(GSE_id))
+                Run_metrics.inc("download_ftp_failures_total")
+                source = "https"
+                gse_info, size = self._https(path, GSE_id, meta, handler)
+        seconds = time.monotonic() - start
+        progress.report(size, seconds)
+        # время скачивания включает и разбор (он идет прямо из потока), кроме режима с пулом процессов
+        Run_metrics.observe("download_seconds", seconds)
+        Run_metrics.observe("download_bytes", size, RunMetrics.bytes_buckets)
+        Run_metrics.inc("download_bytes_total", size)
+        Run_metrics.inc("downloads_" + source + "_total")
+        return gse_info
+
+    def download(self, gse_list, ERRORS):
+        """
+        Вход: лист из GSE ID и файл для ошибок
+        Выход: лист из GseInfo по датасетам, которые удалось скачать и разобрать (в исходном порядке)
+        """
+        progress = DownloadProgress(len(gse_list))
+        futures = [(GSE_id, self.pool.submit(self.fetch, GSE_id, progress)) for GSE_id in gse_list]
+        done = []
+        for GSE_id, future in futures:
+            try:
+                done.append(future.result())
+            except BadFamilyFile:
+                ERRORS.write("error was (bad XML file) " + str(GSE_id) + "\n")
+            except CacheMiss:
+                ERRORS.write("error was (not in cache, offline) " + str(GSE_id) + "\n")
+            except Exception as e:
+                note_failure(ERRORS, "download", GSE_id, e)
+        progress.close()
+        return done
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        for conn in self.connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.connections = []
+
 
-                doi_ex = False
-                for d in res.get(u_id).get('articleids'):
-                    if d.get('idtype') == 'doi':
-                        u_doi = d.get('value')
-                        doi_ex = True
-                if doi_ex:
-                    # pubmed_ret.PubMed_info.doi = "doi: " + u_doi
-                    pubmed_ret.PubMed_info.doi = "https://doi.org/" + u_doi
-                else:
-                    pubmed_ret.PubMed_info.doi = "pubmed_id = " + str(u_id)
-                    ul_doi = "pubmed_id = " + str(u_id)
-                pubmed_ret.PubMed_info.title = res.get(u_id).get('title')
-                pubmed_ret.PubMed_info.full_refs = "{" + ful_jur + " (" + imft + "): " + u_doi + "}"
-            elif len(pubmed.PubMed_info.pbid) > 1:  # если несколько статей
-                # Прохожусь по всем pubmed id, выявляю тот, у которого наибольший импакт фактор
-                best = ["", -1.0]
-                all_refs = ""
-                for uniq_pb in pubmed.PubMed_info.pbid:
-                    u_id = int(uniq_pb)
-                    ful_jur = res.get(u_id).get('fulljournalname')
-                    imft = dict_if.get(ful_jur.lower())
-                    mb_best = [u_id, imft]
-                    if imft == "None" or imft == "Not Available" or imft is None:
-                        mb_best[1] = -0.5
-                    else:
-                        mb_best[1] = float(mb_best[1])
-                    if best[1] < mb_best[1]:
-                        best = mb_best
-
-                    # тут формируем дополение в полный списко всех ссылок
-                    doi_ex = False
-                    for d in res.get(u_id).get('articleids'):
-                        if d.get('idtype') == 'doi':
-                            u_doi = d.get('value')
-                            doi_ex = True
-                    if imft is None:
-                        imft = "None"
-                        new_jurs.append(ful_jur)  # to ERRORs
-                    if doi_ex:
-                        out_str = "{" + ful_jur + " (" + imft + ") doi:" + u_doi + "}; "
-                    else:
-                        out_str = "{" + ful_jur + " (" + imft + ") pubmed_id = " + uniq_pb + "}; "
-                    all_refs = all_refs + out_str
-                if best[1] == -0.5:
-                    best[1] = "None"
-                pubmed_id = best[0]
-                doi_ex = False
-                for d in res.get(pubmed_id).get('articleids'):
-                    if d.get('idtype') == 'doi':
-                        ul_doi = d.get('value')
-                        doi_ex = True
-                if doi_ex:
-                    # pubmed_ret.PubMed_info.doi = "doi: " + ul_doi
-                    pubmed_ret.PubMed_info.doi = "https://doi.org/" + ul_doi
-                else:
-                    pubmed_ret.PubMed_info.doi = "pubmed_id = " + str(pubmed_id)
-                pubmed_ret.PubMed_info.title = res.get(pubmed_id).get('title')
-                # jur = res.get(pubmed_id).get('source')  # Тут краткое имя журнала
-                # pubmed_ret.PubMed_info.journal = jur
-                jur = res.get(pubmed_id).get('fulljournalname')
-                if (jur not in jurs) and (jur not in new_jurs):
-                    new_jurs.append(jur)
-                pubmed_ret.PubMed_info.impfact = dict_if.get(jur.lower())
-                pubmed_ret.PubMed_info.journal = jur
-                pubmed_ret.PubMed_info.full_refs = all_refs
-            exit_list.append(pubmed_ret)
-
-        # return block
-        if len(new_jurs) > 0:
-            ERRORS.write("new jurs! " + str(new_jurs) + "\n")
-    return exit_list
+_geo_downloader = None
+
+
+def get_geo_downloader():
+    """
+    Выход: общий на всю программу пул скачивания (создается при первом обращении)
+    """
+    global _geo_downloader
+    if _geo_downloader is None:
+        _geo_downloader = GeoDownloader(Download_workers, Block_size)
+    return _geo_downloader
 
 
 def xml_by_id(gse_list, ERRORS):
     """
     Вход: лист из GSE ID
-    Выход: скаччанные .xml файлы в tmp директории
-    Функция берет набор ID и через FTP скачивает архивы в tmp папку, после чего разархивирует их до .xml
+    Выход: лист из GseInfo по датасетам, которые удалось скачать и разобрать
+    Функция берет набор ID и через пул потоков (FTP, а при неудаче HTTPS) скачивает архивы, и прямо из потока
+    скачивания разбирает _family.xml. На диск ничего не пишется (кроме отладочного режима --keep_tmp)
+    """
+    return get_geo_downloader().download(gse_list, ERRORS)
+
+
+class LockedWriter:
     """
+    Файл, в который пишут несколько потоков сразу (errors_argeos.txt в конвейере)
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
 
-    def GSE_to_nnn(gse_id):
+    def write(self, text):
+        with self.lock:
+            self.file.write(text)
+
+    def commit(self):
         """
-        Вход: GSE_id
-        ВЫХОД: название наддиректории в виде GSE...nnn (-3 последние символа)
+        Выход: размер файла после всего, что в него записано (для журнала CheckpointJournal)
         """
-        if len(gse_id) > 5:
-            out_n = gse_id[:-3] + "nnn/"
-        else:
-            out_n = "GSEnnn/"
-        return out_n
-
-        # компонеты для ftp подключения к GEO
-        host = "ftp.ncbi.nlm.nih.gov"
-        ftp = ftplib.FTP(host)
-        ftp.login(user="anonymous")
-        for GSE_id in tqdm(gse_list):
-            if VerboseG:
-                tqdm.write("Downloading " + str(GSE_id))  # Важно что использую не print(), т.к. он ломает prog.bar tqdm
-            filename = "/geo/series/" + GSE_to_nnn(GSE_id) + GSE_id + "/miniml/" + GSE_id + "_family.xml.tgz"
-            out = os.path.join(tmp_dir, str(GSE_id + ".xml.tgz"))
-            with open(out, 'wb') as f:
-                def callback(data):
-                    f.write(data)
+        with self.lock:
+            self.file.flush()
+            return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class CheckpointJournal:
+    """
+    Журнал завершенных записей (checkpoint_argeos.jsonl в output директории). Файл только дописывается:
+    после записи каждого пакета в него добавляется строка с accession из пакета и размерами файлов вывода
+    (offsets) на этот момент. При --resume уже записанные accession пропускаются, а файлы вывода обрезаются
+    до последних сохраненных размеров, так что недописанный пакет не дублируется.
+    Первая строка (без accession) пишется сразу после открытия файлов - с размерами шапок
+    """
+
+    def __init__(self, path, append):
+        self.path = path
+        self.done = OrderedSet()  # accession, которые уже есть в выдаче
+        self.offsets = None  # размеры файлов вывода после последнего пакета
+        self.existed = append and os.path.exists(path)  # журнал есть (хоть и может быть пустым)
+        good = 0
+        if self.existed:
+            with open(path, 'rb') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # строка не дописана (программа упала на середине) - дальше не читаем
+                    self.done.update(entry["ids"])
+                    self.offsets = entry["offsets"]
+                    good = good + len(line)
+            os.truncate(path, good)
+        self.file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def truncate_outputs(self, paths):
+        """
+        Вход: словарь имя -> путь файла вывода (имена как в offsets)
+        Обрезает файлы до размеров из последней записи журнала. Если журнал есть, но целых записей в нем нет
+        (упали еще до первой), то ничего из файлов не годится - они обнуляются, и шапки пишутся заново.
+        Если журнала нет совсем (выдача из старой версии или его удалили), файлы считаются дописанными и не трогаются
+        """
+        if self.offsets is None and not self.existed:
+            return
+        for name, path in paths.items():
+            offset = 0 if self.offsets is None else self.offsets.get(name)
+            if offset is not None and os.path.exists(path) and os.path.getsize(path) > offset:
+                os.truncate(path, offset)
+
+    def commit(self, ids, offsets):
+        self.file.write(json.dumps({"ids": list(ids), "offsets": offsets}) + "\n")
+        self.file.flush()
+        self.done.update(ids)
+        self.offsets = offsets
+
+    def close(self):
+        self.file.close()
+
+
+class GeoPipeline:
+    """
+    Конвейер для блока GEO: скачивание -> разбор XML -> PubMed -> разбиение на строки -> запись.
+    Каждая стадия работает в своем потоке (разбор - в пуле процессов, суп держит GIL), между стадиями
+    ограниченные очереди. Одновременно в конвейере не больше depth датасетов, так что память не растет,
+    а сеть и процессор работают параллельно. Пакеты для PubMed собираются строго в порядке входного листа,
+    поэтому выдача не зависит от того, какой датасет скачался раньше.
+    """
+
+    def __init__(self, downloader, parse_workers, depth, chunk_size, split, ERRORS):
+        self.downloader = downloader
+        self.parse_workers = parse_workers
+        self.chunk_size = max(1, chunk_size)
+        self.depth = max(1, depth)
+        self.split = split
+        self.errors = LockedWriter(ERRORS)
+
+    def _stage(self, target, *args):
+        def body():
+            try:
+                target(*args)
+            except BaseException as e:
+                self.q_write.put(e)  # ошибку стадии пробрасываем в основной поток
+        thread = threading.Thread(target=body, daemon=True)
+        thread.start()
+        return thread
+
+    def _feed(self, gse_list, progress):
+        # стадия скачивания: архивы качает пул потоков загрузчика, но не больше depth штук наперед
+        handler = parse_family_tgz
+        if self.proc_pool is not None and self.spool_dir is not None:
+            handler = functools.partial(spool_family_xml, spool_dir=self.spool_dir)
+        elif self.proc_pool is not None:
+            handler = extract_family_xml
+        for idx, GSE_id in enumerate(gse_list):
+            self.window.acquire()
+            future = self.downloader.pool.submit(self.downloader.fetch, GSE_id, progress, handler)
+            future.add_done_callback(lambda f, idx=idx, GSE_id=GSE_id: self.q_parse.put((idx, GSE_id, f)))
+
+    def _parse(self, total):
+        # стадия разбора: содержимое _family.xml уходит в пул процессов
+        for _ in range(total):
+            idx, GSE_id, future = self.q_parse.get()
+            if self.proc_pool is not None and future.exception() is None:
+                future = self.proc_pool.submit(parse_family_job, future.result(), GSE_id, Parser_engine, Sample_rows,
+                                               Value_caps)
+            future.add_done_callback(lambda f, idx=idx, GSE_id=GSE_id: self.q_enrich.put((idx, GSE_id, f)))
+
+    def _enrich(self, total):
+        # стадия PubMed: восстанавливаем исходный порядок и собираем пакеты по chunk_size.
+        # Пакеты копятся, пока не наберется Pubmed_batch статей (или датасетов), и тогда PubMed
+        # спрашивается одним запросом на все накопленные пакеты сразу
+        pending = {}
+        next_idx = 0
+        chunk = []
+        self.held = []  # готовые пакеты, которые ждут PubMed
+        self.held_pmids = OrderedSet()  # PMID без повторов, в порядке появления
+        for _ in range(total):
+            idx, GSE_id, future = self.q_enrich.get()
+            pending[idx] = (GSE_id, future)
+            while next_idx in pending:
+                GSE_id, future = pending.pop(next_idx)
+                next_idx = next_idx + 1
+                # разобранный датасет уже маленький, так что место в конвейере освобождаем сразу
+                self.window.release()
+                try:
+                    result = future.result()
+                    if isinstance(result, tuple):  # из пула процессов: (GseInfo, метрики процесса)
+                        result, snapshot = result
+                        Run_metrics.merge(snapshot)
+                    chunk.append(result)
+                except BadFamilyFile:
+                    self.errors.write("error was (bad XML file) " + str(GSE_id) + "\n")
+                except CacheMiss:
+                    self.errors.write("error was (not in cache, offline) " + str(GSE_id) + "\n")
+                except Exception as e:
+                    note_failure(self.errors, "download", GSE_id, e)
+                if len(chunk) == self.chunk_size:
+                    self._hold(chunk)
+                    chunk = []
+        if chunk:
+            self._hold(chunk)
+        self._flush()
+        self.q_write.put(None)
+
+    def _hold(self, chunk):
+        pubmed_id_list = []
+        for gse_info in chunk:
+            if gse_info.PubMed_info.pbid is not None:
+                for pbid in gse_info.PubMed_info.pbid:
+                    pubmed_id_list.append(pbid)
+        self.held.append((chunk, pubmed_id_list))
+        self.held_pmids.update(pubmed_id_list)
+        held_records = sum(len(c) for c, ids in self.held)
+        if len(self.held_pmids) >= Pubmed_batch or held_records >= Pubmed_batch:
+            self._flush()
 
-                ftp.retrbinary('RETR ' + filename, callback, blocksize=1024)  # последний параметр увелиивает скорость
-            tf = tarfile.open(out)
-            tf.extractall(path=tmp_dir)
-            tf.close()
+    def _flush(self):
+        if not self.held:
+            return
+        pmids = [int(i) for i in self.held_pmids if i != "None"]
+        res = get_pubmed_client().summaries(pmids) if pmids else {}
+        for chunk, pubmed_id_list in self.held:
+            chunk = pubmed_parser(chunk, pubmed_id_list, self.errors, res)  # раздаем инфу из PubMed по пакетам
+            if self.split:
+                chunk = split_to_unique(chunk)
+            self.q_write.put(chunk)
+        self.held = []
+        self.held_pmids = OrderedSet()
+
+    def run(self, gse_list):
+        """
+        Вход: лист из GSE ID
+        Выход: генератор пакетов (листов мегаформата) в порядке входного листа, готовых к записи
+        """
+        self.window = threading.Semaphore(self.depth)
+        self.q_parse = queue.Queue(self.depth)
+        self.q_enrich = queue.Queue(self.depth)
+        self.q_write = queue.Queue(self.depth)
+        self.proc_pool = None
+        if self.parse_workers > 0:
+            # не fork: процессы создаются, когда уже работают потоки стадий, и при fork им могли бы достаться
+            # чужие замки в захваченном состоянии (метрики, tqdm, пулы соединений, кэш)
+            self.proc_pool = ProcessPoolExecutor(self.parse_workers, mp_context=parse_context())
+        # --low_memory: разобрать еще не успели, а _family.xml уже скачан - пусть лежит на диске, а не в памяти
+        self.spool_dir = tempfile.mkdtemp(prefix="argeos_spool_") if Low_memory and self.proc_pool else None
+        progress = DownloadProgress(len(gse_list), leave=True)
+        self._stage(self._feed, gse_list, progress)
+        self._stage(self._parse, len(gse_list))
+        self._stage(self._enrich, len(gse_list))
+        try:
+            while True:
+                item = self.q_write.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            progress.close()
+            if self.proc_pool is not None:
+                self.proc_pool.shutdown(wait=False, cancel_futures=True)
+            if self.spool_dir is not None:
+                shutil.rmtree(self.spool_dir, ignore_errors=True)  # файлы тех, кого так и не разобрали
 
 
-def arex_search(filename, output_dir):
+def arex_search(filename, output_dir, state=None):
     """
-    Вход: список запросов для GEO
+    Вход: список запросов для GEO (и SearchState для режима --delta)
     Выход: лист из id ArrayExpress + таблица с кол-вом записей по каждому запросу
+    У ArrayExpress фильтра по дате в запросе нет, так что с SearchState записи отсеиваются уже тут: остаются те,
+    у которых lastupdatedate (или releasedate) не раньше прошлого поиска по этому запросу
     """
-    bhtml = "https://www.ebi.ac.uk/arrayexpress/xml/v3/experiments"  # базовая html строка
+    bhtml = AE_base + "/experiments"  # базовая html строка
     bhtml = bhtml + "?directsub=true&"  # это позволяет отсеить данные импортированные из GEO
     with open(os.path.join(dirname, filename), "r") as input_file:  # открываем файл с запросами
         term_list = input_file.readlines()
     table_term = open(os.path.join(output_dir, "table_term.tsv"), "a")  # открываем файл для записи таблицы
     table_term.write("term" + '\t' + "number of found datasets (ArrayExpress)" + '\n')
-    arexp_list = []  # объявляю лист для переменных
-    for term in tqdm(term_list):
-        the_term = term  # .split("|")
-        tmp_list = []
-        # Преобразование запроса
-        # Тут преобразую запрос из формата для GEO формат для ArrayExpress
-        if "|" in term:  # если в запросе есть организм, то обрабатываем его отдельно, как того требует ArrayExpress
-            orgn = term.split("|")[1].strip().split("[")[0]
-            term = "(" + term.split("|")[0].strip() + ")"
-            norm_term = term + "&species=" + orgn
+    arexp_list = OrderedSet()  # объявляю множество для ID (без повторов, в порядке появления)
+    queries = []
+    for line in term_list:
+        query = parse_query(line)  # тот же разбор, что и для GEO (запомнен в parse_query)
+        if query is None:
+            continue
+        since = None
+        if state is not None:
+            since = state.since("AE", query.raw)
+            if since is not None:
+                since = since.replace("/", "-")  # у ArrayExpress даты в формате YYYY-MM-DD
+            state.mark("AE", query.raw)
+        # организм у ArrayExpress - отдельный параметр species, см. SearchQuery.ae_params
+        queries.append((query.ae_label(), bhtml + query.ae_params(), since))
+    keys = [url + ("" if since is None else " since=" + since) for label, url, since in queries]
+    cached = [None if Search_cache is None else Search_cache.get("AE", key) for key in keys]
+    # запросы идут параллельно через клиент ArrayExpress, ответы разбираются потоково (ArrayExpressClient.search)
+    results = get_ae_client().search([(url, since) for (label, url, since), hit in zip(queries, cached)
+                                      if hit is None])
+    for (label, url, since), key, hit in tqdm(list(zip(queries, keys, cached))):
+        if hit is not None:
+            i, tmp_list = hit
         else:
-            norm_term = "(" + term.strip() + ")"
-        c = []
-        for i in norm_term.split(" "):  # тут для замены пробелов на плюсики (для url запроса!) сплитим по пробелам
-            if len(i) > 0:  # если пользователь написал 2 пробела, то этот цикл удалит лишний
-                c.append(i)
-        norm_term = "+".join(c)  # наконец сливаем порезанную строку аккрутно пробелчиками
-        # скачивание запроса
-        req = bhtml + "keywords=" + norm_term
-        r = requests.get(req)
-        soup = BeautifulSoup(r.text, features="html.parser")
-        # выцепление всех ArEx ID
-        exp = soup.find_all("experiment")
-        i = len(exp)  # кол-во находок
-        for ex in exp:
-            id = ex.find("accession").get_text().strip()
-            tmp_list.append(id)
-        table_term.write(norm_term.replace("+", " ").replace("&species=", " | ") + '\t' + str(i) + '\n')
-        arexp_list = arexp_list + tmp_list
-    # Фильтрация уникальных значений
-    arexp_list = list(set(arexp_list))
-    num = 0
-    with open(os.path.join(output_dir, "input_ArEx.txt"), "w") as input_ae:  # открываем файл на запись GSE ID
-        for ae in arexp_list:
-            input_ae.write(ae + '\n')  # Проходимся по ID, записываем их в файл
-            num = num + 1
+            tmp_list = next(results)
+            i = len(tmp_list)  # кол-во находок
+            if Search_cache is not None:
+                Search_cache.put("AE", key, i, tmp_list)
+        table_term.write(label + '\t' + str(i) + '\n')
+        arexp_list.update(tmp_list)
+    # ID уже уникальные (порядок как в выдаче), записываю их в файл
+    num = save_search_result(output_dir, "input_ArEx.txt", arexp_list, state)
     table_term.write("TOTAL ArrayExpress (UNIQUE)\t" + str(num) + '\n')  # дописываем кол-во уникальных
     table_term.close()  # не забываем закрыть файл
 
 
-def array_express(id):
+@Run_metrics.timed("ae_record_seconds")
+def array_express(id, client=None):
     """
-    Вход: ArEx ID для анализа
+    Вход: ArEx ID для анализа и (не обязательно) ArrayExpressClient
     Выход: переменная для печати (в мегаформате)
     По итогу решил забить, и для каждой записи в индивидуальном порядке скачивать инфу в xml
+    С клиентом запросы идут через его сессию, а протоколы качаются параллельно и не больше одного раза за запуск
     """
-    bhtml = "https://www.ebi.ac.uk/arrayexpress/xml/v3/experiments"
+    bhtml = AE_base + "/experiments"
     request = bhtml + '/' + id  # формируем строку запроса
     # далее получаю инфу через url запрос
     # if VerboseG:
     #     print(request, file=sys.stderr)
-    r = requests.get(request)  # делаю запрос
+    get_text = cached_get_text if client is None else client.get_text
+    xml = get_text("AE:" + id, request)  # делаю запрос (или беру из кэша)
     # with open(os.path.join(tmp_dir, 'tmp.html'), 'w', encoding='utf-8') as tmp_file:
     #     tmp_file.write(r.text)  # Кэширую страницу во временном файле, потом работаю с файлом.
     # with open(os.path.join(tmp_dir, 'tmp.html'), 'r', encoding='utf-8') as tmp_html:
     #     xml = tmp_html.read()  # читаю файл в переменную, после чего закрываю файл
-    soup = BeautifulSoup(r.text, features="html.parser")  # парсим супом, формирую дерево разбора
-    ae = mydeepcopy(GseInfo())  # объявляю переменную МЕГАкласса
+    soup = BeautifulSoup(xml, features="html.parser")  # парсим супом, формирую дерево разбора
+    ae = GseInfo()  # объявляю переменную МЕГАкласса
     # тут я пока стараюсь выявить соответсвия по тегам и категориям в GEO
     ae.series_info.GSE = id
     if type(soup.find("name")) != 'NoneType':
@@ -713,7 +2887,7 @@ def array_express(id):
             pub_tmp = bib0.find("publication")
             if pub_tmp is not None:
                 ae.PubMed_info.journal = pub_tmp.get_text().strip()
-                ae.PubMed_info.impfact = dict_if.get(ae.PubMed_info.journal.lower())
+                ae.PubMed_info.impfact = get_impact_index().resolve(ae.PubMed_info.journal)
             else:
                 ae.PubMed_info.journal = "None"
                 ae.PubMed_info.impfact = "None"
@@ -729,10 +2903,13 @@ def array_express(id):
     # ! Блок анализа протоколов
     ae.series_info.Summary = soup.find("description").get_text().strip()  # видимо по смыслу это summary (?)
     # ! Блок прохождения по всем протоколам
-    protocols = soup.find_all("protocol")
+    protocols = [str(prot.find("id").get_text().strip()) for prot in soup.find_all("protocol")]
+    if client is None:
+        shmotocols = [protocol_analyzer(prot) for prot in protocols]
+    else:
+        shmotocols = client.protocols(protocols)
     total_protocols = ""
-    for prot in protocols:
-        shmotocol = protocol_analyzer(str(prot.find("id").get_text().strip()))
+    for shmotocol in shmotocols:
         if shmotocol is not None:
             total_protocols = total_protocols + shmotocol
     is_gro = False
@@ -760,41 +2937,224 @@ def array_express(id):
         else:
             ae.series_info.platform = "None"
     # конец анализа, возвращаю готовую переменную
-    return mydeepcopy(ae)
+    return ae
+
+
+class ArrayExpressClient:
+    """
+    Параллельный сбор записей ArrayExpress.
+    Каждый поток держит свою requests.Session (keep-alive), записи качаются пулом потоков, а протоколы - отдельным
+    пулом (чтобы поток с записью не ждал сам себя). Протокол с одним и тем же ID скачивается один раз за запуск:
+    результат хранится в памяти и отдается всем записям, которые на него ссылаются
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.protocol_cache = {}  # id протокола -> Future с его строкой (или None)
+        self.pool = ThreadPoolExecutor(self.workers)
+        self.protocol_pool = ThreadPoolExecutor(self.workers)
+
+    def _session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+            with self.lock:
+                self.connections.append(session)
+        return session
+
+    def get_text(self, key, url):
+        return cached_get_text(key, url, self._session())
+
+    def protocols(self, id_list):
+        """
+        Вход: лист ID протоколов
+        Выход: лист строк protocol_analyzer (в том же порядке)
+        """
+        futures = []
+        with self.lock:
+            for prot_id in id_list:
+                future = self.protocol_cache.get(prot_id)
+                if future is None:
+                    future = self.protocol_pool.submit(protocol_analyzer, prot_id, self.get_text)
+                    self.protocol_cache[prot_id] = future
+                futures.append(future)
+        return [future.result() for future in futures]
+
+    def _search_one(self, url, since):
+        # если ответ оборвался на середине, запрос повторяется целиком
+        return net_call(urllib.parse.urlsplit(url).netloc, lambda: self._search_stream(url, since))
 
+    def _search_stream(self, url, since):
+        """
+        Вход: адрес поискового запроса и дата (YYYY-MM-DD) для фильтра --delta или None
+        Выход: лист accession найденных экспериментов
+        Ответ не читается целиком: XML разбирается iterparse прямо из потока, из каждого <experiment> берутся только
+        accession и даты, после чего он удаляется из памяти
+        """
+        Run_metrics.inc("ae_search_requests_total")
+        start = time.perf_counter()
+        r = self._session().get(url, stream=True, timeout=Net_timeout)
+        r.raise_for_status()
+        r.raw.decode_content = True  # распаковать gzip, если сервер его использует
+        found = []
+        depth = 0
+        root = None
+        fields = {}
+        try:
+            for event, elem in etree.iterparse(r.raw, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    depth = depth + 1
+                    continue
+                depth = depth - 1
+                if depth == 2:  # поля самого эксперимента (вложенные accession у arraydesign и т.п. глубже)
+                    name = _local(elem.tag)
+                    if name in ("accession", "lastupdatedate", "releasedate") and name not in fields:
+                        fields[name] = (elem.text or "").strip()
+                elif depth == 1:
+                    if _local(elem.tag) == "experiment" and fields.get("accession"):
+                        date = fields.get("lastupdatedate") or fields.get("releasedate")
+                        if since is None or date is None or date >= since:  # иначе не менялась с прошлого поиска
+                            found.append(fields["accession"])
+                    fields = {}
+                    elem.clear()
+                    root.clear()
+        finally:
+            r.close()
+            Run_metrics.observe("ae_search_seconds", time.perf_counter() - start)
+        return found
+
+    def search(self, queries):
+        """
+        Вход: лист пар (адрес поискового запроса, дата для --delta или None)
+        Выход: генератор листов accession по запросам (в исходном порядке), запросы идут параллельно
+        """
+        futures = [self.pool.submit(self._search_one, url, since) for url, since in queries]
+        for (url, since), future in zip(queries, futures):
+            yield future.result()
+
+    def run(self, id_list, chunk_size, ERRORS):
+        """
+        Вход: лист ArEx ID, размер пакета и файл для ошибок
+        Выход: генератор пакетов (листов GseInfo) в исходном порядке
+        Впереди текущей записи в работе держится не больше workers * 4 записей
+        """
+        chunk_size = max(1, chunk_size)
+        window = self.workers * 4
+        futures = collections.deque()
+        ids = iter(id_list)
+        chunk = []
+        progress = tqdm(total=len(id_list))
+        while True:
+            while len(futures) < window:
+                aeid = next(ids, None)
+                if aeid is None:
+                    break
+                futures.append((aeid, self.pool.submit(array_express, aeid, self)))
+            if not futures:
+                break
+            aeid, future = futures.popleft()
+            try:
+                chunk.append(future.result())
+            except CacheMiss:
+                ERRORS.write("error was (not in cache, offline) " + str(aeid) + "\n")
+            except Exception as e:
+                note_failure(ERRORS, "ArrayExpress", aeid, e)
+            progress.update(1)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        progress.close()
+        if chunk:
+            yield chunk
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.protocol_pool.shutdown(wait=True)
+        for conn in self.connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.connections = []
+
+
+_ae_client = None
 
+
+def get_ae_client():
+    """
+    Выход: общий на всю программу клиент ArrayExpress (создается при первом обращении)
+    """
+    global _ae_client
+    if _ae_client is None:
+        _ae_client = ArrayExpressClient(AE_workers)
+    return _ae_client
+
+
+@Run_metrics.timed("pubmed_title_search_seconds")
 def pbid_by_title(title_list):
     """
     Вход: лист названий
     Выход: словарь название = pubmed id
     Ищет в pubmed статьи по названиям
-    Вообще этим пактеом сильно удобнее вытаскивать всю инфу, но A) времени нет и Б) работает -- не трогай!
+    Если есть Pubmed_cache, то в PubMed ищутся только названия, которых в нем еще нет
     """
-    term = "(" + "[Title]) OR( ".join(title_list) + "[Title])"
-    pubmed = PubMed(tool=tool, email=email)
-    results = pubmed.query(term, max_results=5)
     dict_for_out = {}
     list_of_ids = []
-    for article in results:
-        if article.title.strip(".") in term:
-            dict_for_out[article.title.strip(".")] = article.pubmed_id.split("\n")[0]
-            list_of_ids.append(article.pubmed_id.split("\n")[0])
+    if Pubmed_cache is not None:
+        cached, title_list = Pubmed_cache.get_titles([t.strip(".") for t in title_list])
+        for title, pmid in cached.items():
+            if pmid is not None:
+                dict_for_out[title] = pmid
+                list_of_ids.append(pmid)
+    if len(title_list) == 0 or Offline:
+        return [dict_for_out, list_of_ids]
+    term = "(" + "[Title]) OR( ".join(title_list) + "[Title])"
+    # раньше это делал pymed (esearch + efetch), теперь esearch и esummary идут через net_call
+    params = {"db": "pubmed", "term": term, "retmax": 5, "retmode": "json", "tool": tool, "email": email}
+    if Api_key:
+        params["api_key"] = Api_key
+    try:
+        r = http_request("get", Eutils_base + "/esearch.fcgi", throttle=get_entrez_bucket().acquire, params=params)
+        r.raise_for_status()
+        found_ids = [int(i) for i in r.json()["esearchresult"]["idlist"]]
+    except Exception as e:
+        tqdm.write("PubMed title search failed: " + repr(e), file=sys.stderr)
+        return [dict_for_out, list_of_ids]  # в кэш ничего не пишем, в следующий раз поищем снова
+    fresh = {}
+    for pmid, summary in get_pubmed_client().summaries(found_ids).items():
+        title = (summary.get("title") or "").strip(".")
+        if len(title) > 0 and title in term:
+            fresh[title] = str(pmid)
+            dict_for_out[title] = str(pmid)
+            list_of_ids.append(str(pmid))
+    if Pubmed_cache is not None:
+        # то, что не нашлось, тоже запоминаем, чтобы не искать каждый раз
+        Pubmed_cache.put_titles({title: fresh.get(title) for title in title_list})
+        Pubmed_cache.put_titles(fresh)
     return [dict_for_out, list_of_ids]
 
 
-def protocol_analyzer(id):
+@Run_metrics.timed("ae_protocol_seconds")
+def protocol_analyzer(id, get_text=cached_get_text):
     """
-    Вход: id протокола из Array Express
+    Вход: id протокола из Array Express (и функция для запроса, по умолчанию cached_get_text)
     Выход: вся информация по протоколу, преобразованная в строку.
     """
-    bhtml = "https://www.ebi.ac.uk/arrayexpress/xml/v3/protocols/"
+    bhtml = AE_base + "/protocols/"
     request = bhtml + id  # формируем строку запроса
     # далее получаю инфу через url запрос
     if VerboseG:
         print("getting protocol by id: " + id, file=sys.stderr)
-        print(request)
-    r = requests.get(request)  # делаю запрос
-    soup = BeautifulSoup(r.text, features="html.parser")  # парсим супом, формирую дерево разбора
+        print(request, file=sys.stderr)
+    xml = get_text("AEP:" + id, request)  # делаю запрос (или беру из кэша)
+    soup = BeautifulSoup(xml, features="html.parser")  # парсим супом, формирую дерево разбора
     is_fail = False
     text = ""
     typ = ""
@@ -816,6 +3176,7 @@ def protocol_analyzer(id):
         return total_information_string
 
 
+@Run_metrics.timed("split_seconds")
 def split_to_unique(glist):
     """
     Вход и Выход: Лист МЕГАФОРМАТА
@@ -830,9 +3191,9 @@ def split_to_unique(glist):
             if ";" in gmega.series_info.organism:
                 org_list = gmega.series_info.organism.split(";")
                 for org in org_list:
-                    new_mega = deepcopy(gmega)  # Очень важно делать глубокую копию!
-                    # Иначе у двух переменных ссылка на один и тот же объект
-                    new_mega.series_info.organism = org.strip()
+                    # копируется только series_info, PubMed_info и gsm_info у копий общие с оригиналом
+                    # (после разбиения их уже никто не меняет, так что глубокая копия не нужна)
+                    new_mega = gmega.replace(series_info=gmega.series_info.replace(organism=org.strip()))
                     prom_list.append(new_mega)
             else:
                 prom_list.append(gmega)
@@ -840,14 +3201,14 @@ def split_to_unique(glist):
     for gmega2 in prom_list:
         if ";" in gmega2.series_info.Type:
             for typ in gmega2.series_info.Type.split(";"):
-                new_mega = deepcopy(gmega2)
-                new_mega.series_info.Type = typ.strip(" ")
+                new_mega = gmega2.replace(series_info=gmega2.series_info.replace(Type=typ.strip(" ")))
                 exit_glist.append(new_mega)
         else:
             exit_glist.append(gmega2)
     return exit_glist
 
 
+@Run_metrics.timed("text_write_seconds")
 def text_output(listochek, output_text_file):
     """
     Вход: лист из переменных мегаформата и файл для записи
@@ -878,89 +3239,846 @@ def text_output(listochek, output_text_file):
             output_text_file.write('GRP\t' + str(gse_info.gsm_info.Growth) + '\n')
 
 
-def table_output(listochek, output_table_file):
+TABLE_COLUMNS = ["Accession", "Organism", "Samples", "Type", "Platform", "Title",  # "Authors",
+                 "Year", "Summary", "Link", "Paper_title", "Journal", "Impact factor 2018", "doi or pubmed id",
+                 "All references", "Type of molecule", "BioProject link (NCBI)", "BioProject link (EBI)", "SRA",
+                 "All protocols"]
+
+
+def table_row(gse_info):
     """
-    Вход: лист из переменных мегаформата и файл для записи
-    Выход: запись в файл таблицы инормации по данному GSE
+    Вход: переменная мегаформата
+    Выход: лист значений (строк) в порядке TABLE_COLUMNS
+    """
+    id = gse_info.series_info.GSE
+    if "GSE" in id:
+        link = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc=" + id  # Если GEO
+    else:
+        link = "https://www.ebi.ac.uk/arrayexpress/experiments/" + id  # Если Array Express
+    series, pubmed, gsm = gse_info.series_info, gse_info.PubMed_info, gse_info.gsm_info
+    return [str(series.GSE), str(series.organism), str(series.samples), str(series.Type), str(series.platform),
+            str(series.title), str(series.sub_date), str(series.Summary), link, str(pubmed.title),
+            str(pubmed.journal), str(pubmed.impfact), str(pubmed.doi), str(pubmed.full_refs), str(gsm.Type_mol),
+            str(series.BioProject), str(series.BioProj_EBI), str(series.SRA), str(gsm.All_protocols)]
+
+
+class TsvWriter:
+    """
+    Таблица в TSV через csv.writer (поля с табами, переносами строк и кавычками экранируются по правилам csv).
+    Последняя колонка (All protocols) режется cell_splitter на несколько ячеек, чтобы влезть в Excel/Google sheets
+    raw - бинарный файл, compressor - функция, которая оборачивает его в сжимающий поток (или None).
+    Сжатый файл пишется отдельными gzip member / zstd фреймами, которые закрываются на каждом commit(): такой файл
+    можно обрезать по любому из этих мест и дописывать дальше, и он останется читаемым
+    """
+
+    def __init__(self, raw, compressor=None, header=True):
+        self.raw = raw
+        self.compressor = compressor
+        self.stream = None
+        self.text = None
+        if header:
+            self._open()
+            self.writer.writerow(TABLE_COLUMNS)
+
+    def _open(self):
+        self.stream = self.raw if self.compressor is None else self.compressor(self.raw)
+        self.text = io.TextIOWrapper(self.stream, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text, delimiter="\t", lineterminator="\n")
+
+    def write_row(self, row):
+        if self.text is None:
+            self._open()
+        self.writer.writerow(row[:-1] + cell_splitter(row[-1]))
+
+    def commit(self):
+        """
+        Выход: размер файла в байтах после всего, что записано (для журнала CheckpointJournal)
+        """
+        if self.text is not None:
+            self.text.flush()
+            if self.compressor is not None:
+                self.text.detach()
+                self.stream.close()  # закрывает только сжатый поток, raw остается открытым
+                self.text = None
+        self.raw.flush()
+        return self.raw.tell()
+
+    def close(self):
+        self.commit()
+        if self.text is not None:
+            self.text.detach()
+        self.raw.close()
+
+
+class ArrowTableWriter:
+    """
+    Таблица в Parquet или Arrow IPC (нужен pyarrow). Колонки те же, что в TSV, все строковые, ячейки не режутся.
+    Строки копятся по колонкам и сбрасываются на диск группами по row_group строк
+    """
+
+    def __init__(self, path, fmt, row_group):
+        self.row_group = max(1, row_group)
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in TABLE_COLUMNS])
+        if fmt == "parquet":
+            self.writer = pyarrow_parquet.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+        self.columns = [[] for _ in TABLE_COLUMNS]
+
+    def write_row(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        if len(self.columns[0]) >= self.row_group:
+            self._flush()
+
+    def _flush(self):
+        if self.columns[0]:
+            self.writer.write_table(pyarrow.Table.from_arrays(self.columns, schema=self.schema))
+            self.columns = [[] for _ in TABLE_COLUMNS]
+
+    def commit(self):
+        # дописывать parquet/arrow нельзя, так что и смещение для --resume не имеет смысла
+        return None
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+# расширение файла таблицы для каждого формата --format
+TABLE_FORMATS = {"tsv": ".tsv", "tsv.gz": ".tsv.gz", "tsv.zst": ".tsv.zst", "parquet": ".parquet",
+                 "arrow": ".arrow"}
+
+
+def zstd_stream(raw):
+    """
+    Вход: бинарный файл
+    Выход: поток, который сжимает в него zstd (сам raw при закрытии потока не закрывается)
+    """
+    if hasattr(zstd, "ZstdFile"):  # compression.zstd из стандартной библиотеки (Python 3.14+)
+        return zstd.ZstdFile(raw, mode='w')
+    return zstd.ZstdCompressor().stream_writer(raw, closefd=False)  # пакет zstandard
+
+
+def table_path(output_dir, fmt):
+    return os.path.join(output_dir, "output_argeos" + TABLE_FORMATS[fmt])
+
+
+def open_table_writer(output_dir, fmt, row_group=10000, append=False):
+    """
+    Вход: директория, формат из TABLE_FORMATS, размер группы строк (для parquet/arrow) и флаг дозаписи (для tsv)
+    Выход: writer с методами write_row(row), commit() и close(), шапка (если она нужна) уже записана
+    """
+    path = table_path(output_dir, fmt)
+    if fmt in ("parquet", "arrow"):
+        return ArrowTableWriter(path, fmt, row_group)
+    header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+    compressor = {"tsv": None,
+                  "tsv.gz": lambda raw: gzip.GzipFile(fileobj=raw, mode='wb'),
+                  "tsv.zst": zstd_stream}[fmt]
+    return TsvWriter(open(path, 'ab' if append else 'wb'), compressor, header)
+
+
+SAMPLE_COLUMNS = ["Accession", "Sample", "Channel", "Source", "Cell type", "Molecule", "Pair"]
+VOCAB_COLUMNS = ["Pair", "Tag", "Value"]
+SAMPLE_FORMATS = {"tsv": ".tsv", "parquet": ".parquet"}
+
+
+def sample_paths(output_dir, fmt):
+    """
+    Выход: пути до таблицы сэмплов и до словаря пар tag/value для формата --samples
+    """
+    return (os.path.join(output_dir, "output_samples" + SAMPLE_FORMATS[fmt]),
+            os.path.join(output_dir, "samples_vocab" + SAMPLE_FORMATS[fmt]))
+
+
+class SampleWriter:
+    """
+    Длинная таблица по сэмплам (--samples): строка на каждую пару tag/value из Characteristics каждого канала
+    каждого сэмпла, плюс source, cell type и molecule канала. В отличие от основной таблицы тут ничего не
+    схлопывается, так что видно, какой сэмпл какие характеристики имеет.
+    Сами пары в таблице заменены номерами (колонка Pair) из словаря samples_vocab: одна и та же пара
+    ("cell type", "macrophage") на миллионе сэмплов хранится один раз. Словарь только дописывается - пара получает
+    следующий номер при первой встрече, поэтому tsv можно обрезать по журналу (CheckpointJournal) и продолжить.
+    В parquet строковые колонки еще и словарные (dictionary), словарь пар пишется целиком при закрытии
+    """
+
+    def __init__(self, output_dir, fmt, row_group=10000, append=False):
+        self.fmt = fmt
+        self.row_group = max(1, row_group)
+        self.vocab = {}  # (tag, value) -> номер пары
+        path, vocab_path = sample_paths(output_dir, fmt)
+        if fmt == "parquet":
+            self.vocab_path = vocab_path
+            text = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+            self.schema = pyarrow.schema([("Accession", text), ("Sample", pyarrow.string()),
+                                          ("Channel", pyarrow.int32()), ("Source", text), ("Cell type", text),
+                                          ("Molecule", text), ("Pair", pyarrow.int32())])
+            self.writer = pyarrow_parquet.ParquetWriter(path, self.schema, compression="zstd")
+            self.columns = [[] for _ in SAMPLE_COLUMNS]
+            return
+        if append and os.path.exists(vocab_path):
+            with open(vocab_path, 'r', encoding='utf-8', newline='') as vocab_file:
+                reader = csv.reader(vocab_file, delimiter="\t")
+                next(reader, None)  # шапка
+                for pair_id, tag, value in reader:
+                    self.vocab[(tag, value)] = int(pair_id)
+        self.files = []
+        self.writers = []
+        for file_path, columns in ((path, SAMPLE_COLUMNS), (vocab_path, VOCAB_COLUMNS)):
+            header = not (append and os.path.exists(file_path) and os.path.getsize(file_path) > 0)
+            file = open(file_path, 'a' if append else 'w', encoding='utf-8', newline='')
+            writer = csv.writer(file, delimiter="\t", lineterminator="\n")
+            if header:
+                writer.writerow(columns)
+            self.files.append(file)
+            self.writers.append(writer)
+
+    def _pair(self, pair):
+        pair_id = self.vocab.get(pair)
+        if pair_id is None:
+            pair_id = len(self.vocab) + 1
+            self.vocab[pair] = pair_id
+            if self.fmt == "tsv":
+                self.writers[1].writerow([pair_id, pair[0], pair[1]])
+        return pair_id
+
+    def _row(self, row):
+        if self.fmt == "tsv":
+            self.writers[0].writerow(["" if value is None else value for value in row])
+            return
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        if len(self.columns[0]) >= self.row_group:
+            self._flush()
+
+    def _flush(self):
+        if self.columns[0]:
+            arrays = [pyarrow.array(column, type=field.type) for column, field in zip(self.columns, self.schema)]
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.columns = [[] for _ in SAMPLE_COLUMNS]
+
+    @Run_metrics.timed("samples_write_seconds")
+    def write(self, listochek):
+        """
+        Вход: лист из переменных мегаформата (записи без строк сэмплов, например из ArrayExpress, пропускаются)
+        """
+        rows = 0
+        for gse_info in listochek:
+            samples = gse_info.gsm_info.Samples
+            if samples is None:
+                continue
+            # копии из split_to_unique делят gsm_info с оригиналом: после записи строки отпускаются,
+            # так что вторая копия уже ничего не пишет (и память не держится до конца пакета)
+            gse_info.gsm_info.Samples = None
+            accession = gse_info.series_info.GSE
+            for sample, channel, source, cells, mol_type, pairs in samples:
+                for pair in pairs or [None]:
+                    self._row((accession, sample, channel, source, cells, mol_type,
+                               None if pair is None else self._pair(pair)))
+                    rows = rows + 1
+        Run_metrics.inc("sample_rows_total", rows)
+
+    def commit(self):
+        """
+        Выход: размеры файлов (для журнала CheckpointJournal), у parquet их нет
+        """
+        if self.fmt != "tsv":
+            return {}
+        offsets = {}
+        for name, file in zip(("samples", "samples_vocab"), self.files):
+            file.flush()
+            offsets[name] = file.tell()
+        return offsets
+
+    def close(self):
+        if self.fmt != "tsv":
+            self._flush()
+            self.writer.close()
+            pairs = sorted(self.vocab.items(), key=lambda item: item[1])
+            vocab = pyarrow.table({"Pair": pyarrow.array([pair_id for pair, pair_id in pairs], pyarrow.int32()),
+                                   "Tag": [pair[0] for pair, pair_id in pairs],
+                                   "Value": [pair[1] for pair, pair_id in pairs]})
+            pyarrow_parquet.write_table(vocab, self.vocab_path, compression="zstd")
+            return
+        for file in self.files:
+            file.close()
+
+
+class SearchIndex:
+    """
+    Полнотекстовый индекс по выдаче (SQLite FTS5, файл argeos_index.sqlite в output директории), чтобы искать
+    датасеты по словам из описаний, характеристик и протоколов, а не грепать огромный output_argeos.tsv.
+    Пополняется в table_output по мере записи (и при --resume/--incremental дописывается, а не строится заново).
+    Текст хранится по accession один раз, а строки таблицы (после split_to_unique их может быть несколько
+    на один accession) - в отдельной таблице rows
+    """
+    fields = ("title", "summary", "overall_design", "cell_type", "characteristics", "protocols", "paper_title")
+    weights = (10.0, 4.0, 3.0, 3.0, 2.0, 1.0, 5.0)  # веса колонок для ранжирования (bm25)
+
+    def __init__(self, path, append=True):
+        if not append and os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS accessions (docid INTEGER PRIMARY KEY, accession TEXT UNIQUE)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (accession TEXT, organism TEXT, type TEXT, samples TEXT, "
+                        "year TEXT, journal TEXT, impfact TEXT, link TEXT, PRIMARY KEY (accession, organism, type))")
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(" + ", ".join(self.fields) +
+                        ", tokenize='porter unicode61')")
+        self.written = set()  # accession, текст которых в этом запуске уже записан
+
+    def add(self, gse_info, row):
+        """
+        Вход: запись и ее строка таблицы (table_row)
+        """
+        series, pubmed, gsm = gse_info.series_info, gse_info.PubMed_info, gse_info.gsm_info
+        accession = str(series.GSE)
+        self.db.execute("INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (accession, str(series.organism), str(series.Type), str(series.samples),
+                         str(series.sub_date)[:4], str(pubmed.journal), str(pubmed.impfact), row[8]))
+        if accession in self.written:
+            return  # копия из split_to_unique: текст тот же
+        self.written.add(accession)
+        self.db.execute("INSERT OR IGNORE INTO accessions (accession) VALUES (?)", (accession,))
+        docid = self.db.execute("SELECT docid FROM accessions WHERE accession = ?", (accession,)).fetchone()[0]
+        texts = (series.title, series.Summary, series.Overall_design, gsm.Cell_type, gsm.Characteristics,
+                 gsm.All_protocols, pubmed.title)
+        # старая версия текста (с прошлого запуска) заменяется по rowid
+        self.db.execute("INSERT OR REPLACE INTO docs (rowid, " + ", ".join(self.fields) + ") VALUES (?" +
+                        ", ?" * len(self.fields) + ")", [docid] + ["" if t is None else str(t) for t in texts])
+
+    def search(self, query, field=None, organism=None, limit=20):
+        """
+        Вход: запрос в синтаксисе FTS5 (слова, "фразы", AND/OR/NOT, префиксы lung*, колонка:слово),
+        колонка из fields, подстрока названия организма и сколько результатов вернуть
+        Выход: лист словарей, лучшие совпадения первыми
+        Если запрос не разобрался как FTS5 (например, в нем есть скобка или дефис), слова ищутся как есть
+        """
+        top = ("SELECT docs.rowid AS docid, bm25(docs, " + ", ".join(map(str, self.weights)) + ") AS score "
+               "FROM docs WHERE docs MATCH ?")
+        params = []
+        if organism is not None:
+            top = top + (" AND EXISTS (SELECT 1 FROM rows r JOIN accessions a ON a.accession = r.accession "
+                         "WHERE a.docid = docs.rowid AND r.organism LIKE ?)")
+            params.append("%" + organism + "%")
+        top = top + " ORDER BY score LIMIT ?"
+        params.append(limit)
+        sql = ("SELECT a.accession, top.score, "
+               "(SELECT group_concat(DISTINCT r.organism) FROM rows r WHERE r.accession = a.accession), "
+               "(SELECT group_concat(DISTINCT r.type) FROM rows r WHERE r.accession = a.accession), "
+               + ", ".join("docs." + name for name in self.fields) +
+               " FROM (" + top + ") top JOIN docs ON docs.rowid = top.docid JOIN accessions a ON a.docid = top.docid "
+               "ORDER BY top.score")
+        try:
+            found = self.db.execute(sql, [self._match(query, field)] + params).fetchall()
+        except sqlite3.OperationalError:
+            quoted = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+            found = self.db.execute(sql, [self._match(quoted, field)] + params).fetchall()
+        return [{"accession": acc, "score": round(-score, 6), "title": texts[0],
+                 "snippet": self._snippet(query, texts if field is None else (texts[self.fields.index(field)],)),
+                 "organism": organism_list, "type": type_list}
+                for acc, score, organism_list, type_list, *texts in found]
+
+    @staticmethod
+    def _snippet(query, texts, width=80):
+        """
+        Вход: запрос и тексты колонок (по убыванию веса)
+        Выход: кусок текста вокруг первого найденного слова запроса, слово в [скобках]
+        Встроенный snippet() FTS5 токенизирует все колонки целиком, на сериях с тысячами сэмплов это секунды,
+        поэтому тут простой поиск по началу слова (без стемминга, как у porter)
+        """
+        words = [word.rstrip("*") for word in re.findall(r"[\w*]+", query)
+                 if word not in ("AND", "OR", "NOT", "NEAR") and word.rstrip("*") not in SearchIndex.fields]
+        if not words:
+            return ""
+        pattern = re.compile(r"\b(?:" + "|".join(re.escape(word) for word in words) + r")\w*", re.IGNORECASE)
+        for text in texts:
+            hit = pattern.search(text or "")
+            if hit is not None:
+                start, end = max(0, hit.start() - width), min(len(text), hit.end() + width)
+                return (("..." if start else "") + text[start:hit.start()] + "[" + hit.group() + "]" +
+                        text[hit.end():end] + ("..." if end < len(text) else ""))
+        return ""
+
+    @staticmethod
+    def _match(query, field):
+        return query if field is None else field + " : (" + query + ")"
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def index_path(output_dir):
+    return os.path.join(output_dir, "argeos_index.sqlite")
+
+
+@Run_metrics.timed("table_write_seconds")
+def table_output(listochek, table_writer, index=None):
+    """
+    Вход: лист из переменных мегаформата, writer из open_table_writer и (не обязательно) SearchIndex
+    Выход: запись в таблицу инормации по данному GSE (и в поисковый индекс)
     """
-    # test = gse_info.gsm_info.Type_mol
     for gse_info in listochek:
         if gse_info.series_info.GSE is not None:
             if VerboseG:
                 tqdm.write("writing " + gse_info.series_info.GSE, file=sys.stderr)
-            all_prot = cell_splitter(deepcopy(gse_info.gsm_info.All_protocols))
-            id = gse_info.series_info.GSE
-            if "GSE" in id:
-                link = "https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc=" + id  # Если GEO
-            else:
-                link = "https://www.ebi.ac.uk/arrayexpress/experiments/" + id  # Если Array Express
-            # посредственно запись строки
-            output_table_file.write(str(gse_info.series_info.GSE) + "\t" + str(gse_info.series_info.organism) + "\t" +
-                                    str(gse_info.series_info.samples) + "\t" + str(gse_info.series_info.Type) + "\t" +
-                                    str(gse_info.series_info.platform) + "\t" +
-                                    str(gse_info.series_info.title) + "\t" +  # str(gse_info.series_info.Authors) + "\t" +
-                                    str(gse_info.series_info.sub_date) + "\t" + str(
-                gse_info.series_info.Summary) + "\t" + link + "\t" + str(gse_info.PubMed_info.title) + "\t" + str(
-                gse_info.PubMed_info.journal) + "\t" +
-                                    str(gse_info.PubMed_info.impfact) + "\t" + str(gse_info.PubMed_info.doi) + "\t" +
-                                    str(
-                                        gse_info.PubMed_info.full_refs) + "\t" +
-                                    str(gse_info.gsm_info.Type_mol) + "\t" + str(
-                gse_info.series_info.BioProject) + "\t" +
-                                    str(gse_info.series_info.BioProj_EBI) + "\t" + str(
-                gse_info.series_info.SRA) + "\t" + all_prot + "\n")
+            row = table_row(gse_info)
+            table_writer.write_row(row)
+            if index is not None:
+                index.add(gse_info, row)
         else:
             print("error with table", file=sys.stderr)
 
 
-@click.command()
+def parse_shard(text):
+    """
+    Вход: строка из --shard вида i/N (i от 1 до N)
+    Выход: (i, N) или None, если строка кривая
+    """
+    try:
+        index, count = (int(x) for x in text.split("/"))
+    except ValueError:
+        return None
+    if count < 1 or not 1 <= index <= count:
+        return None
+    return index, count
+
+
+def shard_of(accession, count):
+    """
+    Вход: accession и кол-во шардов
+    Выход: номер шарда (от 1 до count) для этого accession
+    Берется md5, а не hash(): hash() строк солится заново в каждом процессе, а разбиение должно совпадать
+    на всех машинах и при любом перезапуске
+    """
+    return int.from_bytes(hashlib.md5(accession.encode()).digest()[:8], "big") % count + 1
+
+
+def shard_dir(output_dir, index, count):
+    return os.path.join(output_dir, "shard_" + str(index) + "_of_" + str(count))
+
+
+def open_tsv(path, mode='rb'):
+    """
+    Вход: путь до таблицы в любом tsv формате (.tsv, .tsv.gz, .tsv.zst) и режим (rb или wb)
+    Выход: бинарный поток, который (раз)жимает сам
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if not path.endswith(".zst"):
+        return open(path, mode)
+    raw = open(path, mode)
+    if mode == 'wb':
+        return zstd_stream(raw)
+    if hasattr(zstd, "ZstdFile"):
+        return zstd.ZstdFile(raw)
+    return io.BufferedReader(zstd.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True))
+
+
+def tsv_records(stream):
+    """
+    Вход: бинарный поток с tsv из TsvWriter
+    Выход: генератор записей как есть (bytes, вместе с переносом строки). Ячейка в кавычках может содержать
+    перенос строки, поэтому запись кончается только на строке, после которой кавычек четное число
+    """
+    record = b""
+    for line in stream:
+        record = record + line
+        if record.count(b'"') % 2 == 0:
+            yield record
+            record = b""
+    if record:
+        yield record
+
+
+def _accession_key(accession, ranks):
+    return ranks.get(accession, len(ranks)), accession
+
+
+def _record_key(record, ranks):
+    return _accession_key(record.split(b"\t", 1)[0].decode("utf-8"), ranks)
+
+
+def _natural_runs(path, keys):
+    """
+    Вход: таблица и ключи ее строк по порядку
+    Выход: лист упорядоченных серий (path, номер первой строки, кол-во строк)
+    """
+    runs = []
+    start = length = 0
+    last = None
+    for key in keys:
+        if last is not None and key < last:
+            runs.append((path, start, length))
+            start, length = start + length, 0
+        last = key
+        length = length + 1
+    if length > 0:
+        runs.append((path, start, length))
+    return runs
+
+
+def _run_records(path, start, length):
+    # одна упорядоченная серия строк шарда: пропускаем шапку и то, что до нее
+    with open_tsv(path) as stream:
+        records = tsv_records(stream)
+        for _ in range(start + 1):
+            next(records)
+        for _ in range(length):
+            yield next(records)
+
+
+def merge_tables(paths, ranks, out_path):
+    """
+    Вход: таблицы шардов, словарь accession -> место во входном листе и куда писать
+    Выход: кол-во записанных строк
+    k-way merge: в памяти только по одной строке из каждой серии. Внутри шарда строки идут в порядке входного
+    листа, кроме повторов из --retry_failed (они дописаны в конце), так что каждый шард режется на
+    упорядоченные серии (первый проход только считает их длины), и сливаются уже все серии.
+    Строки переносятся байт в байт, без разбора csv
+    """
+    runs = []
+    header = None
+    for path in paths:
+        with open_tsv(path) as stream:
+            records = tsv_records(stream)
+            first = next(records, None)
+            if header is None:
+                header = first
+            runs.extend(_natural_runs(path, (_record_key(record, ranks) for record in records)))
+    rows = 0
+    with open_tsv(out_path, 'wb') as out:
+        if header is not None:
+            out.write(header)
+        for record in heapq.merge(*(_run_records(*run) for run in runs), key=lambda r: _record_key(r, ranks)):
+            out.write(record)
+            rows = rows + 1
+    return rows
+
+
+def arrow_batches(path):
+    """
+    Вход: таблица в parquet или Arrow IPC (из ArrowTableWriter)
+    Выход: генератор RecordBatch по порядку строк, в памяти только текущий
+    """
+    if path.endswith(".parquet"):
+        yield from pyarrow_parquet.ParquetFile(path).iter_batches()
+        return
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
+
+
+def _arrow_run_rows(path, start, length):
+    # то же, что _run_records, но для parquet/arrow: строки - листы значений в порядке TABLE_COLUMNS
+    for batch in arrow_batches(path):
+        if start >= batch.num_rows:
+            start = start - batch.num_rows
+            continue
+        batch = batch.slice(start, min(length, batch.num_rows - start))
+        start = 0
+        for row in zip(*(column.to_pylist() for column in batch.columns)):
+            yield list(row)
+        length = length - batch.num_rows
+        if length <= 0:
+            return
+
+
+def merge_arrow_tables(paths, ranks, out_path, fmt, row_group=10000):
+    """
+    Вход: таблицы шардов в parquet или arrow, словарь accession -> место во входном листе, куда писать и формат
+    Выход: кол-во записанных строк
+    Как merge_tables, только строки читаются пачками (RecordBatch) и пишутся через ArrowTableWriter
+    """
+    runs = []
+    for path in paths:
+        keys = (_accession_key(accession, ranks) for batch in arrow_batches(path)
+                for accession in batch.column(0).to_pylist())
+        runs.extend(_natural_runs(path, keys))
+    rows = 0
+    writer = ArrowTableWriter(out_path, fmt, row_group)
+    for row in heapq.merge(*(_arrow_run_rows(*run) for run in runs), key=lambda r: _accession_key(r[0], ranks)):
+        writer.write_row(row)
+        rows = rows + 1
+    writer.close()
+    return rows
+
+
+def merge_table_term(paths, out_path):
+    """
+    Вход: table_term.tsv шардов и куда писать
+    Выход: True, если у шардов одинаковые результаты поиска
+    Каждый шард ищет по тем же запросам (или берет общий поиск из --mode1), поэтому таблицы должны совпадать.
+    Если поиск шел в разное время и числа разошлись, берется максимум по каждому запросу
+    """
+    rows = {}  # (заголовок раздела, запрос) -> кол-во, в порядке первого шарда
+    same = True
+    for path in paths:
+        section = None
+        seen = set()
+        with open(path, 'r') as table_term:
+            for line in table_term:
+                term, _, count = line.rstrip("\n").rpartition("\t")
+                if term == "term":
+                    section = line
+                    rows.setdefault((section, None), None)
+                    continue
+                key = (section, term)
+                seen.add(key)
+                if key in rows and rows[key] != count:
+                    same = False
+                    if count.isdigit() and rows[key].isdigit():
+                        count = str(max(int(count), int(rows[key])))
+                rows[key] = count
+        same = same and seen == {key for key in rows if key[1] is not None}
+    with open(out_path, 'w') as out:
+        for (section, term), count in rows.items():
+            out.write(section if term is None else term + "\t" + count + "\n")
+    return same
+
+
+@click.group(invoke_without_command=True)
 @click.option('--input_file', '-i', default="input_terms.txt", show_default=True, help="название файла для входа")
 @click.option('--output', '-o', default="argeos_output", show_default=True,
               help="название директории с результатом")
 @click.option('--verbose', '-v', is_flag=True, help="Более подробные сообщения во время работы")
 @click.option('--text_out', '-t', is_flag=True, help="Добавит к выдаче текствый файл")
+@click.option('--format', 'output_format', type=click.Choice(list(TABLE_FORMATS)), default="tsv", show_default=True,
+              help="Формат таблицы: tsv, сжатый tsv (gzip/zstd) или колоночный parquet/arrow (нужен pyarrow)")
+@click.option('--row_group_size', default=10000, show_default=True,
+              help="Сколько строк копить перед записью группы в parquet/arrow")
 @click.option('--unique', '-u', is_flag=True, help="Не разбивать строки на уникальные (по типу и организмам)")
 @click.option('--cell_size', '-l', default=50000, show_default=True,
               help="Ограничение ячейки для таблицы, для корректной вставики в Exel/Google sheets. "
                    "0 если нет ограничений")
+@click.option('--resume', is_flag=True,
+              help="Продолжить прерванный запуск: пропустить ID из checkpoint_argeos.jsonl и дописать выдачу")
+@click.option('--incremental', is_flag=True,
+              help="Анализировать только ID, которых не было в прошлом input_GSE.txt/input_ArEx.txt, "
+                   "и дописать их к выдаче")
+@click.option('--delta', is_flag=True,
+              help="Искать только записи, вышедшие или измененные после прошлого поиска по тому же запросу "
+                   "(даты в search_state.json), и анализировать только их")
+@click.option('--datetype', type=click.Choice(["mdat", "pdat"]), default="mdat", show_default=True,
+              help="По какой дате искать в режиме --delta: mdat - изменения, pdat - публикации")
 @click.option('--chunk_size', '-c', default=3, show_default=True,
-              help=str("Переменная, определяющая величину пакета для скачивания. Если больше - меньше сеансов связи, " +
-                       "больше занимаемого места tmp директорией (и наоборот)"))
+              help=str("Переменная, определяющая величину пакета для запросов в PubMed. Если больше - меньше " +
+                       "сеансов связи, больше датасетов одновременно в памяти (и наоборот)"))
+@click.option('--workers', '-w', default=4, show_default=True,
+              help="Сколько потоков одновременно скачивают архивы с GEO")
+@click.option('--ae_workers', default=8, show_default=True,
+              help="Сколько потоков одновременно запрашивают записи и протоколы ArrayExpress")
+@click.option('--search_workers', default=3, show_default=True,
+              help="Сколько запросов esearch к GEO идут одновременно (частота запросов все равно ограничена NCBI)")
+@click.option('--block_size', default=1024 * 1024, show_default=True,
+              help="Размер блока (в байтах) при скачивании архивов с GEO")
+@click.option('--parser', 'parser_engine', type=click.Choice(["soup", "iter"]), default="soup", show_default=True,
+              help="Парсер для MINiML: soup - BeautifulSoup, iter - потоковый iterparse (меньше памяти, быстрее)")
+@click.option('--parse_workers', default=max(1, (os.cpu_count() or 2) - 1), show_default=True,
+              help="Сколько процессов разбирают XML (0 - разбирать прямо в потоках скачивания)")
+@click.option('--queue_depth', default=16, show_default=True,
+              help="Сколько датасетов одновременно может находиться в конвейере (очереди между стадиями)")
+@click.option('--low_memory', is_flag=True,
+              help="Для огромных серий (десятки тысяч сэмплов): потоковый парсер iter вместо супа, а _family.xml "
+                   "ждет разбора во временном файле, а не в памяти. Вместе с --value_cap")
+@click.option('--value_cap', default=None,
+              help="Сколько разных значений оставлять в полях сэмплов (Characteristics, Cell type и т.д.), остальные "
+                   "только считаются (\"…and N more distinct values\"). Число для всех полей или поле=число через "
+                   "запятую: " + ", ".join(GsmCollector.fields))
+@click.option('--fuzzy_if', is_flag=True,
+              help="Если журнал не нашелся в таблице импакт-факторов, искать самое похожее название")
+@click.option('--api_key', default=None, help="NCBI API ключ (до 10 запросов в секунду вместо 3)")
+@click.option('--pubmed_batch', default=200, show_default=True,
+              help="Сколько PMID отправлять в PubMed за один запрос (не больше 500)")
+@click.option('--keep_tmp', is_flag=True,
+              help="Отладка: сохранять скачанные архивы в argeos_tmp (по умолчанию на диск ничего не пишется)")
+@click.option('--cache_dir', default=None,
+              help="Директория для локального кэша скачанных файлов GEO/ArrayExpress (если не задана - кэша нет)")
+@click.option('--cache_max_size', default=5120, show_default=True, help="Максимальный размер кэша, МБ")
+@click.option('--cache_ttl', default=24.0, show_default=True,
+              help="Сколько часов запись в кэше считается свежей (без проверки на сервере)")
+@click.option('--cache_max_age', default=90.0, show_default=True,
+              help="Через сколько дней без проверки запись удаляется из кэша")
+@click.option('--search_ttl', default=0.0, show_default=True,
+              help="Сколько часов результаты поиска в кэше (--cache_dir) считаются свежими: по запросу, по которому "
+                   "недавно искали, сервер не спрашивается (0 - всегда искать заново)")
+@click.option('--pubmed_max_age', default=0.0, show_default=True,
+              help="Через сколько дней ответы PubMed в кэше считаются устаревшими (0 - никогда)")
+@click.option('--prewarm', default=None,
+              help="Файл со списком PMID (по одному на строке): заранее скачать их в кэш PubMed")
+@click.option('--offline', is_flag=True, help="Работать только с кэшем, ничего не скачивать (нужен --cache_dir)")
+@click.option('--timeout', default=120.0, show_default=True,
+              help="Сколько секунд ждать данных от сервера, прежде чем считать соединение зависшим")
+@click.option('--retries', default=5, show_default=True,
+              help="Сколько раз повторять запрос после временной ошибки сети (обрыв, таймаут, 429, 5xx)")
+@click.option('--retry_failed', default=1, show_default=True,
+              help="Сколько раз в конце запуска заново пробовать ID, которые не скачались из-за сети")
+@click.option('--shard', default=None,
+              help="i/N: обработать только свою часть ID (i от 1 до N, разбиение по хэшу accession), выдача - "
+                   "в <output>/shard_i_of_N. Шарды запускаются независимо (на разных ядрах или машинах) и "
+                   "собираются командой merge")
+@click.option('--samples', 'samples_format', type=click.Choice(list(SAMPLE_FORMATS)), default=None,
+              help="Дополнительно записать длинную таблицу по сэмплам GEO (output_samples + словарь samples_vocab): "
+                   "GSM, канал, source, cell type, molecule и каждая пара tag/value из Characteristics")
+@click.option('--index', 'build_index', is_flag=True,
+              help="Построить полнотекстовый индекс argeos_index.sqlite по выдаче (поиск: команда query)")
+@click.option('--prometheus', default=None,
+              help="Дополнительно записать метрики запуска (как в run_report.json) в этот файл в формате Prometheus")
 @click.option('--mode1', is_flag=True, help="Только поиск, без анализа данных")
 @click.option('--mode2', is_flag=True, help="Только анализ, без поиска (входной файл input_GSE.txt)")
-def main(input_file, output, text_out, chunk_size, mode1, mode2, verbose, unique, cell_size):
+def main(input_file, output, text_out, output_format, row_group_size, resume, incremental, delta, datetype, chunk_size,
+         mode1, mode2, verbose, unique, cell_size, workers, ae_workers, search_workers, block_size, parser_engine,
+         parse_workers, queue_depth, low_memory, value_cap, fuzzy_if, api_key, pubmed_batch, keep_tmp, cache_dir,
+         cache_max_size, cache_ttl, cache_max_age, search_ttl, pubmed_max_age, prewarm, offline, timeout, retries,
+         retry_failed, shard, samples_format, build_index, prometheus):
     """
     Программа разработанна для аннатоирования результатов поиска в базах данных GEO и ArrayExpress. На вход программа
     принимает один или нескольуо поисковых запросов, записанных на разных строках. На выходе, в output ректории
     получаются две таблицы:
     количество находок для каждого запроса и базы данных (table_term.tsv);
     таблица с подробной информацией по каждой находке;
-    два файла со списком найденных ID
+    два файла со списком найденных ID;
+    отчет о запуске run_report.json (время по стадиям, объем скачанного, ошибки)
 
     Рекомендации по созданию запросов: ключевые слова писать через пробел и AND. Если нужно добавить оргнаизм, то
     добавить "|" в начале и "[ORGN]" в конце. Пример: lung AND macrophages | Rattus norvegicus[ORGN]
     """
     # -----------!!!! НАЧАЛО ОСНОВНОГО КОДА !!!!------------
+    ctx = click.get_current_context()
+    if ctx.invoked_subcommand is not None:
+        # вызвана команда (query, merge), основной код не нужен. Из общих опций ей передается только --output
+        # (argeos -o DIR merge), остальные к командам не относятся - лучше ошибка, чем тихо их не заметить
+        given = [param.opts[0] for param in ctx.command.params if param.name != "output" and
+                 ctx.get_parameter_source(param.name) == click.core.ParameterSource.COMMANDLINE]
+        if given:
+            raise click.UsageError(", ".join(given) + " cannot be used with the " + ctx.invoked_subcommand +
+                                   " command")
+        if ctx.get_parameter_source("output") == click.core.ParameterSource.COMMANDLINE:
+            ctx.obj = {"output": output}
+        return
     # проверка что оба мода не вызваны одновременно
-    global Cell_size_for_tsv
+    global Cell_size_for_tsv, Download_workers, AE_workers, Search_workers, Block_size, Parser_engine, Keep_tmp
+    global Api_key, Pubmed_batch, Pubmed_cache, Fuzzy_if, Local_cache, Offline, Net_timeout, Net_retries, Sample_rows
+    global Value_caps, Low_memory, Search_cache
     Cell_size_for_tsv = cell_size
+    Download_workers = workers
+    AE_workers = ae_workers
+    Search_workers = search_workers
+    Block_size = block_size
+    Parser_engine = "iter" if low_memory else parser_engine  # суп держит в памяти весь файл целиком
+    Low_memory = low_memory
+    Keep_tmp = keep_tmp
+    Api_key = api_key
+    Fuzzy_if = fuzzy_if
+    Run_metrics.reset()
+    Pubmed_batch = pubmed_batch
+    Net_timeout = (min(10.0, timeout), timeout)
+    Net_retries = retries
+    Sample_rows = samples_format is not None
     maxterms = 1000000  # формально нужно оганичение, но по факту смотрю все
     if verbose:
         global VerboseG
         VerboseG = True  # переключаем глобальную переменную флажком, сделанно для удобства написания кода
     if mode1 and mode2:
         return print("Error! Can not call mode1 and mode2 in same time!", file=sys.stderr)
+    if offline and cache_dir is None:
+        return print("Error! --offline works only with --cache_dir", file=sys.stderr)
+    if resume and (output_format in ("parquet", "arrow") or samples_format == "parquet"):
+        return print("Error! --resume works only with tsv formats", file=sys.stderr)
+    if incremental and mode2:
+        return print("Error! --incremental needs a new search (can not be used with --mode2)", file=sys.stderr)
+    if delta and mode2:
+        return print("Error! --delta needs a new search (can not be used with --mode2)", file=sys.stderr)
+    Value_caps = {}
+    if value_cap is not None:
+        Value_caps = parse_caps(value_cap)
+        if Value_caps is None:
+            return print("Error! --value_cap must be N or field=N pairs (" + ", ".join(GsmCollector.fields) + ")",
+                         file=sys.stderr)
+    if shard is not None:
+        shard = parse_shard(shard)
+        if shard is None:
+            return print("Error! --shard must be i/N with 1 <= i <= N, for example 2/8", file=sys.stderr)
+    if output_format in ("parquet", "arrow", "tsv.zst"):
+        # не обязательные пакеты проверяю сразу, а не после поиска и скачивания
+        package = zstd if output_format == "tsv.zst" else pyarrow
+        try:
+            package._load()
+        except ImportError:
+            return print("Error! --format " + output_format + " needs " +
+                         ("zstandard" if output_format == "tsv.zst" else "pyarrow") + " package", file=sys.stderr)
+    if samples_format == "parquet":
+        try:
+            pyarrow._load()
+        except ImportError:
+            return print("Error! --samples parquet needs pyarrow package", file=sys.stderr)
+    Offline = offline
+    if cache_dir is not None:
+        Local_cache = LocalCache(os.path.join(dirname, cache_dir), cache_max_size * 1024 * 1024,
+                                 cache_ttl * 3600, cache_max_age * 86400)
+        Pubmed_cache = PubMedCache(os.path.join(dirname, cache_dir, "pubmed.sqlite"), pubmed_max_age * 86400)
+        Search_cache = SearchCache(os.path.join(dirname, cache_dir, "search.sqlite"), search_ttl * 3600)
+    if prewarm is not None:
+        if Pubmed_cache is None:
+            return print("Error! --prewarm works only with --cache_dir", file=sys.stderr)
+        with open(os.path.join(dirname, prewarm), 'r') as prewarm_file:
+            prewarm_ids = [int(x) for x in prewarm_file.read().split() if x.strip().isdigit()]
+        print("Prewarming PubMed cache: " + str(len(prewarm_ids)) + " PMIDs", file=sys.stderr)
+        get_pubmed_client().summaries(prewarm_ids)
     output_dir = os.path.join(dirname, output)
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)  # проверяю наличие output директории, если ее нет то создаю
+    shared_search = False
+    if shard is not None:
+        # у шарда все свое (выдача, журнал, ошибки, отчет) в поддиректории, общий только результат поиска:
+        # если в output уже есть списки ID (например, после --mode1), шард берет их, а не ищет заново
+        parent_dir = output_dir
+        output_dir = shard_dir(parent_dir, *shard)
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+        for name in ("input_GSE.txt", "input_ArEx.txt", "table_term.tsv", "delta_input_GSE.txt",
+                     "delta_input_ArEx.txt"):
+            if os.path.exists(os.path.join(parent_dir, name)) and not os.path.exists(os.path.join(output_dir, name)):
+                shutil.copy(os.path.join(parent_dir, name), output_dir)
+                shared_search = True
     # Блок инициации работы
-    if (mode1 and not mode2) or (not mode1 and not mode2):
+    previous_ids = OrderedSet()  # что было найдено в прошлый раз (для --incremental)
+    if incremental:
+        for name in ("input_GSE.txt", "input_ArEx.txt"):
+            if os.path.exists(os.path.join(output_dir, name)):
+                with open(os.path.join(output_dir, name), 'r') as previous:
+                    previous_ids.update(x.strip() for x in previous)
+    # в режиме --delta анализируются только новые и измененные записи из delta_input_*.txt (см. save_search_result)
+    list_prefix = "delta_" if delta else ""
+    if resume and os.path.exists(os.path.join(output_dir, list_prefix + "input_GSE.txt")) and not mode2:
+        # при продолжении поиск не повторяю: берем те же ID, что были в прерванном запуске
+        print("Resuming: search results are taken from the previous run", file=sys.stderr)
+    elif shared_search and not mode2:
+        print("Shard: search results are taken from " + parent_dir, file=sys.stderr)
+    elif (mode1 and not mode2) or (not mode1 and not mode2):
+        state = SearchState(os.path.join(output_dir, "search_state.json"), datetype) if delta else None
         print("Starting systematic search", file=sys.stderr)
-        print("GEO search", file=sys.stderr)
-        sist_search(input_file, maxterms, output_dir)  # Производим запросы, генерим файл input_GSE.txt
-        print("ArrayExpress search", file=sys.stderr)
-        arex_search(input_file, output_dir)
+        try:
+            print("GEO search", file=sys.stderr)
+            sist_search(input_file, maxterms, output_dir, state)  # Производим запросы, генерим файл input_GSE.txt
+            print("ArrayExpress search", file=sys.stderr)
+            arex_search(input_file, output_dir, state)
+        except QuerySyntaxError as e:
+            return print("Error! Bad query in " + input_file + ": " + str(e), file=sys.stderr)
+        finally:
+            if Search_cache is not None:
+                Search_cache.close()  # дальше поиска нет
+                Search_cache = None
+        if state is not None:
+            state.save()  # даты сохраняю только если оба поиска прошли
         print("End of systematic search", file=sys.stderr)
+        if mode1 and _ae_client is not None:
+            _ae_client.close()  # дальше анализа не будет, а в основном режиме клиент еще нужен
     main_true = (not mode1 and mode2) or (not mode1 and not mode2)
     if main_true:
         print("Starting main analysis", file=sys.stderr)
@@ -969,149 +4087,318 @@ def main(input_file, output, text_out, chunk_size, mode1, mode2, verbose, unique
         if mode2 and input_file != "input_terms.txt":
             input_GSE_name = os.path.join(dirname, input_file)
         else:
-            input_GSE_name = os.path.join(output_dir, "input_GSE.txt")
+            input_GSE_name = os.path.join(output_dir, list_prefix + "input_GSE.txt")
         # открываем файл на чтение, считываем ID
         with open(input_GSE_name, 'r') as input_GSE:
             gse_list = input_GSE.readlines()
         # "чистим" названия, удаляя скрытый символ переноса строк
         gse_list = [x.strip() for x in gse_list]
         # тоже и для листа ArreyExpress
-        with open(os.path.join(output_dir, "input_ArEx.txt"), 'r') as input_arex:
+        with open(os.path.join(output_dir, list_prefix + "input_ArEx.txt"), 'r') as input_arex:
             arex_list = input_arex.readlines()
         arex_list = [x.strip() for x in arex_list]
+        if shard is not None:
+            # шард берет только свои ID, а их места во входном листе запоминает для merge (shard_ids.txt)
+            positions = list(enumerate(gse_list + arex_list))
+            gse_list = [x for x in gse_list if shard_of(x, shard[1]) == shard[0]]
+            arex_list = [x for x in arex_list if shard_of(x, shard[1]) == shard[0]]
+            with open(os.path.join(output_dir, "shard_ids.txt"), 'w') as shard_ids:
+                for position, id in positions:
+                    if shard_of(id, shard[1]) == shard[0]:
+                        shard_ids.write(str(position) + "\t" + id + "\n")
+            print("Shard " + str(shard[0]) + "/" + str(shard[1]) + ": " + str(len(gse_list) + len(arex_list)) +
+                  " of " + str(len(positions)) + " IDs", file=sys.stderr)
 
         # Для удобства ввел переменную, чтоб оформление кусков не отличалось от text_out
         tab_out = True
 
+        # При --resume и --incremental файлы дописываются, а уже записанные ID пропускаются (см. CheckpointJournal)
+        append = resume or incremental
+        journal = CheckpointJournal(os.path.join(output_dir, "checkpoint_argeos.jsonl"), append)
+        journal.truncate_outputs({"table": table_path(output_dir, output_format),
+                                  "text": os.path.join(output_dir, "output_argeos.txt"),
+                                  "errors": os.path.join(output_dir, "errors_argeos.txt"),
+                                  "samples": sample_paths(output_dir, "tsv")[0],
+                                  "samples_vocab": sample_paths(output_dir, "tsv")[1]})
+        skip_ids = OrderedSet(journal.done)
+        skip_ids.update(previous_ids)
+        if len(skip_ids) > 0:
+            total = len(gse_list) + len(arex_list)
+            gse_list = [x for x in gse_list if x not in skip_ids]
+            arex_list = [x for x in arex_list if x not in skip_ids]
+            print("Skipping " + str(total - len(gse_list) - len(arex_list)) + " IDs done in previous runs",
+                  file=sys.stderr)
+
         # Открываю файлы в соответсвии с флагами + сразу записываю шапки, если они нужны
         if tab_out:
-            output_table = open(os.path.join(output_dir, "output_argeos.tsv"), 'w', encoding='utf-8')
-            # Записываем шапку в таблицу
-            output_table.write("Accession" + "\t" + "Organism" + "\t" + "Samples" + "\t" + "Type" + "\t" +
-                               "Platform" + "\t" + "Title" +  # "\t" +"Authors" +
-                               "\t" + "Year" + "\t" + "Summary" + "\t" + "Link" + "\t" + "Paper_title" + "\t" +
-                               "Journal" + "\t" + "Impact factor 2018" + "\t" + "doi or pubmed id" + "\t" +
-                               "All references" + "\t" + "Type of molecule" + "\t" + "BioProject link (NCBI)" +
-                               "\t" + "BioProject link (EBI)" + "\t" + "SRA" + "\t" + "All protocols" + "\n")
+            # шапка (колонки TABLE_COLUMNS) записывается сразу при открытии
+            output_table = open_table_writer(output_dir, output_format, row_group_size, append)
         if text_out:
-            output_file = open(os.path.join(output_dir, "output_argeos.txt"), 'w', encoding='utf-8')
-        errors = open(os.path.join(output_dir, "errors_argeos.txt"), 'w', encoding='utf-8')
+            output_file = open(os.path.join(output_dir, "output_argeos.txt"), 'a' if append else 'w',
+                               encoding='utf-8')
+        search_index = SearchIndex(index_path(output_dir), append) if build_index else None
+        sample_writer = None
+        if samples_format is not None:
+            sample_writer = SampleWriter(output_dir, samples_format, row_group_size, append)
+        errors = LockedWriter(open(os.path.join(output_dir, "errors_argeos.txt"), 'a' if append else 'w',
+                                   encoding='utf-8'))
+
+        def checkpoint(records):
+            # пакет уже в файлах: запоминаю его accession и размеры файлов в журнале
+            offsets = {"table": output_table.commit(), "errors": errors.commit()}
+            if search_index is not None:
+                search_index.commit()
+            if sample_writer is not None:
+                offsets.update(sample_writer.commit())
+            if text_out:
+                output_file.flush()
+                offsets["text"] = output_file.tell()
+            journal.commit(OrderedSet(gse_info.series_info.GSE for gse_info in records), offsets)
+            Run_metrics.inc("records_written_total", len(records))
+
+        if journal.offsets is None:
+            # размеры сразу после шапок: если упадем на первом же пакете, --resume обрежет файлы до них
+            checkpoint([])
 
     # ---!! Начало ЦИКЛА!!---
     if main_true:
-        # БЛОК GEO
-        print("GEO datasets:", file=sys.stderr)
         # разбиваем наш лист на множество мелких
-        gse_list_withou_bad = [y for y in gse_list if y not in Bad_IDs]
-        gse_mega_list = chunks(gse_list_withou_bad, chunk_size)
-        for listochek in tqdm(gse_mega_list):
-            # БЛОК СКАЧИВАНИЯ ФАЙЛА
-            # В начале я скачиваю пакет из нескольких листов, а потом уже спокойно прохожусь по этим файлам,
-            # т.к. они уже на серваке (на компе) в tmp-шной папке
-            # создание/стирание tmp директории
+        bad_ids = get_bad_ids()
+        gse_list_withou_bad = [y for y in gse_list if y not in bad_ids]
+        if Keep_tmp:
+            # в отладочном режиме скачанные архивы складываются в tmp директорию и не удаляются в конце
             try:
                 shutil.rmtree(tmp_dir)  # если директория была до этого, то стираю ее
             except Exception:
                 pass
             os.mkdir(tmp_dir)  # создаю заведомо  пустую директорию
-            listochek = xml_by_id(listochek, errors)  # скачиваю файлы
-            gse_list = []
-            pubmed_id_list = []
-            for GSE in listochek:
-                # ! Блок АНАЛИЗА ФАЙЛА
-                # парсю .xml файл, получаю всю инфу в лист
-                if VerboseG:
-                    print("working with " + GSE, file=sys.stderr)
-                try:
-                    gse_info = geo_xml_parser(os.path.join(tmp_dir, str(GSE + "_family.xml")))
-                except Exception:
-                    gse_info = GseInfo()
-                    errors.write("error was (bad XML file) " + str(GSE) + "\n")
-                gse_list.append(gse_info)
-                if gse_info.PubMed_info.pbid is not None:
-                    for pbid in gse_info.PubMed_info.pbid:
-                        pubmed_id_list.append(pbid)
-            gse_list = pubmed_parser(gse_list, pubmed_id_list,
-                                     errors)  # произвожу анализ pubmed данных, обновляю лист этой инфой
-
-            # ! Блок c разбиением на несколько строк
-            if not unique:
-                gse_list = split_to_unique(gse_list)
-            # ! Блок записи результата
-            if tab_out:
-                table_output(gse_list, output_table)
-            if text_out:
-                text_output(gse_list, output_file)
-        # БЛОК ArreyExpress
-        chunk_size_lockal = 1  # Пока выключаю проход по кускам, будем индивидуально проходить
-        # (иначе есть баг с записью в лист :( )
-        ae_mega_list = chunks(arex_list, chunk_size_lockal)
-        # Тут какая-та очень странная ошибка, вроде обращение к одному элементу.
-        # Короче прохожусь по листу, а всесь лист получается заполнен копией последней переменной
-        # пробовал deepcopy (даже функцию свою написал, для своего класса), но все равно не работает :(
-        print("End of GEO. Starting ArrayExpress", file=sys.stderr)
-        for listochek in tqdm(ae_mega_list):
-            try:
-                shutil.rmtree(tmp_dir)  # если директория была до этого, то стираю ее
-            except Exception:
-                pass
-            os.mkdir(tmp_dir)  # создаю заведомо пустую tmp директорию
-
-            pubmed_title_list = []
-            ae_list = []
-            # i = 0
-            for aeid in listochek:
-                ae_mega = array_express(aeid)
-                ae_list.append(mydeepcopy(ae_mega))
-                # ae_list.append(array_express(aeid))
-                # i = i + 1
-                if type(ae_mega.PubMed_info.title) == list:
-                    for pbtit in ae_mega.PubMed_info.title:
-                        pubmed_title_list.append(pbtit)
-            if len(pubmed_title_list) > 0:
-                tit_res = pbid_by_title(pubmed_title_list)
-                tit_dict = tit_res[0]
-                pb_id_list_ae = tit_res[1]
-                # преобразование по словарю:
-                for aesh in ae_list:
-                    if type(aesh.PubMed_info.title) == list:
-                        aesh.PubMed_info.pbid = []
-                        all_fails = True
-                        some_fails = False
-                        for lt in aesh.PubMed_info.title:
-                            pid = tit_dict.get(lt.strip("."))
-                            if pid is not None:
-                                aesh.PubMed_info.pbid.append(pid)
-                                all_fails = False
-                            else:
-                                some_fails = True
-                        if all_fails and some_fails:
-                            aesh.PubMed_info.pbid = None
-                ae_list = pubmed_parser(ae_list, pb_id_list_ae, errors)
-
-            # ! Блок записи результата
-            if tab_out:
-                table_output(ae_list, output_table)
-            if text_out:
-                text_output(ae_list, output_file)
+        geo_ids = gse_list_withou_bad
+        ae_ids = arex_list
+        # Первый проход - по всем ID, следующие (--retry_failed) - только по тем, что попали в Error_List
+        # из-за сети (битые файлы и т.п. не повторяются)
+        for retry_round in range(retry_failed + 1):
+            if retry_round > 0:
+                if len(Error_List) == 0:
+                    break
+                failed = list(OrderedSet(Error_List))
+                Error_List.clear()
+                geo_ids = [x for x in failed if x.startswith("GSE")]
+                ae_ids = [x for x in failed if not x.startswith("GSE")]
+                with _breakers_lock:
+                    _breakers.clear()  # предохранители с прошлого прохода не в счет
+                print("Retrying " + str(len(failed)) + " failed IDs (round " + str(retry_round) + ")",
+                      file=sys.stderr)
+                errors.write("retry round " + str(retry_round) + ": " + str(len(failed)) + " IDs\n")
+            # БЛОК GEO
+            print("GEO datasets:", file=sys.stderr)
+            # Скачивание, разбор, PubMed и запись идут конвейером (см. GeoPipeline): пока пишется один пакет,
+            # следующие уже качаются и разбираются. Архивы не распаковываются на диск, битые файлы пишутся в errors
+            pipeline = GeoPipeline(get_geo_downloader(), parse_workers, queue_depth, chunk_size, not unique, errors)
+            for gse_list in pipeline.run(geo_ids):
+                # ! Блок записи результата
+                if tab_out:
+                    table_output(gse_list, output_table, search_index)
+                if text_out:
+                    text_output(gse_list, output_file)
+                if sample_writer is not None:
+                    sample_writer.write(gse_list)
+                checkpoint(gse_list)
+            # БЛОК ArreyExpress
+            # Записи качаются параллельно (get_ae_client), а сюда приходят пакетами по chunk_size в исходном порядке.
+            # Раньше тут был chunk_size = 1 из-за общих на все записи подклассов GseInfo (теперь они свои у каждой)
+            print("End of GEO. Starting ArrayExpress", file=sys.stderr)
+            for ae_list in get_ae_client().run(ae_ids, chunk_size, errors):
+                pubmed_title_list = []
+                for ae_mega in ae_list:
+                    if type(ae_mega.PubMed_info.title) == list:
+                        for pbtit in ae_mega.PubMed_info.title:
+                            pubmed_title_list.append(pbtit)
+                if len(pubmed_title_list) > 0:
+                    tit_res = pbid_by_title(pubmed_title_list)
+                    tit_dict = tit_res[0]
+                    pb_id_list_ae = tit_res[1]
+                    # преобразование по словарю:
+                    for aesh in ae_list:
+                        if type(aesh.PubMed_info.title) == list:
+                            aesh.PubMed_info.pbid = []
+                            all_fails = True
+                            some_fails = False
+                            for lt in aesh.PubMed_info.title:
+                                pid = tit_dict.get(lt.strip("."))
+                                if pid is not None:
+                                    aesh.PubMed_info.pbid.append(pid)
+                                    all_fails = False
+                                else:
+                                    some_fails = True
+                            if all_fails and some_fails:
+                                aesh.PubMed_info.pbid = None
+                    ae_list = pubmed_parser(ae_list, pb_id_list_ae, errors)
+
+                # ! Блок записи результата
+                if tab_out:
+                    table_output(ae_list, output_table, search_index)
+                if text_out:
+                    text_output(ae_list, output_file)
+                checkpoint(ae_list)
 
     # ---!! КОНЕЦ ЦИКЛА !!---
 
     # Блок терминации работы
-    # Закрываю файлы на запись, удаляю tmp директорию
+    # Закрываю файлы на запись
     if main_true:
+        if _geo_downloader is not None:
+            _geo_downloader.close()
+        if _ae_client is not None:
+            _ae_client.close()
+        if Local_cache is not None:
+            Local_cache.evict()
+            Local_cache.close()
+        if _impact_index is not None and len(_impact_index.unresolved) > 0:
+            # вместо строчки "new jurs!" на каждый пакет - один отчет в конце
+            _impact_index.write_report(os.path.join(output_dir, "unresolved_journals.tsv"))
+            errors.write("new jurs! " + str(len(_impact_index.unresolved)) +
+                         " journals without impact factor, see unresolved_journals.tsv\n")
+        if Pubmed_cache is not None:
+            print("PubMed cache: " + str(Pubmed_cache.hits) + " hits, " + str(Pubmed_cache.misses) + " misses",
+                  file=sys.stderr)
+            Pubmed_cache.close()
+        if len(Error_List) > 0:
+            # то, что так и не скачалось: можно запустить снова (GSE - через --mode2 -i failed_ids.txt)
+            with open(os.path.join(output_dir, "failed_ids.txt"), 'w') as failed_file:
+                failed_file.write("\n".join(OrderedSet(Error_List)) + "\n")
+            print(str(len(OrderedSet(Error_List))) + " IDs failed, see failed_ids.txt", file=sys.stderr)
+        elif os.path.exists(os.path.join(output_dir, "failed_ids.txt")):
+            os.remove(os.path.join(output_dir, "failed_ids.txt"))  # остался от прошлого запуска
         errors.close()
+        journal.close()
         if tab_out:
             output_table.close()
         if text_out:
             output_file.close()
-        try:
-            shutil.rmtree(tmp_dir)  # удаление tmp директории
-        except Exception:
-            pass
+        if search_index is not None:
+            search_index.close()
+        if sample_writer is not None:
+            sample_writer.close()
         print("Work finished!", file=sys.stderr)
+    # Отчет о запуске: сколько времени ушло на каждую стадию, сколько скачано и т.д. (см. RunMetrics)
+    options = {k: v for k, v in click.get_current_context().params.items() if k != "api_key"}
+    Run_metrics.write_json(os.path.join(output_dir, "run_report.json"), options=options,
+                           failed_ids=list(Error_List))
+    if prometheus is not None:
+        Run_metrics.write_prometheus(os.path.join(dirname, prometheus))
     # Конец основного кода
 
 
+def command_output(output):
+    """
+    Вход: --output команды (query, merge)
+    Выход: директория: --output можно написать и перед именем команды (argeos -o DIR merge), см. main
+    """
+    ctx = click.get_current_context()
+    parent = (ctx.obj or {}).get("output")
+    if parent is None:
+        return output
+    if ctx.get_parameter_source("output") == click.core.ParameterSource.COMMANDLINE and output != parent:
+        raise click.UsageError("--output given twice: " + parent + " and " + output)
+    return parent
+
+
+@main.command("query")
+@click.argument('terms', nargs=-1, required=True)
+@click.option('--output', '-o', default="argeos_output", show_default=True,
+              help="директория с результатом (там лежит argeos_index.sqlite)")
+@click.option('--field', '-f', type=click.Choice(SearchIndex.fields), default=None,
+              help="Искать только в этой колонке")
+@click.option('--organism', default=None, help="Только записи с этим организмом (подстрока, без учета регистра)")
+@click.option('--limit', '-n', default=20, show_default=True, help="Сколько результатов показать")
+@click.option('--json', 'as_json', is_flag=True, help="Выдача в json (по строке на результат)")
+def query(terms, output, field, organism, limit, as_json):
+    """
+    Поиск по индексу выдачи (строится основным запуском с --index). Запрос - слова в синтаксисе SQLite FTS5:
+    macrophage AND lung, "alveolar macrophage", interfer*, NOT mouse, characteristics:IL6.
+    Лучшие совпадения первыми (bm25: совпадения в названии весят больше, чем в протоколах).
+    Пример: python Argeos_submit.py query -o argeos_output alveolar macrophage --organism "Homo sapiens"
+    """
+    path = index_path(os.path.join(dirname, command_output(output)))
+    if not os.path.exists(path):
+        return print("Error! No index " + path + " (run ARGEOS with --index first)", file=sys.stderr)
+    index = SearchIndex(path)
+    start = time.perf_counter()
+    found = index.search(" ".join(terms), field, organism, limit)
+    took = time.perf_counter() - start
+    index.close()
+    for hit in found:
+        if as_json:
+            print(json.dumps(hit, ensure_ascii=False))
+        else:
+            print("\t".join([hit["accession"], str(hit["score"]), str(hit["organism"]), str(hit["title"]),
+                             hit["snippet"].replace("\t", " ").replace("\n", " ")]))
+    print(str(len(found)) + " found in " + "%.1f" % (took * 1000) + " ms", file=sys.stderr)
+
+
+@main.command("merge")
+@click.option('--output', '-o', default="argeos_output", show_default=True,
+              help="директория, в которой лежат shard_i_of_N (туда же пишется общая выдача)")
+def merge(output):
+    """
+    Собирает выдачу шардов (запуски с --shard i/N) в одну: таблицу output_argeos (в любом формате --format) в
+    порядке входного листа, как будто был один запуск, и table_term.tsv. Строки сливаются потоково (в памяти
+    только списки ID), ошибки и failed_ids.txt шардов дописываются друг за другом.
+    Пример: python Argeos_submit.py merge -o argeos_output
+    """
+    output_dir = os.path.join(dirname, command_output(output))
+    found = {}
+    for name in (os.listdir(output_dir) if os.path.isdir(output_dir) else []):
+        match = re.fullmatch(r"shard_(\d+)_of_(\d+)", name)
+        if match is not None and os.path.isdir(os.path.join(output_dir, name)):
+            found.setdefault(int(match.group(2)), []).append(int(match.group(1)))
+    if len(found) != 1:
+        return print("Error! Expected shard_i_of_N directories of one N in " + output_dir + ", found: " +
+                     str(sorted(found)), file=sys.stderr)
+    count, indexes = found.popitem()
+    missing = sorted(set(range(1, count + 1)) - set(indexes))
+    if missing:
+        return print("Error! Missing shards " + ", ".join(map(str, missing)) + " of " + str(count), file=sys.stderr)
+    dirs = [shard_dir(output_dir, index, count) for index in range(1, count + 1)]
+    for path in dirs:
+        if not os.path.exists(os.path.join(path, "run_report.json")):
+            print("Warning! " + path + " has no run_report.json (the shard has not finished?)", file=sys.stderr)
+    ranks = {}  # accession -> место во входном листе
+    for path in dirs:
+        with open(os.path.join(path, "shard_ids.txt"), 'r') as shard_ids:
+            for line in shard_ids:
+                position, id = line.rstrip("\n").split("\t")
+                ranks.setdefault(id, int(position))
+    for fmt in TABLE_FORMATS:
+        paths = [table_path(path, fmt) for path in dirs]
+        present = [path for path in paths if os.path.exists(path)]
+        if not present:
+            continue
+        if len(present) < len(paths):
+            print("Warning! " + os.path.basename(paths[0]) + " is missing in shards " +
+                  ", ".join(str(index) for index, path in enumerate(paths, 1) if path not in present) +
+                  ", the merged table has only the other shards", file=sys.stderr)
+        if fmt in ("parquet", "arrow"):
+            rows = merge_arrow_tables(present, ranks, table_path(output_dir, fmt), fmt)
+        else:
+            rows = merge_tables(present, ranks, table_path(output_dir, fmt))
+        print(table_path(output_dir, fmt) + ": " + str(rows) + " rows", file=sys.stderr)
+    terms = [os.path.join(path, "table_term.tsv") for path in dirs]
+    terms = [path for path in terms if os.path.exists(path)]
+    if terms and not merge_table_term(terms, os.path.join(output_dir, "table_term.tsv")):
+        print("Warning! Shards have different search results, table_term.tsv has the maximum counts",
+              file=sys.stderr)
+    for name in ("errors_argeos.txt", "failed_ids.txt"):
+        parts = [os.path.join(path, name) for path in dirs if os.path.exists(os.path.join(path, name))]
+        if parts:
+            with open(os.path.join(output_dir, name), 'wb') as out:
+                for part in parts:
+                    with open(part, 'rb') as part_file:
+                        shutil.copyfileobj(part_file, out)
+        elif os.path.exists(os.path.join(output_dir, name)):
+            os.remove(os.path.join(output_dir, name))
+    print("Merged " + str(count) + " shards", file=sys.stderr)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+"""
+Бенчмарк сбора уникальных значений по сэмплам и фильтрации плохих ID.
+Генерирует синтетический MINiML с N сэмплами (у каждого свои Characteristics) и меряет время на один сэмпл:
+при дедупликации через OrderedSet оно не должно расти с N, при старой через лист - растет линейно.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_dedup.py
+    python benchmarks/bench_dedup.py --sizes 1000 5000 20000
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Argeos_submit as argeos  # noqa: E402
+
+NS = "http://www.ncbi.nlm.nih.gov/geo/info/MINiML"
+
+
+def make_miniml(samples):
+    """
+    Вход: кол-во сэмплов
+    Выход: bytes с MINiML одной серии, у каждого сэмпла уникальные Characteristics и Treatment
+    """
+    out = io.StringIO()
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<MINiML xmlns="%s">\n' % NS)
+    out.write('<Platform iid="GPL1"><Accession database="GEO">GPL1</Accession>'
+              '<Organism taxid="9606">Homo sapiens</Organism></Platform>\n')
+    for n in range(samples):
+        out.write('<Sample iid="GSM%d"><Accession database="GEO">GSM%d</Accession><Channel position="1">'
+                  '<Source>tissue %d</Source><Organism taxid="9606">Homo sapiens</Organism>'
+                  '<Characteristics tag="cell type">cell line %d</Characteristics>'
+                  '<Characteristics tag="donor">donor %d, long description of the sample</Characteristics>'
+                  '<Treatment-Protocol>treated for %d hours</Treatment-Protocol>'
+                  '<Growth-Protocol>standard medium</Growth-Protocol>'
+                  '<Molecule>total RNA</Molecule>'
+                  '<Extract-Protocol>TRIzol</Extract-Protocol>'
+                  '</Channel></Sample>\n' % (n, n, n, n, n, n))
+    out.write('<Series iid="GSE1"><Title>synthetic</Title><Accession database="GEO">GSE1</Accession>'
+              '<Pubmed-ID>1</Pubmed-ID><Summary>s</Summary><Overall-Design>d</Overall-Design>'
+              '<Type>Expression profiling by array</Type>'
+              '<Status><Submission-Date>2020-01-01</Submission-Date></Status></Series>\n')
+    out.write('</MINiML>\n')
+    return out.getvalue().encode()
+
+
+class ListCollector(argeos.GsmCollector):
+    """
+    Старая дедупликация через листы и "not in" - для сравнения
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.tr_list, self.gr_list, self.cell_types = [], [], []
+        self.tp_list, self.exp_list, self.char_list = [], [], []
+
+    def add_channel(self, treatment, growth, cells, mol_type, extprot, charact):
+        if treatment is not None:
+            self.treatment = treatment
+        if growth is not None:
+            self.growth = growth
+        for values, item in ((self.tr_list, self.treatment), (self.gr_list, self.growth),
+                             (self.cell_types, cells), (self.tp_list, mol_type),
+                             (self.exp_list, extprot), (self.char_list, charact)):
+            if item not in values:
+                values.append(item)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_parser(xml, collector_class):
+    saved = argeos.GsmCollector
+    argeos.GsmCollector = collector_class
+    try:
+        return timed(argeos.geo_xml_iterparser, io.BytesIO(xml))
+    finally:
+        argeos.GsmCollector = saved
+
+
+def bench_bad_ids(samples, bad_ids):
+    gse_list = ["GSE" + str(n) for n in range(samples)]
+    return timed(lambda: [y for y in gse_list if y not in bad_ids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[500, 1000, 2000, 5000, 10000])
+    parser.add_argument("--no-list", action="store_true", help="не мерять старую версию на листах")
+    args = parser.parse_args()
+
+    print("samples\tset us/sample\tlist us/sample\tbad_ids set us/id\tbad_ids list us/id")
+    for n in args.sizes:
+        xml = make_miniml(n)
+        new = bench_parser(xml, argeos.GsmCollector)
+        old = float("nan") if args.no_list else bench_parser(xml, ListCollector)
+        blocklist = ["GSE" + str(-i) for i in range(n)]  # ни один ID не совпадает - худший случай для листа
+        bad_set = bench_bad_ids(n, argeos.OrderedSet(blocklist))
+        bad_list = float("nan") if args.no_list else bench_bad_ids(n, blocklist)
+        print("%d\t%.1f\t%.1f\t%.3f\t%.3f" % (n, new / n * 1e6, old / n * 1e6, bad_set / n * 1e6, bad_list / n * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Бенчмарк записей GseInfo: память на N записей и время split_to_unique.
+Каждая синтетическая запись - два организма и два типа эксперимента, т.е. после разбиения из нее получается 4.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_records.py
+    python benchmarks/bench_records.py --records 50000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Argeos_submit as argeos  # noqa: E402
+
+
+def make_record(n):
+    gse = argeos.GseInfo()
+    gse.series_info.GSE = "GSE" + str(n)
+    gse.series_info.organism = "Homo sapiens; Mus musculus"
+    gse.series_info.Type = "Expression profiling by array; Expression profiling by high throughput sequencing"
+    gse.series_info.samples = 12
+    gse.series_info.platform = "GPL570; GPL1261"
+    gse.series_info.title = "Synthetic series number " + str(n)
+    gse.series_info.sub_date = "2020-01-01"
+    gse.series_info.Summary = "Summary of the synthetic series " + str(n) + ". " * 20
+    gse.series_info.Overall_design = "Design " + str(n)
+    gse.PubMed_info.pbid = [str(30000000 + n)]
+    gse.PubMed_info.title = "Paper " + str(n)
+    gse.PubMed_info.journal = "Nature"
+    gse.PubMed_info.impfact = "42.778"
+    gse.PubMed_info.doi = "10.1038/" + str(n)
+    gse.PubMed_info.full_refs = "['" + str(30000000 + n) + "']"
+    gse.gsm_info.Cell_type = "'cell line " + str(n) + "'"
+    gse.gsm_info.Characteristics = "'cell type: cell line " + str(n) + "; age: 42; '" * 5
+    gse.gsm_info.All_protocols = "[Overal design]Design " + str(n) + " [Treatment] None" * 10
+    return gse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--records", type=int, default=10000)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = [make_record(n) for n in range(args.records)]
+    build_time = time.perf_counter() - start
+    built_mem = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    split = argeos.split_to_unique(records)
+    split_time = time.perf_counter() - start
+    split_mem, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("records\t%d -> %d after split_to_unique" % (len(records), len(split)))
+    print("build\t%.3f s\t%.1f MB" % (build_time, built_mem / 2 ** 20))
+    print("split\t%.3f s\t+%.1f MB (peak %.1f MB)" % (split_time, (split_mem - built_mem) / 2 ** 20,
+                                                        peak_mem / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Фикстуры для бенчмарков: MINiML архивы GEO, XML ArrayExpress и json ответы E-utilities.
+Раскладываются по директории так же, как лежат на серверах, и отдаются локальным сервером (mock_server.py).
+
+По умолчанию фикстуры генерируются (детерминированно, одинаковые от запуска к запуску):
+    small  - серия на 4 сэмпла
+    median - серия на 24 сэмпла (примерно медиана по GEO)
+    large  - серия на 10 000 сэмплов
+плюс еще 20 обычных серий для сквозного прогона, эксперименты и протоколы ArrayExpress и esummary по всем PMID.
+
+Можно записать и настоящие ответы серверов (нужна сеть):
+    python benchmarks/fixtures.py --record --gse GSE10 GSE100000 --ae E-MTAB-513 --pmid 12345678
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Argeos_submit as argeos  # noqa: E402
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fixtures")
+NS = "http://www.ncbi.nlm.nih.gov/geo/info/MINiML"
+SIZES = {"small": 4, "median": 24, "large": 10000}
+EXTRA_SERIES = 20
+JOURNALS = [("Nature", "Nature"), ("Cell", "Cell"), ("Nucleic Acids Research", "Nucleic Acids Res"),
+            ("The Journal of Immunology", "J Immunol"), ("PLoS ONE", "PLoS One")]
+WORDS = ("lung macrophage alveolar inflammation cytokine response knockout tissue cell line treated control "
+         "expression profiling sequencing mouse human liver kidney stimulation time course").split()
+
+
+def text(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def miniml(gse_number, samples, seed):
+    """
+    Выход: bytes с _family.xml серии GSE<gse_number> на samples сэмплов
+    """
+    rnd = random.Random(seed)
+    gse = "GSE" + str(gse_number)
+    two_species = gse_number % 3 == 0
+    out = io.StringIO()
+    out.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+    out.write('<MINiML xmlns="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="0.5.0">\n' % NS)
+    out.write('<Contributor iid="contrib1"><Person><First>Ivan</First><Last>Petrov</Last></Person></Contributor>\n')
+    out.write('<Platform iid="GPL570"><Status database="GEO"><Submission-Date>2003-11-07</Submission-Date>'
+              '</Status><Title>[HG-U133_Plus_2] Affymetrix Human Genome U133 Plus 2.0 Array</Title>'
+              '<Accession database="GEO">GPL570</Accession><Technology>in situ oligonucleotide</Technology>'
+              '<Distribution>commercial</Distribution><Organism taxid="9606">Homo sapiens</Organism></Platform>\n')
+    if two_species:
+        out.write('<Platform iid="GPL1261"><Title>[Mouse430_2] Affymetrix Mouse Genome 430 2.0 Array</Title>'
+                  '<Accession database="GEO">GPL1261</Accession>'
+                  '<Organism taxid="10090">Mus musculus</Organism></Platform>\n')
+    for n in range(samples):
+        out.write('<Sample iid="GSM%d%05d"><Status database="GEO"><Submission-Date>2020-01-01</Submission-Date>'
+                  '</Status><Title>%s</Title><Accession database="GEO">GSM%d%05d</Accession>'
+                  '<Type>RNA</Type><Channel-Count>1</Channel-Count><Channel position="1">'
+                  '<Source>%s</Source><Organism taxid="9606">Homo sapiens</Organism>'
+                  '<Characteristics tag="cell type">%s</Characteristics>'
+                  '<Characteristics tag="time">%d h</Characteristics>'
+                  '<Characteristics tag="donor">donor %d</Characteristics>'
+                  '<Treatment-Protocol>%s</Treatment-Protocol>'
+                  '<Growth-Protocol>%s</Growth-Protocol>'
+                  '<Molecule>total RNA</Molecule>'
+                  '<Extract-Protocol>%s</Extract-Protocol>'
+                  '<Label>biotin</Label></Channel>'
+                  '<Description>%s</Description><Platform-ID>GPL570</Platform-ID></Sample>\n'
+                  % (gse_number, n, text(rnd, 4), gse_number, n, text(rnd, 3), rnd.choice(WORDS) + " cells",
+                     rnd.randint(0, 48), n % 50, text(rnd, 12), text(rnd, 8), text(rnd, 10), text(rnd, 15)))
+    pmid = 30000000 + gse_number
+    out.write('<Series iid="%s"><Status database="GEO"><Submission-Date>2019-0%d-1%d</Submission-Date>'
+              '<Release-Date>2020-01-01</Release-Date><Last-Update-Date>2021-01-01</Last-Update-Date></Status>'
+              '<Title>%s</Title><Accession database="GEO">%s</Accession><Pubmed-ID>%d</Pubmed-ID>'
+              '<Summary>%s</Summary><Overall-Design>%s</Overall-Design>'
+              '<Type>Expression profiling by array</Type>%s'
+              '<Contributor-Ref ref="contrib1" position="1" />'
+              '<Sample-Ref ref="GSM%d00000" />'
+              '<Relation type="BioProject" target="https://www.ncbi.nlm.nih.gov/bioproject/PRJNA%d" />'
+              '<Relation type="SRA" target="https://www.ncbi.nlm.nih.gov/sra?term=SRP%06d" /></Series>\n'
+              % (gse, 1 + gse_number % 9, gse_number % 10, text(rnd, 8), gse, pmid, text(rnd, 120),
+                 text(rnd, 40), '<Type>Expression profiling by high throughput sequencing</Type>'
+                 if gse_number % 2 else "", gse_number, 100000 + gse_number, gse_number))
+    out.write('</MINiML>\n')
+    return out.getvalue().encode("utf-8")
+
+
+def write_family(fixture_dir, gse, xml):
+    path = os.path.join(fixture_dir, argeos.geo_family_path(gse).lstrip("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tarfile.open(path, "w:gz") as tar:
+        info = tarfile.TarInfo(gse + "_family.xml")
+        info.size = len(xml)
+        tar.addfile(info, io.BytesIO(xml))
+    return path
+
+
+def ae_experiment(number, rnd):
+    accession = "E-MTAB-%d" % number
+    protocols = ["P-MTAB-%d" % p for p in rnd.sample(range(1, 40), 6)]
+    xml = ('<experiments version="3.0" revision="130311" total="1" total-samples="%d" total-assays="%d">'
+           '<experiment><id>%d</id><accession>%s</accession><name>%s</name>'
+           '<releasedate>2020-0%d-01</releasedate><lastupdatedate>2021-0%d-01</lastupdatedate>'
+           '<organism>%s</organism><experimenttype>RNA-seq of coding RNA</experimenttype>'
+           '<experimentdesign>%s</experimentdesign><description><id/><text>%s</text></description>'
+           '<bibliography><accession>%d</accession><title>%s</title><publication>%s</publication>'
+           '<doi>10.1000/ae.%d</doi></bibliography>%s'
+           '<arraydesign><accession>A-AFFY-44</accession><name>Affymetrix HG-U133 Plus 2</name></arraydesign>'
+           '</experiment></experiments>'
+           % (rnd.randint(4, 40), rnd.randint(4, 40), number, accession, text(rnd, 6), 1 + number % 9,
+              1 + number % 9, rnd.choice(["Homo sapiens", "Mus musculus"]), text(rnd, 3), text(rnd, 60),
+              31000000 + number, "AE paper " + str(number), rnd.choice(JOURNALS)[0], number,
+              "".join('<protocol><id>%s</id><accession>%s</accession></protocol>' % (p, p) for p in protocols)))
+    return accession, xml, protocols
+
+
+def ae_protocol(accession, rnd):
+    return ('<protocols total="1"><protocol><id>%s</id><accession>%s</accession><name>%s</name>'
+            '<text>%s</text><type>%s</type></protocol></protocols>'
+            % (accession, accession, accession, text(rnd, 40),
+               rnd.choice(["growth protocol", "nucleic acid extraction protocol", "sequencing protocol"])))
+
+
+def summary(pmid, rnd):
+    journal, source = rnd.choice(JOURNALS)
+    return {"uid": str(pmid), "pubdate": "2020 Jan", "source": source, "fulljournalname": journal,
+            "title": "Paper about " + text(rnd, 6), "authors": [{"name": "Petrov I", "authtype": "Author"}],
+            "articleids": [{"idtype": "pubmed", "value": str(pmid)},
+                           {"idtype": "doi", "value": "10.1000/%d" % pmid}]}
+
+
+def build(fixture_dir=DEFAULT_DIR, large=SIZES["large"]):
+    """
+    Вход: директория и кол-во сэмплов в большой серии
+    Генерирует все фикстуры и manifest.json с их списком
+    """
+    rnd = random.Random(2020)
+    manifest = {"geo": {}, "geo_all": [], "ae": [], "pmids": [], "terms": ["lung AND macrophages",
+                                                                          "alveolar | Homo sapiens[ORGN]"]}
+    sizes = dict(SIZES, large=large)
+    numbers = {"small": 101, "median": 102, "large": 103}
+    for name, samples in sizes.items():
+        gse = "GSE" + str(numbers[name])
+        write_family(fixture_dir, gse, miniml(numbers[name], samples, numbers[name]))
+        manifest["geo"][name] = gse
+        manifest["geo_all"].append(gse)
+    for number in range(1000, 1000 + EXTRA_SERIES):
+        write_family(fixture_dir, "GSE" + str(number), miniml(number, rnd.randint(6, 60), number))
+        manifest["geo_all"].append("GSE" + str(number))
+    manifest["pmids"] = [30000000 + int(gse[3:]) for gse in manifest["geo_all"]]
+
+    ae_dir = os.path.join(fixture_dir, "arrayexpress")
+    os.makedirs(os.path.join(ae_dir, "experiments"), exist_ok=True)
+    os.makedirs(os.path.join(ae_dir, "protocols"), exist_ok=True)
+    protocols = set()
+    search = ['<experiments version="3.0" total="10">']
+    for number in range(1, 11):
+        accession, xml, used = ae_experiment(number, rnd)
+        with open(os.path.join(ae_dir, "experiments", accession), "w", encoding="utf-8") as f:
+            f.write(xml)
+        search.append(xml[xml.index("<experiment>"):xml.index("</experiments>")])
+        protocols.update(used)
+        manifest["ae"].append(accession)
+    search.append("</experiments>")
+    with open(os.path.join(ae_dir, "search.xml"), "w", encoding="utf-8") as f:
+        f.write("".join(search))
+    for accession in sorted(protocols):
+        with open(os.path.join(ae_dir, "protocols", accession), "w", encoding="utf-8") as f:
+            f.write(ae_protocol(accession, rnd))
+
+    eutils_dir = os.path.join(fixture_dir, "eutils")
+    os.makedirs(eutils_dir, exist_ok=True)
+    with open(os.path.join(eutils_dir, "esummary.json"), "w") as f:
+        json.dump({str(pmid): summary(pmid, rnd) for pmid in manifest["pmids"]}, f)
+    # uid в gds для серии GSEn - это 200000000 + n
+    with open(os.path.join(eutils_dir, "esearch.json"), "w") as f:
+        json.dump({"gds": [str(200000000 + int(gse[3:])) for gse in manifest["geo_all"]]}, f)
+    with open(os.path.join(fixture_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def record(fixture_dir, gse_list, ae_list, pmid_list):
+    """
+    Записывает настоящие ответы GEO, ArrayExpress и esummary в директорию фикстур (дописывает manifest.json)
+    """
+    import requests
+    manifest_path = os.path.join(fixture_dir, "manifest.json")
+    manifest = load_manifest(fixture_dir) if os.path.exists(manifest_path) else \
+        {"geo": {}, "geo_all": [], "ae": [], "pmids": [], "terms": []}
+    for gse in gse_list:
+        url = argeos.GEO_https_base + argeos.geo_family_path(gse)
+        path = os.path.join(fixture_dir, argeos.geo_family_path(gse).lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        r = requests.get(url, timeout=300)
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            f.write(r.content)
+        manifest["geo_all"].append(gse)
+    for accession in ae_list:
+        xml = requests.get(argeos.AE_base + "/experiments/" + accession, timeout=60).text
+        with open(os.path.join(fixture_dir, "arrayexpress", "experiments", accession), "w", encoding="utf-8") as f:
+            f.write(xml)
+        for protocol in argeos.BeautifulSoup(xml, features="html.parser").find_all("protocol"):
+            prot_id = protocol.find("id").get_text().strip()
+            prot_xml = requests.get(argeos.AE_base + "/protocols/" + prot_id, timeout=60).text
+            with open(os.path.join(fixture_dir, "arrayexpress", "protocols", prot_id), "w", encoding="utf-8") as f:
+                f.write(prot_xml)
+        manifest["ae"].append(accession)
+    if pmid_list:
+        summaries_path = os.path.join(fixture_dir, "eutils", "esummary.json")
+        with open(summaries_path) as f:
+            summaries = json.load(f)
+        r = requests.post(argeos.Eutils_base + "/esummary.fcgi",
+                          data={"db": "pubmed", "id": ",".join(map(str, pmid_list)), "retmode": "json"}, timeout=60)
+        result = r.json()["result"]
+        for uid in result["uids"]:
+            summaries[uid] = result[uid]
+        with open(summaries_path, "w") as f:
+            json.dump(summaries, f)
+        manifest["pmids"].extend(int(p) for p in pmid_list)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest(fixture_dir=DEFAULT_DIR):
+    with open(os.path.join(fixture_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def ensure(fixture_dir=DEFAULT_DIR, large=SIZES["large"]):
+    """
+    Выход: manifest, фикстуры генерируются только если их еще нет
+    """
+    if os.path.exists(os.path.join(fixture_dir, "manifest.json")):
+        return load_manifest(fixture_dir)
+    return build(fixture_dir, large)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--dir", default=DEFAULT_DIR, help="куда складывать фикстуры")
+    parser.add_argument("--large", type=int, default=SIZES["large"], help="сэмплов в большой серии")
+    parser.add_argument("--record", action="store_true", help="записать настоящие ответы серверов (нужна сеть)")
+    parser.add_argument("--gse", nargs="*", default=[])
+    parser.add_argument("--ae", nargs="*", default=[])
+    parser.add_argument("--pmid", nargs="*", default=[])
+    args = parser.parse_args()
+    if args.record:
+        ensure(args.dir, args.large)
+        record(args.dir, args.gse, args.ae, args.pmid)
+    else:
+        build(args.dir, args.large)
+    print(json.dumps(load_manifest(args.dir), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Локальный сервер вместо NCBI и EBI для бенчмарков: отдает фикстуры из fixtures.py.
+    /geo/series/...                   - архивы MINiML (тот же путь, что на ftp.ncbi.nlm.nih.gov)
+    /arrayexpress/experiments?...     - поиск ArrayExpress (search.xml на любой запрос)
+    /arrayexpress/experiments/<id>    - запись ArrayExpress
+    /arrayexpress/protocols/<id>      - протокол ArrayExpress
+    /entrez/eutils/esearch.fcgi       - esearch (gds - все серии из фикстур, с историей и страницами; pubmed - пусто)
+    /entrez/eutils/esummary.fcgi      - esummary по PMID в json (GET и POST)
+FTP тут нет: ARGEOS переключается на скачивание архивов по HTTPS (GEO_ftp_host = None), см. configure
+
+Запуск отдельно (например, чтобы погонять ARGEOS руками):
+    python benchmarks/mock_server.py --port 8765
+"""
+import argparse
+import collections
+import http.server
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+import fixtures
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ArgeosMock/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, data):
+        self._send(200, json.dumps(data).encode(), "application/json")
+
+    def _file(self, path, content_type):
+        path = os.path.normpath(os.path.join(self.server.fixture_dir, path.lstrip("/")))
+        if not path.startswith(self.server.fixture_dir) or not os.path.isfile(path):
+            return self._send(404, b"not found", "text/plain")
+        with open(path, "rb") as f:
+            self._send(200, f.read(), content_type)
+
+    def do_GET(self, form=None):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if form:
+            query.update(form)
+        with self.server.lock:
+            self.server.hits[url.path.split("/")[1]] += 1
+        if url.path.startswith("/geo/"):
+            self._file(url.path, "application/x-gzip")
+        elif url.path.rstrip("/") == "/arrayexpress/experiments":
+            self._file("arrayexpress/search.xml", "application/xml")
+        elif url.path.startswith("/arrayexpress/"):
+            self._file(url.path, "application/xml")
+        elif url.path.endswith("/esearch.fcgi"):
+            self._json({"header": {}, "esearchresult": self.server.esearch(query)})
+        elif url.path.endswith("/esummary.fcgi"):
+            uids = [uid for uid in query.get("id", "").split(",") if uid in self.server.summaries]
+            result = {"uids": uids}
+            for uid in uids:
+                result[uid] = self.server.summaries[uid]
+            self._json({"header": {"type": "esummary", "version": "0.3"}, "result": result})
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode()))
+        self.do_GET(form)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """
+    Сервер с фикстурами. Как менеджер контекста запускается в отдельном потоке на свободном порту:
+        with MockServer(fixture_dir) as server:
+            server.configure(Argeos_submit)
+    """
+    daemon_threads = True
+
+    def __init__(self, fixture_dir=fixtures.DEFAULT_DIR, port=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.fixture_dir = os.path.abspath(fixture_dir)
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()  # запросы по первой части пути (geo, arrayexpress, entrez)
+        self.history = {}
+        with open(os.path.join(self.fixture_dir, "eutils", "esummary.json")) as f:
+            self.summaries = json.load(f)
+        with open(os.path.join(self.fixture_dir, "eutils", "esearch.json")) as f:
+            self.uids = json.load(f)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def esearch(self, query):
+        term = query.get("term", "")
+        if term.startswith("#"):  # страница из истории прошлого запроса
+            uids = self.history.get((query.get("WebEnv"), term[1:]), [])
+        else:
+            uids = self.uids.get(query.get("db", "pubmed"), [])
+        start = int(query.get("retstart", 0))
+        retmax = int(query.get("retmax", 20))
+        result = {"count": str(len(uids)), "retmax": str(len(uids[start:start + retmax])), "retstart": str(start),
+                  "idlist": uids[start:start + retmax]}
+        if query.get("usehistory") == "y" and not term.startswith("#"):
+            with self.lock:
+                key = str(len(self.history) + 1)
+                self.history[("MOCK", key)] = uids
+            result.update(querykey=key, webenv="MOCK")
+        return result
+
+    def configure(self, argeos):
+        """
+        Направляет все запросы ARGEOS на этот сервер
+        """
+        argeos.GEO_ftp_host = None
+        argeos.GEO_https_base = self.url
+        argeos.AE_base = self.url + "/arrayexpress"
+        argeos.Eutils_base = self.url + "/entrez/eutils"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--dir", default=fixtures.DEFAULT_DIR)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    fixtures.ensure(args.dir)
+    server = MockServer(args.dir, args.port)
+    print("Serving " + server.fixture_dir + " on " + server.url, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Набор бенчмарков ARGEOS на записанных фикстурах (fixtures.py) через локальный сервер (mock_server.py),
+без обращений к NCBI и EBI. Меряются:
+    geo_xml_parser / geo_xml_iterparser - small, median и large (10k сэмплов) серии
+    gsm_analizator  - блоки сэмплов большой серии
+    pubmed_parser   - summary всех статей из фикстур (esummary через локальный сервер)
+    split_to_unique - N записей (по умолчанию 10 000)
+    table_output    - те же N записей в tsv
+    main            - полный запуск: поиск, скачивание, разбор, PubMed, ArrayExpress и запись таблицы
+Результат - json (min и медиана по повторам, в секундах), чтобы сравнивать между коммитами.
+
+Запуск из корня репозитория:
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --repeat 5 --output bench.json
+    python benchmarks/run_benchmarks.py --only main geo_xml_parser
+"""
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Argeos_submit as argeos  # noqa: E402
+import bench_records  # noqa: E402
+import fixtures  # noqa: E402
+import mock_server  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# XMLParsedAsHTMLWarning на каждый разбор супом. На уровне модуля, а не в main(): процессы разбора (forkserver)
+# импортируют этот файл заново и иначе фильтра не получат
+warnings.filterwarnings("ignore", message="It looks like you're using an HTML parser")
+
+
+def measure(func, repeat, setup=None):
+    """
+    Вход: функция, кол-во повторов и (не обязательно) функция подготовки, ее результат передается в func
+    Выход: словарь с временем (подготовка не считается)
+    """
+    times = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def family_xml(fixture_dir, gse):
+    with tarfile.open(os.path.join(fixture_dir, argeos.geo_family_path(gse).lstrip("/")), "r:gz") as tf:
+        return tf.extractfile(gse + "_family.xml").read()
+
+
+def bench_parsers(fixture_dir, manifest, repeat, results):
+    for name, gse in manifest["geo"].items():
+        xml = family_xml(fixture_dir, gse)
+        for parser in ("geo_xml_parser", "geo_xml_iterparser"):
+            results[parser + "/" + name] = measure(lambda stream: getattr(argeos, parser)(stream), repeat,
+                                                   lambda: io.BytesIO(xml))
+    xml = family_xml(fixture_dir, manifest["geo"]["large"]).decode("utf-8")
+    samples = argeos.BeautifulSoup(xml, features="html.parser").find_all("sample")
+    results["gsm_analizator/large"] = measure(argeos.gsm_analizator, repeat, lambda: samples)
+    results["gsm_analizator/large"]["samples"] = len(samples)
+
+
+def bench_pubmed(fixture_dir, manifest, repeat, results):
+    records = [argeos.geo_xml_iterparser(io.BytesIO(family_xml(fixture_dir, gse))) for gse in manifest["geo_all"]]
+    pmids = [pmid for gse_info in records for pmid in gse_info.PubMed_info.pbid or []]
+
+    def run(batch):
+        argeos._pubmed_client = None  # новый клиент: каждый повтор идет на сервер, а не в память
+        argeos.pubmed_parser(batch, pmids, io.StringIO())
+
+    results["pubmed_parser"] = measure(run, repeat, lambda: copy.deepcopy(records))
+    results["pubmed_parser"]["pmids"] = len(pmids)
+
+
+def bench_split(n, repeat, results):
+    records = [bench_records.make_record(i) for i in range(n)]
+    results["split_to_unique"] = measure(argeos.split_to_unique, repeat, lambda: records)
+    results["split_to_unique"]["records"] = n
+    split = argeos.split_to_unique(records)
+    with tempfile.TemporaryDirectory() as out:
+        def run(writer):
+            argeos.table_output(split, writer)
+            writer.close()
+
+        results["table_output"] = measure(run, repeat, lambda: argeos.open_table_writer(out, "tsv"))
+        results["table_output"]["rows"] = len(split)
+
+
+def bench_main(manifest, repeat, results, extra_args):
+    with tempfile.TemporaryDirectory() as work:
+        terms = os.path.join(work, "input_terms.txt")
+        with open(terms, "w") as f:
+            f.write("\n".join(manifest["terms"]) + "\n")
+        out = os.path.join(work, "out")
+
+        def run(_):
+            with contextlib.redirect_stderr(io.StringIO()), contextlib.redirect_stdout(io.StringIO()):
+                argeos.main(["-i", terms, "-o", out] + extra_args, standalone_mode=False)
+
+        def setup():
+            shutil.rmtree(out, ignore_errors=True)
+            # общие на запуск клиенты main закрывает в конце, для следующего повтора нужны новые
+            argeos._geo_downloader = None
+            argeos._ae_client = None
+            argeos._pubmed_client = None
+            argeos.Error_List.clear()
+
+        results["main"] = measure(run, repeat, setup)
+        with open(os.path.join(out, "output_argeos.tsv")) as f:
+            results["main"]["rows"] = sum(1 for _ in f) - 1
+        results["main"]["args"] = extra_args
+        with open(os.path.join(out, "run_report.json")) as f:
+            # суммарное время по стадиям из отчета последнего повтора (см. RunMetrics в Argeos_submit.py)
+            histograms = json.load(f)["histograms"]
+        results["main"]["stages"] = {name: round(hist["sum"], 4) for name, hist in histograms.items()
+                                     if name.endswith("_seconds")}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--fixtures", default=fixtures.DEFAULT_DIR, help="директория с фикстурами")
+    parser.add_argument("--rebuild", action="store_true", help="сгенерировать фикстуры заново")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--records", type=int, default=10000, help="записей для split_to_unique и table_output")
+    parser.add_argument("--only", nargs="*", default=None,
+                        help="только эти бенчмарки (geo_xml_parser, gsm_analizator, pubmed_parser, "
+                             "split_to_unique, main)")
+    parser.add_argument("--main_args", default="", help="дополнительные аргументы для main, одной строкой")
+    parser.add_argument("--output", default=None, help="куда записать json (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    manifest = fixtures.build(args.fixtures) if args.rebuild else fixtures.ensure(args.fixtures)
+    wanted = set(args.only) if args.only else None
+    results = {}
+    argeos._entrez_bucket = argeos.TokenBucket(1000)  # локальному серверу ограничение NCBI не нужно
+    with mock_server.MockServer(args.fixtures) as server:
+        server.configure(argeos)
+        if wanted is None or wanted & {"geo_xml_parser", "gsm_analizator"}:
+            bench_parsers(args.fixtures, manifest, args.repeat, results)
+        if wanted is None or "pubmed_parser" in wanted:
+            bench_pubmed(args.fixtures, manifest, args.repeat, results)
+        if wanted is None or wanted & {"split_to_unique", "table_output"}:
+            bench_split(args.records, args.repeat, results)
+        if wanted is None or "main" in wanted:
+            bench_main(manifest, args.repeat, results, args.main_args.split())
+        requests = dict(server.hits)
+
+    report = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+              "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "requests": requests,
+              "results": results}
+    text = json.dumps(report, indent=1)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
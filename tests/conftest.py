@@ -0,0 +1,55 @@
+"""
+Общее для тестов: фикстуры из benchmarks/fixtures.py (большая серия урезана, чтобы прогоны были быстрыми)
+и локальный сервер benchmarks/mock_server.py вместо NCBI и EBI
+"""
+import contextlib
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import Argeos_submit as argeos  # noqa: E402
+import fixtures  # noqa: E402
+import mock_server  # noqa: E402
+
+
+def pytest_configure(config):
+    # XMLParsedAsHTMLWarning на каждый разбор супом
+    config.addinivalue_line("filterwarnings", "ignore:It looks like you're using an HTML parser")
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    fixture_dir = str(tmp_path_factory.mktemp("fixtures"))
+    manifest = fixtures.build(fixture_dir, large=200)
+    argeos._entrez_bucket = argeos.TokenBucket(1000)
+    with mock_server.MockServer(fixture_dir) as mock:
+        mock.configure(argeos)
+        mock.manifest = manifest
+        yield mock
+
+
+@pytest.fixture
+def run_main(server, tmp_path):
+    """
+    Выход: функция run_main(output_dir, *аргументы) - запуск main по запросам из фикстур, возвращает stderr
+    """
+    terms = tmp_path / "input_terms.txt"
+    terms.write_text("\n".join(server.manifest["terms"]) + "\n")
+
+    def run(output_dir, *args):
+        # общие на запуск клиенты main закрывает в конце, для следующего запуска нужны новые
+        argeos._geo_downloader = None
+        argeos._ae_client = None
+        argeos._pubmed_client = None
+        argeos.Error_List.clear()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err), contextlib.redirect_stdout(io.StringIO()):
+            argeos.main(["-i", str(terms), "-o", str(output_dir)] + list(args), standalone_mode=False)
+        return err.getvalue()
+
+    return run
@@ -0,0 +1,32 @@
+"""
+Журнал CheckpointJournal: --resume и --incremental не должны ни дублировать, ни терять уже записанные строки
+"""
+import os
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_resume_after_crash_in_first_batch(run_main, tmp_path):
+    run_main(tmp_path / "full")
+    out = tmp_path / "out"
+    run_main(out)
+    table = out / "output_argeos.tsv"
+    with open(table, "rb") as f:
+        header = f.readline()
+    os.truncate(table, len(header) + 5000)  # упали посреди первого пакета
+    with open(out / "checkpoint_argeos.jsonl", "w"):
+        pass  # и журнал успел только создаться
+    run_main(out, "--resume")
+    assert read(table) == read(tmp_path / "full" / "output_argeos.tsv")
+
+
+def test_incremental_without_journal_keeps_output(run_main, tmp_path):
+    out = tmp_path / "out"
+    run_main(out)
+    before = read(out / "output_argeos.tsv")
+    os.remove(out / "checkpoint_argeos.jsonl")
+    run_main(out, "--incremental")
+    assert read(out / "output_argeos.tsv") == before
@@ -0,0 +1,43 @@
+"""
+Запуски с --shard i/N, собранные командой merge, должны давать ту же выдачу, что и один запуск без шардов
+"""
+import contextlib
+import io
+
+import pytest
+
+import Argeos_submit as argeos
+
+
+def read_table(path, fmt):
+    if fmt == "parquet":
+        return pytest.importorskip("pyarrow.parquet").read_table(path)
+    if fmt == "arrow":
+        return pytest.importorskip("pyarrow").ipc.open_file(path).read_all()
+    with argeos.open_tsv(path) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("fmt", ["tsv", "tsv.gz", "parquet", "arrow"])
+def test_three_shards_match_single_run(run_main, tmp_path, fmt):
+    if fmt in ("parquet", "arrow"):
+        pytest.importorskip("pyarrow")
+    # маленькие группы строк, чтобы слияние шло через несколько RecordBatch
+    args = ["--format", fmt, "--row_group_size", "7"]
+    run_main(tmp_path / "single", *args)
+    sharded = tmp_path / "sharded"
+    for index in (1, 2, 3):
+        run_main(sharded, "--shard", str(index) + "/3", *args)
+    with contextlib.redirect_stderr(io.StringIO()):
+        argeos.main(["-o", str(sharded), "merge"], standalone_mode=False)  # -o перед командой тоже работает
+    single = read_table(argeos.table_path(str(tmp_path / "single"), fmt), fmt)
+    merged = read_table(argeos.table_path(str(sharded), fmt), fmt)
+    assert merged == single if fmt.startswith("tsv") else merged.equals(single)
+    assert (sharded / "table_term.tsv").read_text() == (tmp_path / "single" / "table_term.tsv").read_text()
+
+
+def test_merge_rejects_run_options(tmp_path):
+    with pytest.raises(argeos.click.UsageError):
+        argeos.main(["-o", str(tmp_path), "--format", "parquet", "merge"], standalone_mode=False)
+    with pytest.raises(argeos.click.UsageError):
+        argeos.main(["-o", str(tmp_path), "merge", "-o", str(tmp_path / "other")], standalone_mode=False)
@@ -0,0 +1,42 @@
+"""
+Какие ошибки повторяются (net_call) и попадают в Error_List для --retry_failed, а какие нет
+"""
+import ftplib
+import io
+import socket
+
+import pytest
+import requests
+
+import Argeos_submit as argeos
+
+
+@pytest.mark.parametrize("error", [requests.ConnectionError("refused"), requests.ReadTimeout("slow"),
+                                   requests.exceptions.ChunkedEncodingError("cut"), ConnectionResetError(),
+                                   socket.timeout(), socket.gaierror(), ftplib.error_temp("421 busy"), EOFError()])
+def test_transient(error):
+    assert argeos.is_transient(error)
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.InvalidURL("bad"), requests.exceptions.MissingSchema("bad"),
+                                   requests.exceptions.InvalidSchema("bad"), PermissionError(), FileNotFoundError(),
+                                   ftplib.error_perm("550 no such file"), IndexError("series")])
+def test_permanent(error):
+    assert not argeos.is_transient(error)
+
+
+def test_http_status():
+    response = requests.Response()
+    for status, transient in ((503, True), (429, True), (404, False), (403, False)):
+        response.status_code = status
+        assert argeos.is_transient(requests.HTTPError(response=response)) == transient
+
+
+def test_note_failure(monkeypatch):
+    monkeypatch.setattr(argeos, "Error_List", [])
+    errors = io.StringIO()
+    argeos.note_failure(errors, "download", "GSE1", requests.ConnectionError("refused"))
+    argeos.note_failure(errors, "download", "GSE2", argeos.CircuitOpen("ftp.ncbi.nlm.nih.gov"))
+    argeos.note_failure(errors, "download", "GSE3", PermissionError("denied"))
+    assert argeos.Error_List == ["GSE1", "GSE2"]
+    assert errors.getvalue().splitlines()[2] == "error was (download, not retried: PermissionError: denied) GSE3"
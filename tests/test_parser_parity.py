@@ -0,0 +1,47 @@
+"""
+Суп (geo_xml_parser) и iterparse (geo_xml_iterparser) должны давать одинаковые записи по одному и тому же MINiML.
+Запуск из корня репозитория: python -m pytest -q tests
+"""
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import Argeos_submit as argeos  # noqa: E402
+
+SAMPLE = ('<Sample iid="%s"><Accession database="GEO">%s</Accession><Channel-Count>1</Channel-Count>'
+          '<Channel position="1"><Source>%s</Source><Organism taxid="9606">Homo sapiens</Organism>%s'
+          '<Molecule>total RNA</Molecule><Extract-Protocol>TRIzol</Extract-Protocol></Channel></Sample>\n')
+
+
+def miniml(*samples):
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n'
+            '<MINiML xmlns="http://www.ncbi.nlm.nih.gov/geo/info/MINiML" version="0.5.0">\n'
+            '<Platform iid="GPL570"><Accession database="GEO">GPL570</Accession>'
+            '<Organism taxid="9606">Homo sapiens</Organism></Platform>\n' + "".join(samples) +
+            '<Series iid="GSE1"><Status database="GEO"><Submission-Date>2020-01-01</Submission-Date></Status>'
+            '<Title>Parity</Title><Accession database="GEO">GSE1</Accession><Summary>none</Summary>'
+            '<Overall-Design>none</Overall-Design><Type>Expression profiling by array</Type></Series>\n'
+            '</MINiML>\n').encode("utf-8")
+
+
+def fields(record):
+    return {name: getattr(record, name) for name in record.__slots__}
+
+
+def both(xml, sample_rows=False):
+    soup = argeos.geo_xml_parser(io.BytesIO(xml), sample_rows)
+    it = argeos.geo_xml_iterparser(io.BytesIO(xml), sample_rows)
+    for part in ("series_info", "PubMed_info", "gsm_info"):
+        assert fields(getattr(soup, part)) == fields(getattr(it, part))
+    return it
+
+
+def test_source_without_cell_type():
+    xml = miniml(SAMPLE % ("GSM1", "GSM1", "lung tissue", ""),
+                 SAMPLE % ("GSM2", "GSM2", "", ""),
+                 SAMPLE % ("GSM3", "GSM3", "liver", '<Characteristics tag="cell type">hepatocyte</Characteristics>'))
+    record = both(xml)
+    assert record.gsm_info.Cell_type == "'Source: lung tissue', 'Source: ', 'hepatocyte'"
+    record = both(xml, sample_rows=True)
+    assert [row[2] for row in record.gsm_info.Samples] == ["lung tissue", "", "liver"]
@@ -0,0 +1,92 @@
+"""
+Разбор строк input_terms.txt (parse_query) и сборка из них запросов для GEO и ArrayExpress
+"""
+import urllib.parse
+
+import pytest
+
+import Argeos_submit as argeos
+
+
+def old_entrez_term(term):
+    # как запрос для GEO собирался склейкой строк до parse_query
+    if "|" in term:
+        term = "(" + term.strip() + " AND gse[ETYP]"
+        return term.replace(" |", "|").replace("|", ") AND")
+    return "(" + term.strip() + ") AND gse[ETYP]"
+
+
+def old_ae(term):
+    # как адрес и подпись для ArrayExpress собирались до parse_query: (keywords=..., подпись в table_term.tsv)
+    if "|" in term:
+        orgn = term.split("|")[1].strip().split("[")[0]
+        norm_term = "(" + term.split("|")[0].strip() + ")" + "&species=" + orgn
+    else:
+        norm_term = "(" + term.strip() + ")"
+    norm_term = "+".join(part for part in norm_term.split(" ") if part)
+    return "keywords=" + norm_term, norm_term.replace("+", " ").replace("&species=", " | ")
+
+
+@pytest.mark.parametrize("line", ["lung AND macrophages", "(lung AND macrophages)", "alveolar | Homo sapiens[ORGN]",
+                                  "alveolar macrophage | Mus musculus[ORGN]", "(lung OR liver) AND inflammation",
+                                  "lung NOT mouse", "cytokine response[TIAB]"])
+def test_same_as_string_concatenation(line):
+    query = argeos.parse_query(line + "\n")
+    assert query.entrez_term() == old_entrez_term(line)
+    if "[" not in line.partition("|")[0]:  # тэги полей ArrayExpress раньше получал как есть
+        assert (query.ae_params(), query.ae_label()) == old_ae(line)
+
+
+def test_examples():
+    query = argeos.parse_query("lung AND macrophages")
+    assert query.entrez_term() == "(lung AND macrophages) AND gse[ETYP]"
+    assert query.ae_params() == "keywords=(lung+AND+macrophages)"
+    query = argeos.parse_query("alveolar | Homo sapiens[ORGN]")
+    assert query.entrez_term() == "(alveolar) AND Homo sapiens[ORGN] AND gse[ETYP]"
+    assert query.ae_params() == "keywords=(alveolar)&species=Homo+sapiens"
+    assert query.ae_label() == "(alveolar) | Homo sapiens"
+    # организм без тэга: для Entrez [ORGN] дописывается сам
+    assert argeos.parse_query("alveolar | Homo sapiens").entrez_term() == \
+        "(alveolar) AND Homo sapiens[ORGN] AND gse[ETYP]"
+
+
+def test_operators_keep_written_order():
+    # приоритетов не вводим: Entrez считает операторы слева направо, так что порядок и скобки остаются как есть
+    query = argeos.parse_query("a OR b AND c")
+    assert [item if isinstance(item, str) else item.words for item in query.items] == [["a"], "OR", ["b"], "AND",
+                                                                                      ["c"]]
+    assert query.entrez_term() == "(a OR b AND c) AND gse[ETYP]"
+    query = argeos.parse_query("(a OR (b)) AND c")
+    group = query.items[0]
+    assert isinstance(group, argeos.QueryGroup) and isinstance(group.items[2], argeos.QueryGroup)
+    assert query.entrez_term() == "((a OR (b)) AND c) AND gse[ETYP]"
+
+
+def test_field_tags():
+    query = argeos.parse_query("lung AND Homo sapiens [ORGN]")
+    assert (query.items[2].words, query.items[2].field) == (["Homo", "sapiens"], "ORGN")
+    assert query.entrez_term() == "(lung AND Homo sapiens[ORGN]) AND gse[ETYP]"
+    # в цепочке из AND организм уходит в species, а тэги только для Entrez выкидываются
+    assert argeos.parse_query("lung AND Homo sapiens[ORGN] AND 2020[PDAT]").ae_label() == "(lung) | Homo sapiens"
+    # с OR так нельзя - от тэга остается только слово
+    assert argeos.parse_query("lung OR Homo sapiens[ORGN]").ae_label() == "(lung OR Homo sapiens)"
+
+
+def test_quoted_phrase():
+    query = argeos.parse_query('"alveolar macrophage" AND lung[TIAB]')
+    assert query.items[0].words == ['"alveolar macrophage"']
+    assert query.entrez_term() == '("alveolar macrophage" AND lung[TIAB]) AND gse[ETYP]'
+    assert urllib.parse.unquote_plus(query.ae_params()) == 'keywords=("alveolar macrophage" AND lung)'
+    # скобки и операторы внутри кавычек - часть фразы
+    assert argeos.parse_query('"a (b) OR c"').items[0].words == ['"a (b) OR c"']
+
+
+def test_blank_line():
+    assert argeos.parse_query("  \n") is None
+
+
+@pytest.mark.parametrize("line", ["(lung", "lung)", "lung AND (", "()", '"lung', "[ORGN] lung", "a | b | c", " | ",
+                                  "AND", "lung AND", "OR lung", "lung AND OR liver", "(lung NOT) AND liver"])
+def test_malformed(line):
+    with pytest.raises(argeos.QuerySyntaxError):
+        argeos.parse_query(line)